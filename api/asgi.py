@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+ASGI-режим Rating API.
+Прокси-эндпоинты к referrals service (/api/referral-join, /api/check-subscriptions)
+работают асинхронно через общий пул httpx: ожидание медленной проверки Telegram
+стоит корутину, а не поток gunicorn. Остальные маршруты обслуживает тот же
+Flask-приложение (rating_api.app) через WSGI-адаптер — маршруты и JSON не меняются.
+Здесь же живая трансляция розыгрыша (/api/giveaway/events, SSE): клиент держит одно
+соединение вместо опроса draw-status/results, события приходят через Redis pub/sub
+(draw_events.py). В WSGI-режиме этого маршрута нет — клиенты продолжают опрос.
+
+Запуск: gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+"""
+
+import asyncio
+import json
+import os
+import random
+from typing import Any, Dict, Optional
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from rating_api import app as flask_app, _draw_events, _draw_state, _get_cached_giveaway_results
+
+REFERRALS_API_URL = os.environ.get('REFERRALS_API_URL', 'http://referrals_api:8000')
+REFERRALS_TIMEOUT = float(os.environ.get('REFERRALS_TIMEOUT', '25'))
+# Сколько одновременных запросов к referrals держит один процесс
+REFERRALS_MAX_CONNECTIONS = int(os.environ.get('REFERRALS_MAX_CONNECTIONS', '200'))
+REFERRALS_MAX_KEEPALIVE = int(os.environ.get('REFERRALS_MAX_KEEPALIVE', '50'))
+# Потоки для Flask-маршрутов внутри ASGI-процесса
+WSGI_WORKERS = int(os.environ.get('WSGI_WORKERS', os.environ.get('GUNICORN_THREADS', '4')))
+# SSE: комментарий-пинг раз в N секунд (держит соединение через прокси), лимит клиентов на процесс,
+# очередь событий на клиента — отставший клиент получает свежий snapshot вместо пропущенных событий
+DRAW_EVENTS_HEARTBEAT = float(os.environ.get('DRAW_EVENTS_HEARTBEAT', '15'))
+DRAW_EVENTS_MAX_CLIENTS = int(os.environ.get('DRAW_EVENTS_MAX_CLIENTS', '5000'))
+DRAW_EVENTS_QUEUE = int(os.environ.get('DRAW_EVENTS_QUEUE', '64'))
+
+app = FastAPI(title="GTM Rating API (ASGI)", docs_url=None, redoc_url=None, openapi_url=None)
+# Как Flask-CORS по умолчанию: любые источники
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+@app.on_event("startup")
+async def _startup() -> None:
+    global _client
+    _client = httpx.AsyncClient(
+        base_url=REFERRALS_API_URL,
+        timeout=REFERRALS_TIMEOUT,
+        limits=httpx.Limits(max_connections=REFERRALS_MAX_CONNECTIONS, max_keepalive_connections=REFERRALS_MAX_KEEPALIVE),
+    )
+
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    if _client is not None:
+        await _client.aclose()
+
+
+async def _json_body(request: Request) -> Dict[str, Any]:
+    try:
+        data = await request.json()
+    except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def _proxy(path: str, payload: Dict[str, Any]) -> JSONResponse:
+    r = await _client.post(path, json=payload)
+    return JSONResponse(r.json(), status_code=r.status_code)
+
+
+@app.post('/api/referral-join')
+async def referral_join(request: Request):
+    """Proxy: начисление реферального билета через referrals service (асинхронно)"""
+    try:
+        data = await _json_body(request)
+        referral_code = data.get('referral_code')
+        referred_telegram_id = data.get('referred_telegram_id')
+        if not referral_code or not referred_telegram_id:
+            return JSONResponse({'success': False, 'error': 'referral_code and referred_telegram_id required'}, status_code=400)
+        return await _proxy('/referral-join', {
+            'referral_code': referral_code,
+            'referred_telegram_id': int(referred_telegram_id),
+        })
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=500)
+
+
+@app.post('/api/check-subscriptions')
+async def check_subscriptions(request: Request):
+    """Proxy: проверка подписок через referrals service (асинхронно)"""
+    try:
+        data = await _json_body(request)
+        telegram_id = data.get('telegram_id')
+        if not telegram_id:
+            return JSONResponse({'success': False, 'error': 'telegram_id required'}, status_code=400)
+        return await _proxy('/check-subscriptions', {'telegram_id': int(telegram_id)})
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, status_code=500)
+
+
+_sse_clients = 0
+
+
+def _sse(event: Dict[str, Any]) -> bytes:
+    lines = []
+    if event.get('version') is not None:
+        lines.append(f"id: {event['version']}")
+    lines.append(f"event: {event.get('type', 'message')}")
+    lines.append("data: " + json.dumps(event, ensure_ascii=False, default=str))
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+async def _draw_snapshot(giveaway_id: int) -> Dict[str, Any]:
+    """Текущее состояние и победители — из версионированного кэша (Redis/LRU), не из Supabase"""
+    state = await run_in_threadpool(_draw_state.get, giveaway_id)
+    winners = []
+    if state.get('completed'):
+        winners = await run_in_threadpool(_get_cached_giveaway_results, giveaway_id, state) or []
+    return {'type': 'snapshot', 'giveaway_id': giveaway_id, 'version': state.get('version', 0),
+            'completed': bool(state.get('completed')), 'winners_count': state.get('winners_count', 0),
+            'winners': winners}
+
+
+@app.get('/api/giveaway/events')
+async def giveaway_events(request: Request, giveaway_id: int = 1):
+    """SSE: snapshot при подключении, затем drawing / winner (по местам) / status (с error, если розыгрыш сорвался)"""
+    if _sse_clients >= DRAW_EVENTS_MAX_CLIENTS:
+        return JSONResponse({'success': False, 'error': 'too many listeners'}, status_code=503,
+                            headers={'Retry-After': '5'})
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=DRAW_EVENTS_QUEUE)
+
+    def offer(event: Dict[str, Any]) -> None:
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Клиент не успевает читать: выбрасываем накопленное, он получит snapshot
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait({'type': 'resync'})
+
+    def on_event(event: Dict[str, Any]) -> None:
+        # Вызывается из потока подписки на Redis
+        if int(event.get('giveaway_id') or 0) == giveaway_id:
+            loop.call_soon_threadsafe(offer, event)
+
+    async def stream():
+        global _sse_clients
+        _sse_clients += 1
+        # Подписываемся до snapshot: событие между ними придёт повторно, а не потеряется (клиент сверяет version)
+        unsubscribe = _draw_events.subscribe(on_event)
+        try:
+            # Разброс переподключений, чтобы рестарт реплики не давал всплеск
+            yield f"retry: {random.randint(2000, 5000)}\n\n".encode()
+            yield _sse(await _draw_snapshot(giveaway_id))
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), DRAW_EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield b": ping\n\n"
+                    continue
+                if event.get('type') == 'resync':
+                    event = await _draw_snapshot(giveaway_id)
+                yield _sse(event)
+        finally:
+            unsubscribe()
+            _sse_clients -= 1
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Всё остальное — существующие Flask-маршруты
+app.mount('/', WSGIMiddleware(flask_app, workers=WSGI_WORKERS))
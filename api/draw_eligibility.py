@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Индекс допуска к розыгрышу, который ведётся заранее, а не собирается в момент розыгрыша.
+Две части:
+  * список исключений (организаторы; GIVEAWAY_EXCLUDED_IDS) — маска снимка в draw-winners,
+    как и раньше жёстко заданный список;
+  * последние решённые проверки подписок в Redis-хэше, общем для реплик (без Redis — в памяти
+    процесса). Пишут только решённые проверки (record): API, воркер referrals (/check, sweep)
+    и бот по вступлениям/выходам из каналов; ошибка Telegram ничего не меняет.
+generate-results по-прежнему проверяет каждого выпавшего владельца билетов за подписку вживую.
+Индекс лишь избавляет от проверки тех, чья подписка подтверждена не раньше
+ELIGIBILITY_VERIFIED_TTL назад, и — только если задан ELIGIBILITY_UNSUBSCRIBED_TTL — маскирует
+тех, чей отказ («не подписан») не старше этого окна. Оба окна по умолчанию выключены (0):
+закэшированный отказ сам по себе никого не исключает.
+Над снимком индекс превращается в маску: розыгрыш выбирает только из веса допущенных
+участников (giveaway_draw.draw_giveaway(excluded=...)), а не отбрасывает их после выборки.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from giveaway_draw import DrawSnapshot
+from shared_cache import CACHE_PREFIX, RedisError, get_redis
+
+# Тот же хэш пишут referrals и бот (shared/tg_membership.py GIVEAWAY_ELIGIBILITY_KEY)
+ELIGIBILITY_KEY = os.environ.get('GIVEAWAY_ELIGIBILITY_KEY', f"{CACHE_PREFIX}:giveaway:eligibility:subs")
+# Сколько секунд подтверждённая подписка избавляет кандидата от повторной проверки (0 — проверять всегда)
+ELIGIBILITY_VERIFIED_TTL = float(os.environ.get('ELIGIBILITY_VERIFIED_TTL', '0'))
+# Сколько секунд отказ («не подписан») исключает из выборки generate-results без новой проверки
+# (0 — не исключает: выпавший кандидат проверяется вживую). Имеет смысл только короткое окно,
+# например сразу после sweep'а: переподписавшийся за это время пользователь будет пропущен
+ELIGIBILITY_UNSUBSCRIBED_TTL = float(os.environ.get('ELIGIBILITY_UNSUBSCRIBED_TTL', '0'))
+# Размер HMGET при чтении состояний владельцев билетов за подписку
+ELIGIBILITY_READ_CHUNK = 1000
+
+
+def _encode(ok: bool, at: float) -> str:
+    return f"{1 if ok else 0}:{at:.3f}"
+
+
+def _decode(raw) -> Tuple[bool, float]:
+    if isinstance(raw, bytes):
+        raw = raw.decode()
+    flag, _, at = str(raw).partition(':')
+    return flag == '1', float(at or 0)
+
+
+class EligibilityIndex:
+    """excluded — telegram_id, которые не могут выиграть ни при каких условиях"""
+
+    def __init__(self, excluded: Iterable[int] = ()):
+        self._lock = threading.Lock()
+        self._excluded: frozenset = frozenset(int(t) for t in excluded)
+        self._local: Dict[int, Tuple[bool, float]] = {}
+        self._stats = {'recorded': 0, 'masked': 0, 'refusals_masked': 0, 'skipped_checks': 0}
+
+    @property
+    def excluded(self) -> frozenset:
+        return self._excluded
+
+    def set_excluded(self, telegram_ids: Iterable[int]) -> None:
+        self._excluded = frozenset(int(t) for t in telegram_ids)
+
+    def is_excluded(self, telegram_id: int) -> bool:
+        return int(telegram_id) in self._excluded
+
+    # --- состояние подписок ---
+
+    def record(self, results: Dict[int, bool], at: Optional[float] = None) -> None:
+        """Решённые проверки подписок {telegram_id: подписан на все каналы}; неудавшиеся не передавать"""
+        if not results:
+            return
+        at = time.time() if at is None else at
+        with self._lock:
+            self._stats['recorded'] += len(results)
+        r = get_redis()
+        if r is not None:
+            try:
+                r.hset(ELIGIBILITY_KEY, mapping={str(int(t)): _encode(ok, at) for t, ok in results.items()})
+                return
+            except RedisError as e:
+                print(f"⚠️ eligibility: не удалось сохранить проверки подписок: {e}")
+        # Без Redis состояние живёт в памяти процесса
+        with self._lock:
+            for tid, ok in results.items():
+                self._local[int(tid)] = (bool(ok), at)
+
+    def _entries(self, telegram_ids: List[int]) -> Dict[int, Tuple[bool, float]]:
+        """Последние проверки указанных пользователей (Redis + более свежие локальные)"""
+        entries: Dict[int, Tuple[bool, float]] = {}
+        r = get_redis()
+        if r is not None and telegram_ids:
+            try:
+                pipe = r.pipeline(transaction=False)
+                for i in range(0, len(telegram_ids), ELIGIBILITY_READ_CHUNK):
+                    pipe.hmget(ELIGIBILITY_KEY, [str(t) for t in telegram_ids[i:i + ELIGIBILITY_READ_CHUNK]])
+                values = [v for chunk in pipe.execute() for v in chunk]
+                for tid, raw in zip(telegram_ids, values):
+                    if raw is not None:
+                        entries[tid] = _decode(raw)
+            except (RedisError, ValueError) as e:
+                print(f"⚠️ eligibility: Redis недоступен, берём локальное состояние: {e}")
+                entries = {}
+        with self._lock:
+            for tid in telegram_ids:
+                local = self._local.get(tid)
+                if local is not None and (tid not in entries or local[1] > entries[tid][1]):
+                    entries[tid] = local
+        return entries
+
+    def recently_subscribed(self, telegram_ids: Iterable[int]) -> Set[int]:
+        """Кому не нужна живая проверка: подписка подтверждена не раньше ELIGIBILITY_VERIFIED_TTL назад"""
+        ids = [int(t) for t in telegram_ids]
+        if ELIGIBILITY_VERIFIED_TTL <= 0 or not ids:
+            return set()
+        since = time.time() - ELIGIBILITY_VERIFIED_TTL
+        fresh = {tid for tid, (ok, at) in self._entries(ids).items() if ok and at >= since}
+        with self._lock:
+            self._stats['skipped_checks'] += len(fresh)
+        return fresh
+
+    # --- маски над снимком ---
+
+    def excluded_in(self, snapshot: DrawSnapshot) -> List[int]:
+        """Участники снимка из списка исключений"""
+        masked = [int(snapshot.ids[i]) for i in snapshot.positions(self._excluded)]
+        with self._lock:
+            self._stats['masked'] = len(masked)
+        return masked
+
+    def refused(self, snapshot: DrawSnapshot) -> List[int]:
+        """Владельцы билетов за подписку, чья последняя проверка — «не подписан» и не старше
+        ELIGIBILITY_UNSUBSCRIBED_TTL; при выключенном окне — никто"""
+        if ELIGIBILITY_UNSUBSCRIBED_TTL <= 0:
+            return []
+        holders = [int(snapshot.ids[i]) for i in range(len(snapshot)) if snapshot.subs[i] > 0]
+        since = time.time() - ELIGIBILITY_UNSUBSCRIBED_TTL
+        out = sorted(tid for tid, (ok, at) in self._entries(holders).items() if not ok and at >= since)
+        with self._lock:
+            self._stats['refusals_masked'] = len(out)
+        return out
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'excluded': len(self._excluded), 'local_states': len(self._local)}
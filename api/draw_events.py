@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+События розыгрыша (объявление мест, смена статуса) для живой трансляции.
+Событие публикует один процесс — тот, что провёл или сбросил розыгрыш, — в Redis-канал;
+каждый процесс воркера держит одну подписку и раздаёт события своим локальным
+подписчикам (SSE-клиентам в asgi.py). 10k зрителей — это по одной подписке на процесс,
+а не 10k опросов draw-status в секунду.
+Без Redis события доходят только до подписчиков процесса-публикатора.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from shared_cache import CACHE_PREFIX, RedisError, get_redis
+
+DRAW_EVENTS_CHANNEL = os.environ.get('DRAW_EVENTS_CHANNEL', f"{CACHE_PREFIX}:giveaway:events")
+
+Event = Dict[str, Any]
+
+
+class DrawEvents:
+    """publish(event) — разослать всем репликам; subscribe(callback) — получать события процесса.
+    callback вызывается из потока подписки и не должен блокироваться."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[int, Callable[[Event], None]] = {}
+        self._next_token = 0
+        self._started_pid: Optional[int] = None
+        self._stats = {'published': 0, 'received': 0, 'delivered': 0, 'publish_errors': 0}
+
+    def publish(self, event: Event) -> None:
+        event = {**event, 'ts': time.time()}
+        r = get_redis()
+        if r is not None:
+            try:
+                r.publish(DRAW_EVENTS_CHANNEL, json.dumps(event, ensure_ascii=False, default=str))
+                with self._lock:
+                    self._stats['published'] += 1
+                return
+            except RedisError as e:
+                print(f"⚠️ draw events: не удалось разослать событие: {e}")
+                with self._lock:
+                    self._stats['publish_errors'] += 1
+        # Без Redis (или при его сбое) — хотя бы подписчикам этого процесса
+        self._dispatch(event)
+
+    def subscribe(self, callback: Callable[[Event], None]) -> Callable[[], None]:
+        """Подписаться на события; возвращает функцию отписки"""
+        self.ensure_started()
+        with self._lock:
+            self._next_token += 1
+            token = self._next_token
+            self._subscribers[token] = callback
+
+        def unsubscribe() -> None:
+            with self._lock:
+                self._subscribers.pop(token, None)
+        return unsubscribe
+
+    def _dispatch(self, event: Event) -> None:
+        with self._lock:
+            callbacks = list(self._subscribers.values())
+            self._stats['received'] += 1
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"⚠️ draw events: подписчик упал: {e}")
+        with self._lock:
+            self._stats['delivered'] += len(callbacks)
+
+    def _listen(self) -> None:
+        while True:
+            r = get_redis()
+            if r is None:
+                return
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(DRAW_EVENTS_CHANNEL)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message or message.get('type') != 'message':
+                        continue
+                    try:
+                        event = json.loads(message.get('data'))
+                    except ValueError:
+                        continue
+                    if isinstance(event, dict):
+                        self._dispatch(event)
+            except (RedisError, OSError) as e:
+                print(f"⚠️ draw events: подписка прервана: {e}")
+                time.sleep(1)
+
+    def ensure_started(self) -> None:
+        """Одна подписка на Redis на процесс воркера"""
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        with self._lock:
+            if self._started_pid == pid:
+                return
+            self._started_pid = pid
+        if get_redis() is not None:
+            threading.Thread(target=self._listen, name='draw-events-listener', daemon=True).start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, 'subscribers': len(self._subscribers)}
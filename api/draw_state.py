@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Состояние розыгрышей (проведён / сколько победителей) — версионированные записи в Redis
+по giveaway_id с коротким кэшем в памяти процесса. Проведение розыгрыша и сброс меняют
+версию, поэтому опрос draw-status не ходит в Supabase вовсе.
+Результаты неизменны в пределах версии: они хранятся в ограниченном LRU процесса и в
+Redis под ключом версии, так что после первого чтения на любой реплике остальные
+отдают их без Supabase. Новый розыгрыш/сброс просто меняет версию.
+Если записи нет (первый запуск, Redis очищен), состояние восстанавливается одним
+HEAD-запросом с count=exact.
+Версия же даёт ETag для HTTP-кэша (браузер, micro-cache nginx).
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from shared_cache import CACHE_PREFIX, RedisError, get_redis
+
+# Сколько процесс верит своей копии состояния без обращения к Redis, сек
+DRAW_STATE_LOCAL_TTL = float(os.environ.get('DRAW_STATE_LOCAL_TTL', '2'))
+# Результаты скольких розыгрышей держит процесс и сколько живут результаты версии в Redis, сек
+DRAW_RESULTS_LOCAL_MAX = int(os.environ.get('DRAW_RESULTS_LOCAL_MAX', '64'))
+DRAW_RESULTS_TTL = int(os.environ.get('DRAW_RESULTS_TTL', str(30 * 24 * 3600)))
+
+
+class DrawState:
+    """count_winners(giveaway_id) -> число строк giveaway_winners (HEAD count=exact); исключения пробрасываются"""
+
+    def __init__(self, count_winners: Callable[[int], int]):
+        self._count_winners = count_winners
+        self._lock = threading.Lock()
+        self._local: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+        self._results: 'OrderedDict[int, Tuple[str, List[Dict[str, Any]]]]' = OrderedDict()
+        self._stats = {'local_hits': 0, 'redis_reads': 0, 'probes': 0,
+                       'results_local_hits': 0, 'results_redis_hits': 0, 'results_misses': 0}
+
+    def _key(self, giveaway_id: int) -> str:
+        return f"{CACHE_PREFIX}:giveaway:{int(giveaway_id)}:state"
+
+    def _remember(self, giveaway_id: int, state: Dict[str, Any]) -> None:
+        with self._lock:
+            self._local[giveaway_id] = (time.monotonic(), state)
+
+    def get(self, giveaway_id: int) -> Dict[str, Any]:
+        """{'completed', 'winners_count', 'version', 'updated_at'}"""
+        giveaway_id = int(giveaway_id)
+        with self._lock:
+            entry = self._local.get(giveaway_id)
+            if entry is not None and time.monotonic() - entry[0] < DRAW_STATE_LOCAL_TTL:
+                self._stats['local_hits'] += 1
+                return entry[1]
+        r = get_redis()
+        if r is not None:
+            try:
+                raw = r.get(self._key(giveaway_id))
+                with self._lock:
+                    self._stats['redis_reads'] += 1
+                if raw is not None:
+                    state = json.loads(raw)
+                    self._remember(giveaway_id, state)
+                    return state
+            except (RedisError, ValueError) as e:
+                print(f"⚠️ draw state: Redis недоступен: {e}")
+        return self._probe(giveaway_id)
+
+    def _probe(self, giveaway_id: int) -> Dict[str, Any]:
+        """Восстановить состояние по числу строк в giveaway_winners"""
+        with self._lock:
+            self._stats['probes'] += 1
+            previous = self._local.get(giveaway_id)
+        try:
+            count = int(self._count_winners(giveaway_id))
+        except Exception as e:
+            print(f"⚠️ draw state: не удалось проверить giveaway_winners: {e}")
+            if previous is not None:
+                return previous[1]
+            raise
+        state = {'completed': count > 0, 'winners_count': count, 'version': 0, 'updated_at': time.time()}
+        r = get_redis()
+        if r is not None:
+            try:
+                # NX: не затираем запись, которую успел сделать розыгрыш/сброс
+                if not r.set(self._key(giveaway_id), json.dumps(state), nx=True):
+                    raw = r.get(self._key(giveaway_id))
+                    if raw is not None:
+                        state = json.loads(raw)
+            except (RedisError, ValueError):
+                pass
+        self._remember(giveaway_id, state)
+        return state
+
+    def _publish(self, giveaway_id: int, completed: bool, winners_count: int) -> Dict[str, Any]:
+        giveaway_id = int(giveaway_id)
+        state = {'completed': completed, 'winners_count': winners_count, 'updated_at': time.time()}
+        r = get_redis()
+        version = None
+        if r is not None:
+            try:
+                version = int(r.incr(self._key(giveaway_id) + ':version'))
+                state['version'] = version
+                r.set(self._key(giveaway_id), json.dumps(state))
+            except RedisError as e:
+                print(f"⚠️ draw state: не удалось записать состояние в Redis: {e}")
+        if version is None:
+            with self._lock:
+                entry = self._local.get(giveaway_id)
+            state['version'] = (entry[1].get('version', 0) if entry else 0) + 1
+        self._remember(giveaway_id, state)
+        with self._lock:
+            self._results.pop(giveaway_id, None)
+        return state
+
+    def mark_completed(self, giveaway_id: int, winners: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Розыгрыш проведён: новая версия, результаты этой версии уже известны"""
+        state = self._publish(giveaway_id, True, len(winners))
+        self.put_results(giveaway_id, state, winners)
+        return state
+
+    def mark_cleared(self, giveaway_id: int) -> Dict[str, Any]:
+        return self._publish(giveaway_id, False, 0)
+
+    # --- результаты: неизменны в пределах версии ---
+
+    @staticmethod
+    def _tag(state: Dict[str, Any]) -> str:
+        # updated_at в теге: версия 0 (восстановленная HEAD-запросом) может повториться
+        return f"{state.get('version', 0)}:{int(float(state.get('updated_at', 0)) * 1000)}"
+
+    def etag(self, giveaway_id: int, state: Dict[str, Any], variant: str = 'results') -> str:
+        """Сильный ETag ответа с результатами: меняется только вместе с версией состояния"""
+        return f"giveaway-{int(giveaway_id)}-{variant}-{self._tag(state).replace(':', '-')}"
+
+    def _results_key(self, giveaway_id: int, state: Dict[str, Any]) -> str:
+        return f"{self._key(giveaway_id)}:results:{self._tag(state)}"
+
+    def _remember_results(self, giveaway_id: int, tag: str, rows: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._results[giveaway_id] = (tag, rows)
+            self._results.move_to_end(giveaway_id)
+            while len(self._results) > DRAW_RESULTS_LOCAL_MAX:
+                self._results.popitem(last=False)
+
+    def results(self, giveaway_id: int, state: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """Результаты версии state: LRU процесса -> Redis; None — ещё никто не читал их из БД"""
+        giveaway_id = int(giveaway_id)
+        tag = self._tag(state)
+        with self._lock:
+            entry = self._results.get(giveaway_id)
+            if entry is not None and entry[0] == tag:
+                self._results.move_to_end(giveaway_id)
+                self._stats['results_local_hits'] += 1
+                return entry[1]
+        r = get_redis()
+        if r is not None:
+            try:
+                raw = r.get(self._results_key(giveaway_id, state))
+                if raw is not None:
+                    rows = json.loads(raw)
+                    self._remember_results(giveaway_id, tag, rows)
+                    with self._lock:
+                        self._stats['results_redis_hits'] += 1
+                    return rows
+            except (RedisError, ValueError) as e:
+                print(f"⚠️ draw state: Redis недоступен для результатов: {e}")
+        with self._lock:
+            self._stats['results_misses'] += 1
+        return None
+
+    def put_results(self, giveaway_id: int, state: Dict[str, Any], rows: List[Dict[str, Any]]) -> None:
+        giveaway_id = int(giveaway_id)
+        self._remember_results(giveaway_id, self._tag(state), rows)
+        r = get_redis()
+        if r is not None:
+            try:
+                r.set(self._results_key(giveaway_id, state), json.dumps(rows, ensure_ascii=False, default=str),
+                      ex=DRAW_RESULTS_TTL)
+            except RedisError as e:
+                print(f"⚠️ draw state: не удалось сохранить результаты в Redis: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
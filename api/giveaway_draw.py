@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Розыгрыш: замороженный снимок участников и взвешенная выборка без возвращения.
+
+Снимок (DrawSnapshot) — отсортированные по telegram_id массивы int64
+(telegram_id, total_tickets, subscription_tickets) в одном файле с sha256 содержимого;
+файл открывается через mmap (numpy, если установлен, иначе memoryview).
+Дерево Фенвика над билетами строится из префиксных сумм за O(n): выбор и удаление
+победителя — O(log n), повторно выпавших ID нет.
+Семантика та же, что у прежнего линейного _weighted_choice: pick = randint(1, total),
+победитель — первый участник, у которого префиксная сумма билетов >= pick.
+Неподходящие участники (список исключений, неподписанные) маскируются до выборки:
+их вес в дереве обнулён, выбор идёт только из допущенных.
+Снимок + seed (+ маска и отклонённые при проверке подписок) полностью определяют результат:
+replay() повторяет розыгрыш бит в бит.
+"""
+
+import bisect
+import hashlib
+import mmap
+import os
+import random
+import secrets
+import struct
+import sys
+from array import array
+from itertools import accumulate
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy не установлен — массивы stdlib, та же точность и формат
+    np = None
+
+SNAPSHOT_MAGIC = b'GTMDRAW1'
+_HEADER = struct.Struct('<8sQ')  # magic, число участников
+
+
+class WeightedSampler:
+    """items — пары (telegram_id, билеты); участники с билетами <= 0 пропускаются.
+    seed/rng — детерминированный режим (тесты, воспроизведение розыгрыша)."""
+
+    def __init__(self, items: Iterable[Tuple[int, int]] = (), seed: Optional[int] = None,
+                 rng: Optional[random.Random] = None):
+        ids: List[int] = []
+        weights: List[int] = []
+        pos: Dict[int, int] = {}
+        for tid, weight in items:
+            weight = int(weight or 0)
+            if weight <= 0 or tid in pos:
+                continue
+            pos[tid] = len(ids)
+            ids.append(tid)
+            weights.append(weight)
+        self._setup(ids, weights, _fenwick_from_prefix(list(accumulate(weights, initial=0))), pos, seed, rng)
+
+    @classmethod
+    def from_arrays(cls, ids: Sequence[int], weights: Sequence[int], tree: List[int],
+                    seed: Optional[int] = None, rng: Optional[random.Random] = None,
+                    removed: Iterable[int] = ()) -> 'WeightedSampler':
+        """Без копирования: ids строго возрастают, все weights > 0 (так устроен DrawSnapshot).
+        removed — позиции, уже исключённые из выборки (их вес в tree обнулён)"""
+        sampler = cls.__new__(cls)
+        sampler._setup(ids, weights, tree, None, seed, rng, removed)
+        return sampler
+
+    def _setup(self, ids: Sequence[int], weights: Sequence[int], tree: List[int],
+               pos: Optional[Dict[int, int]], seed: Optional[int], rng: Optional[random.Random],
+               removed: Iterable[int] = ()) -> None:
+        self._rng = rng or (random.Random(seed) if seed is not None else random)
+        self._ids = ids
+        self._weights = weights
+        self._tree = tree
+        # pos=None — ids отсортированы, позиция ищется бинарным поиском
+        self._pos = pos
+        self._removed: set = set(removed)
+        n = len(ids)
+        self._top = 1 << max(0, n.bit_length() - 1) if n else 0
+        self.total = int(sum(tree[i] for i in _fenwick_roots(n)))
+        self._remaining = n - len(self._removed)
+
+    def __len__(self) -> int:
+        return self._remaining
+
+    def _index(self, tid: int) -> Optional[int]:
+        if self._pos is not None:
+            return self._pos.get(tid)
+        i = bisect.bisect_left(self._ids, tid)
+        return i if i < len(self._ids) and int(self._ids[i]) == tid else None
+
+    def __contains__(self, tid: int) -> bool:
+        i = self._index(tid)
+        return i is not None and i not in self._removed
+
+    def _find(self, pick: int) -> int:
+        """Индекс первого участника с префиксной суммой >= pick"""
+        pos = 0
+        step = self._top
+        n = len(self._ids)
+        tree = self._tree
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] < pick:
+                pos = nxt
+                pick -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def draw(self) -> Optional[int]:
+        """Случайный участник пропорционально билетам (без удаления); None — никого не осталось"""
+        if self.total <= 0:
+            return None
+        return int(self._ids[self._find(self._rng.randint(1, self.total))])
+
+    def remove(self, tid: int) -> bool:
+        """Исключить участника из дальнейших выборок"""
+        pos = self._index(tid)
+        if pos is None or pos in self._removed:
+            return False
+        weight = int(self._weights[pos])
+        self._removed.add(pos)
+        self.total -= weight
+        self._remaining -= 1
+        i = pos + 1
+        n = len(self._ids)
+        while i <= n:
+            self._tree[i] -= weight
+            i += i & -i
+        return True
+
+    def pop(self) -> Optional[int]:
+        """Выбрать победителя и сразу исключить его"""
+        tid = self.draw()
+        if tid is not None:
+            self.remove(tid)
+        return tid
+
+
+def _fenwick_from_prefix(prefix: Sequence[int]) -> List[int]:
+    """Дерево Фенвика (1-based, tree[0] = 0) из префиксных сумм: tree[i] = P[i] - P[i - lowbit(i)]"""
+    n = len(prefix) - 1
+    return [0] + [prefix[i] - prefix[i - (i & -i)] for i in range(1, n + 1)]
+
+
+def _fenwick_roots(n: int) -> List[int]:
+    """Узлы, покрывающие [1..n] без пересечений (их сумма — общий вес)"""
+    roots = []
+    i = n
+    while i > 0:
+        roots.append(i)
+        i -= i & -i
+    return roots
+
+
+class DrawSnapshot:
+    """Замороженные участники розыгрыша: ids (возрастают), tickets (> 0), subs"""
+
+    def __init__(self, ids: Sequence[int], tickets: Sequence[int], subs: Sequence[int], digest: Optional[str] = None):
+        self.ids = ids
+        self.tickets = tickets
+        self.subs = subs
+        self._digest = digest
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, tid: int) -> Tuple[int, int, int]:
+        """(telegram_id, total_tickets, subscription_tickets) участника снимка"""
+        i = bisect.bisect_left(self.ids, tid)
+        if i >= len(self.ids) or int(self.ids[i]) != tid:
+            raise KeyError(tid)
+        return tid, int(self.tickets[i]), int(self.subs[i])
+
+    def positions(self, tids: Iterable[int]) -> List[int]:
+        """Позиции участников снимка по возрастанию; отсутствующие в снимке пропускаются"""
+        out = set()
+        n = len(self.ids)
+        for tid in tids:
+            tid = int(tid)
+            i = bisect.bisect_left(self.ids, tid)
+            if i < n and int(self.ids[i]) == tid:
+                out.add(i)
+        return sorted(out)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[int, int, int]]) -> 'DrawSnapshot':
+        """rows — компактные кортежи (telegram_id, total_tickets, subscription_tickets)"""
+        merged: Dict[int, Tuple[int, int]] = {}
+        for tid, tickets, subs in rows:
+            if int(tickets or 0) > 0:
+                merged[int(tid)] = (int(tickets), int(subs or 0))
+        ids = array('q', sorted(merged))
+        return cls(ids, array('q', (merged[t][0] for t in ids)), array('q', (merged[t][1] for t in ids)))
+
+    # --- файл: заголовок + три столбца int64 little-endian ---
+
+    def to_bytes(self) -> bytes:
+        parts = [_HEADER.pack(SNAPSHOT_MAGIC, len(self.ids))]
+        for column in (self.ids, self.tickets, self.subs):
+            if np is not None and isinstance(column, np.ndarray):
+                parts.append(column.astype('<i8', copy=False).tobytes())
+            else:
+                a = array('q', column)
+                if sys.byteorder == 'big':
+                    a.byteswap()
+                parts.append(a.tobytes())
+        return b''.join(parts)
+
+    @property
+    def sha256(self) -> str:
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.to_bytes()).hexdigest()
+        return self._digest
+
+    def save(self, directory: str) -> str:
+        """Записать в directory/<sha256>.draw (атомарно); возвращает путь"""
+        os.makedirs(directory, exist_ok=True)
+        data = self.to_bytes()
+        self._digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(directory, f"{self._digest}.draw")
+        if not os.path.exists(path):
+            tmp = f"{path}.tmp{os.getpid()}"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load(cls, path: str, verify: bool = True) -> 'DrawSnapshot':
+        """Открыть снимок через mmap; verify — сверить sha256 с содержимым"""
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n = _HEADER.unpack_from(mm, 0)
+        if magic != SNAPSHOT_MAGIC or len(mm) != _HEADER.size + 24 * n:
+            raise ValueError(f"not a draw snapshot: {path}")
+        digest = hashlib.sha256(mm).hexdigest() if verify else None
+        if np is not None:
+            columns = np.frombuffer(mm, dtype='<i8', count=3 * n, offset=_HEADER.size).reshape(3, n)
+            ids, tickets, subs = columns[0], columns[1], columns[2]
+        else:
+            if sys.byteorder == 'big':
+                raise ValueError("memory-mapped snapshots need numpy on big-endian hosts")
+            view = memoryview(mm)[_HEADER.size:].cast('q')
+            ids, tickets, subs = view[:n], view[n:2 * n], view[2 * n:]
+        snapshot = cls(ids, tickets, subs, digest)
+        expected = os.path.basename(path).split('.', 1)[0]
+        if verify and len(expected) == 64 and expected != digest:
+            raise ValueError(f"snapshot hash mismatch: {path}")
+        return snapshot
+
+    def tree(self, masked: Sequence[int] = ()) -> List[int]:
+        """Дерево Фенвика по билетам из префиксных сумм (векторно при наличии numpy);
+        masked — позиции с обнулённым весом"""
+        n = len(self.ids)
+        if np is not None:
+            weights = np.asarray(self.tickets, dtype=np.int64)
+            if len(masked):
+                weights = weights.copy()
+                weights[np.asarray(masked, dtype=np.int64)] = 0
+            prefix = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(weights, out=prefix[1:])
+            idx = np.arange(1, n + 1, dtype=np.int64)
+            return [0] + (prefix[idx] - prefix[idx - (idx & -idx)]).tolist()
+        weights = self.tickets
+        if len(masked):
+            weights = array('q', weights)
+            for i in masked:
+                weights[i] = 0
+        return _fenwick_from_prefix(list(accumulate(weights, initial=0)))
+
+    def sampler(self, seed: int, masked: Sequence[int] = ()) -> WeightedSampler:
+        """Выборка по снимку; masked — позиции неподходящих участников (см. positions)"""
+        return WeightedSampler.from_arrays(self.ids, self.tickets, self.tree(masked), seed=seed, removed=masked)
+
+
+def new_seed() -> int:
+    return secrets.randbits(63)
+
+
+def draw_giveaway(snapshot: DrawSnapshot, seed: int, places: Sequence[int], first_tid: Optional[int] = None,
+                  draw_first: bool = False, verify: Optional[Callable[[List[int]], Dict[int, bool]]] = None,
+                  batch_factor: int = 1, max_attempts: int = 500, excluded: Iterable[int] = ()) -> Dict[str, Any]:
+    """Провести розыгрыш по снимку.
+    excluded — telegram_id неподходящих участников: выборка идёт только из веса остальных.
+    first_tid — заранее известный победитель 1 места (исключается из выборки);
+    draw_first — иначе разыграть 1 место без проверки; places — места, разыгрываемые с verify.
+    verify(batch) -> {telegram_id: прошёл ли проверку}; отсутствующие считаются прошедшими.
+    Кандидаты выбираются пакетами по batch_factor на свободное место, места — строго в порядке выборки,
+    поэтому результат не зависит от размера пакета. Возвращает протокол для replay().
+    """
+    masked = snapshot.positions(excluded)
+    sampler = snapshot.sampler(seed, masked)
+    first: Optional[int] = None
+    if first_tid is not None:
+        sampler.remove(int(first_tid))
+        first = int(first_tid)
+    elif draw_first:
+        first = sampler.pop()
+
+    open_places = list(places)
+    winners: List[Tuple[int, int]] = []
+    rejected: List[int] = []
+    attempts = 0
+    while open_places and attempts < max_attempts and len(sampler):
+        batch: List[int] = []
+        while len(batch) < len(open_places) * max(1, batch_factor) and attempts < max_attempts:
+            candidate = sampler.pop()
+            if candidate is None:
+                break
+            attempts += 1
+            batch.append(candidate)
+        if not batch:
+            break
+        verified = verify(batch) if verify else {}
+        for candidate in batch:
+            if not open_places:
+                break
+            if not verified.get(candidate, True):
+                rejected.append(candidate)
+                continue
+            winners.append((open_places.pop(0), candidate))
+
+    return {
+        'snapshot_sha256': snapshot.sha256,
+        'seed': seed,
+        'participants': len(snapshot),
+        'first_tid': first_tid,
+        'draw_first': draw_first,
+        'first': first,
+        'places': list(places),
+        'max_attempts': max_attempts,
+        'excluded': [int(snapshot.ids[i]) for i in masked],
+        'winners': winners,
+        'rejected': rejected,
+    }
+
+
+def replay(snapshot: DrawSnapshot, record: Dict[str, Any]) -> Dict[str, Any]:
+    """Повторить розыгрыш по протоколу draw_giveaway: те же seed и решения проверки подписок"""
+    if record.get('snapshot_sha256') not in (None, snapshot.sha256):
+        raise ValueError("snapshot does not match the draw record")
+    rejected = {int(t) for t in record.get('rejected') or []}
+    return draw_giveaway(
+        snapshot, int(record['seed']), record['places'], first_tid=record.get('first_tid'),
+        draw_first=bool(record.get('draw_first')), verify=lambda batch: {t: t not in rejected for t in batch},
+        max_attempts=int(record.get('max_attempts', 500)), excluded=record.get('excluded') or (),
+    )
+
+
+if __name__ == '__main__':
+    # Аудит: python giveaway_draw.py <протокол.json> [снимок.draw]
+    import json
+    with open(sys.argv[1], encoding='utf-8') as f:
+        draw_record = json.load(f)
+    snapshot_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(
+        os.path.dirname(os.path.abspath(sys.argv[1])), f"{draw_record['snapshot_sha256']}.draw")
+    result = replay(DrawSnapshot.load(snapshot_path), draw_record)
+    same = result['first'] == draw_record['first'] and [list(w) for w in result['winners']] == [list(w) for w in draw_record['winners']]
+    print(json.dumps({'match': same, 'first': result['first'], 'winners': result['winners']}, ensure_ascii=False))
+    sys.exit(0 if same else 1)
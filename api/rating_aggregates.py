@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Агрегаты рейтингов артистов в памяти процесса: count, sum и гистограмма 1..5.
+Прогреваются один раз из таблицы оценок, дальше обновляются инкрементально после
+каждого успешного add_artist_rating. Реплики обмениваются оценками через Redis
+pub/sub, периодическая сверка с RPC get_artist_rating перечитывает разошедшихся артистов.
+Пока агрегаты не прогреты, вызывающий код идёт в RPC как раньше.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from shared_cache import CACHE_PREFIX, RedisError, get_redis
+
+ARTIST_RATINGS_TABLE = os.environ.get('ARTIST_RATINGS_TABLE', 'artist_ratings')
+RATINGS_CHANNEL = os.environ.get('RATINGS_CHANNEL', f"{CACHE_PREFIX}:artist_ratings:events")
+# Период сверки с Supabase, сек (0 — отключить)
+RATING_RECONCILE_INTERVAL = float(os.environ.get('RATING_RECONCILE_INTERVAL', '300'))
+
+RatingRow = Tuple[str, str, int]  # (artist_name, user_id, rating)
+
+
+class ArtistAggregate:
+    __slots__ = ('count', 'total', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.histogram = [0, 0, 0, 0, 0]
+
+    def add(self, rating: int) -> None:
+        self.count += 1
+        self.total += rating
+        self.histogram[rating - 1] += 1
+
+    def remove(self, rating: int) -> None:
+        self.count -= 1
+        self.total -= rating
+        self.histogram[rating - 1] -= 1
+
+    def average(self) -> float:
+        return round(self.total / self.count, 2) if self.count else 0.0
+
+
+def _valid_rating(value: Any) -> Optional[int]:
+    try:
+        rating = int(value)
+    except (TypeError, ValueError):
+        return None
+    return rating if 1 <= rating <= 5 else None
+
+
+class RatingAggregates:
+    """load_all() — все оценки; load_artist(name) — оценки одного артиста;
+    remote_stats(name) — ответ RPC get_artist_rating (для сверки)"""
+
+    def __init__(self, load_all: Callable[[], Iterable[RatingRow]], load_artist: Callable[[str], Iterable[RatingRow]],
+                 remote_stats: Callable[[str], Optional[Dict[str, Any]]]):
+        self._load_all = load_all
+        self._load_artist = load_artist
+        self._remote_stats = remote_stats
+        self._lock = threading.RLock()
+        self._aggs: Dict[str, ArtistAggregate] = {}
+        # Последняя оценка пользователя: повторная оценка заменяет прежнюю
+        self._by_user: Dict[str, Dict[str, int]] = {}
+        self._origin = uuid.uuid4().hex
+        self._started_pid: Optional[int] = None
+        self.ready = False
+        self.version = 0
+        self._listeners: List[Callable[[str, int, float], None]] = []
+        self._stats = {'applied_local': 0, 'applied_remote': 0, 'reconciled_artists': 0, 'last_warm_ms': 0}
+
+    # --- состояние ---
+
+    def _build(self, rows: Iterable[RatingRow]) -> Tuple[Dict[str, ArtistAggregate], Dict[str, Dict[str, int]]]:
+        aggs: Dict[str, ArtistAggregate] = {}
+        by_user: Dict[str, Dict[str, int]] = {}
+        for artist, user_id, value in rows:
+            rating = _valid_rating(value)
+            if not artist or rating is None:
+                continue
+            users = by_user.setdefault(artist, {})
+            agg = aggs.setdefault(artist, ArtistAggregate())
+            old = users.get(user_id)
+            if old is not None:
+                agg.remove(old)
+            users[user_id] = rating
+            agg.add(rating)
+        return aggs, by_user
+
+    def _changed(self, artists: Iterable[str]) -> None:
+        self.version += 1
+        for artist in artists:
+            agg = self._aggs.get(artist) or ArtistAggregate()
+            for listener in self._listeners:
+                try:
+                    listener(artist, agg.count, agg.average())
+                except Exception as e:
+                    print(f"⚠️ rating aggregates: listener failed: {e}")
+
+    def on_change(self, listener: Callable[[str, int, float], None]) -> None:
+        """Подписаться на изменения агрегата: listener(artist, count, average) вызывается под замком агрегатов"""
+        self._listeners.append(listener)
+
+    def warm(self) -> None:
+        started = time.monotonic()
+        aggs, by_user = self._build(self._load_all())
+        with self._lock:
+            # Исчезнувшие артисты тоже уведомляются — с нулевым count
+            touched = set(self._aggs) | set(aggs)
+            self._aggs = aggs
+            self._by_user = by_user
+            self.ready = True
+            self._stats['last_warm_ms'] = int((time.monotonic() - started) * 1000)
+            self._changed(touched)
+        print(f"⭐ Агрегаты рейтингов прогреты: {len(aggs)} артистов за {self._stats['last_warm_ms']} мс")
+
+    def reload_artist(self, artist: str) -> None:
+        aggs, by_user = self._build(self._load_artist(artist))
+        with self._lock:
+            self._aggs[artist] = aggs.get(artist, ArtistAggregate())
+            self._by_user[artist] = by_user.get(artist, {})
+            self._changed([artist])
+
+    def _apply_locked(self, artist: str, user_id: str, value: Any) -> Optional[RatingRow]:
+        rating = _valid_rating(value)
+        if not artist or rating is None:
+            return None
+        user_id = str(user_id)
+        users = self._by_user.setdefault(artist, {})
+        agg = self._aggs.setdefault(artist, ArtistAggregate())
+        old = users.get(user_id)
+        if old is not None:
+            agg.remove(old)
+        users[user_id] = rating
+        agg.add(rating)
+        return artist, user_id, rating
+
+    def apply(self, artist: str, user_id: str, rating: int, publish: bool = True) -> None:
+        """Учесть успешно сохранённую оценку (и разослать её другим репликам)"""
+        self.apply_many([(artist, user_id, rating)], publish=publish)
+
+    def apply_many(self, rows: Iterable[RatingRow], publish: bool = True) -> None:
+        applied: List[RatingRow] = []
+        with self._lock:
+            for artist, user_id, rating in rows:
+                row = self._apply_locked(artist, user_id, rating)
+                if row is not None:
+                    applied.append(row)
+            if not applied:
+                return
+            self._stats['applied_local' if publish else 'applied_remote'] += len(applied)
+            self._changed({artist for artist, _, _ in applied})
+        if publish:
+            self._publish(applied)
+
+    def _revert_locked(self, artist: str, user_id: str, rejected: int, stored: Optional[int]) -> bool:
+        users = self._by_user.get(artist) or {}
+        if users.get(user_id) != rejected:
+            return False  # с тех пор пришла другая оценка — она и остаётся
+        agg = self._aggs.setdefault(artist, ArtistAggregate())
+        agg.remove(rejected)
+        if stored is None:
+            del users[user_id]
+        else:
+            users[user_id] = stored
+            agg.add(stored)
+        return True
+
+    def revert_many(self, rows: Iterable[RatingRow]) -> None:
+        """Откатить оптимистично учтённые оценки, которые база отклонила: у пользователя
+        восстанавливается оценка из таблицы (или никакой). Откат рассылается другим репликам."""
+        rows = [(a, str(u), r) for a, u, r in rows if a and _valid_rating(r) is not None]
+        stored: Dict[str, Dict[str, int]] = {}
+        for artist in {a for a, _, _ in rows}:
+            stored[artist] = self._build(self._load_artist(artist))[1].get(artist, {})
+        reverts = [(a, u, int(r), stored[a].get(u)) for a, u, r in rows]
+        self._apply_reverts(reverts)
+        self._publish_event({'reverts': reverts})
+
+    def _apply_reverts(self, reverts: Iterable[Tuple[str, str, int, Optional[int]]]) -> None:
+        with self._lock:
+            touched = {artist for artist, user_id, rejected, stored in reverts
+                       if self._revert_locked(artist, user_id, rejected, stored)}
+            if touched:
+                self._changed(touched)
+
+    def stats(self, artist: str) -> Optional[Dict[str, Any]]:
+        """Статистика артиста в формате get_artist_rating или None, если агрегаты ещё не прогреты"""
+        if not self.ready:
+            return None
+        with self._lock:
+            agg = self._aggs.get(artist) or ArtistAggregate()
+            return {
+                'artist_name': artist,
+                'average_rating': agg.average(),
+                'total_ratings': agg.count,
+                'rating_distribution': {str(i + 1): n for i, n in enumerate(agg.histogram)},
+            }
+
+    def snapshot(self) -> Dict[str, Tuple[int, int, List[int]]]:
+        """Копия агрегатов: artist -> (count, sum, histogram)"""
+        with self._lock:
+            return {a: (g.count, g.total, list(g.histogram)) for a, g in self._aggs.items()}
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._stats, 'ready': self.ready, 'artists': len(self._aggs), 'version': self.version}
+
+    # --- обмен между репликами ---
+
+    def _publish(self, rows: List[RatingRow]) -> None:
+        if rows:
+            self._publish_event({'ratings': rows})
+
+    def _publish_event(self, event: Dict[str, Any]) -> None:
+        r = get_redis()
+        if r is None:
+            return
+        try:
+            r.publish(RATINGS_CHANNEL, json.dumps({'origin': self._origin, **event}, ensure_ascii=False))
+        except RedisError as e:
+            print(f"⚠️ rating aggregates: не удалось разослать оценку: {e}")
+
+    def _listen(self) -> None:
+        while True:
+            r = get_redis()
+            if r is None:
+                return
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(RATINGS_CHANNEL)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message or message.get('type') != 'message':
+                        continue
+                    try:
+                        event = json.loads(message.get('data'))
+                    except ValueError:
+                        continue
+                    if event.get('origin') == self._origin:
+                        continue
+                    self.apply_many((tuple(row) for row in event.get('ratings') or [] if len(row) == 3), publish=False)
+                    self._apply_reverts(tuple(row) for row in event.get('reverts') or [] if len(row) == 4)
+            except (RedisError, OSError) as e:
+                print(f"⚠️ rating aggregates: подписка прервана: {e}")
+                time.sleep(1)
+
+    # --- сверка с Supabase ---
+
+    def reconcile(self) -> int:
+        """Сверить каждого артиста с RPC; разошедшихся перечитать из таблицы. Возвращает их число"""
+        drifted = 0
+        for artist, (count, total, _) in self.snapshot().items():
+            try:
+                remote = self._remote_stats(artist) or {}
+                remote_count = int(remote.get('total_ratings', 0) or 0)
+                remote_avg = float(remote.get('average_rating', 0) or 0)
+            except Exception:
+                continue
+            local_avg = round(total / count, 2) if count else 0.0
+            if remote_count != count or abs(remote_avg - local_avg) > 0.011:
+                drifted += 1
+                try:
+                    self.reload_artist(artist)
+                except Exception as e:
+                    print(f"⚠️ rating aggregates: не удалось перечитать {artist}: {e}")
+        with self._lock:
+            self._stats['reconciled_artists'] += drifted
+        if drifted:
+            print(f"🔁 Сверка рейтингов: перечитано артистов {drifted}")
+        return drifted
+
+    def _run(self) -> None:
+        while not self.ready:
+            try:
+                self.warm()
+            except Exception as e:
+                print(f"⚠️ rating aggregates: прогрев не удался, повтор через 30с: {e}")
+                time.sleep(30)
+        if RATING_RECONCILE_INTERVAL <= 0:
+            return
+        while True:
+            time.sleep(RATING_RECONCILE_INTERVAL)
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"⚠️ rating aggregates: сверка не удалась: {e}")
+
+    def ensure_started(self) -> None:
+        """Прогрев, подписка и сверка — фоновые потоки, по одному набору на процесс воркера"""
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        with self._lock:
+            if self._started_pid == pid:
+                return
+            self._started_pid = pid
+        threading.Thread(target=self._run, name='rating-aggregates', daemon=True).start()
+        if get_redis() is not None:
+            threading.Thread(target=self._listen, name='rating-aggregates-listener', daemon=True).start()
+
+
+class LeaderboardIndex:
+    """Отсортированные списки артистов (по среднему и по числу оценок) поверх RatingAggregates.
+    Изменение одного артиста переставляет только его (bisect), без пересортировки каталога.
+    Полный отсортированный список кэшируется по версии индекса (по одному на sort) вместе с ETag;
+    limit — срез этого списка, так что кэш не растёт от разных значений limit.
+    """
+
+    SORTS = ('average', 'count')
+
+    def __init__(self, aggregates: RatingAggregates):
+        self._aggregates = aggregates
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[int, float]] = {}
+        self._orders: Dict[str, List[Tuple[Any, ...]]] = {sort: [] for sort in self.SORTS}
+        self.version = 0
+        self._rendered: Dict[str, Tuple[int, List[Dict[str, Any]], str]] = {}
+        aggregates.on_change(self._update)
+
+    @staticmethod
+    def _sort_key(sort: str, artist: str, count: int, average: float) -> Tuple[Any, ...]:
+        if sort == 'average':
+            return -average, -count, artist
+        return -count, -average, artist
+
+    def _update(self, artist: str, count: int, average: float) -> None:
+        with self._lock:
+            old = self._entries.pop(artist, None)
+            for sort, order in self._orders.items():
+                if old is not None:
+                    i = bisect.bisect_left(order, self._sort_key(sort, artist, *old))
+                    if i < len(order) and order[i][-1] == artist:
+                        del order[i]
+                if count > 0:
+                    bisect.insort(order, self._sort_key(sort, artist, count, average))
+            if count > 0:
+                self._entries[artist] = (count, average)
+            self.version += 1
+            self._rendered.clear()
+
+    def render(self, sort: str = 'average', limit: Optional[int] = None) -> Optional[Tuple[Dict[str, Any], str]]:
+        """(тело ответа, ETag) или None, пока агрегаты не прогреты"""
+        if not self._aggregates.ready:
+            return None
+        with self._lock:
+            cached = self._rendered.get(sort)
+            if cached is None or cached[0] != self.version:
+                artists = []
+                for key in self._orders[sort]:
+                    artist = key[-1]
+                    count, average = self._entries[artist]
+                    artists.append({'artist_name': artist, 'average_rating': average, 'total_ratings': count})
+                # ETag по содержимому: у реплик одинаковые данные дают одинаковый ETag
+                etag = hashlib.sha1(json.dumps({'sort': sort, 'artists': artists}, sort_keys=True,
+                                               ensure_ascii=False).encode('utf-8')).hexdigest()
+                cached = self._rendered[sort] = (self.version, artists, etag)
+        _, artists, etag = cached
+        # limit больше каталога — это весь список (и тот же ETag)
+        if limit is not None and limit < len(artists):
+            artists = artists[:limit]
+            etag = f"{etag}-{limit}"
+        return {'sort': sort, 'total_artists': len(cached[1]), 'artists': artists}, etag
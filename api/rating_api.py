@@ -11,8 +11,34 @@ from flask_cors import CORS
 import requests
 import json
 import os
-import random
-from typing import List, Dict, Any, Optional
+import sys
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Iterator, Iterable, Tuple, Union
+
+from supabase_http import SupabaseHTTP, get_supabase
+from shared_cache import RedisError, SharedTTLCache, get_redis
+from user_stats_cache import STATS_COLUMNS, UserStatsCache
+from singleflight import SingleFlight
+from draw_eligibility import EligibilityIndex
+from draw_events import DrawEvents
+from draw_state import DrawState
+from giveaway_draw import DrawSnapshot, draw_giveaway, new_seed
+from rating_aggregates import ARTIST_RATINGS_TABLE, LeaderboardIndex, RatingAggregates
+from rating_writer import BufferFull, RatingWriter, RetryLater, write_ratings
+
+try:
+    from shared.tg_membership import (
+        MODE_ALL, MembershipCache, MembershipChecker, MembershipLedger, get_subscription_channels,
+        subscription_verdict,
+    )
+    from shared.tg_ratelimit import TelegramRateLimiter
+except ImportError:  # запуск из исходников: shared/ лежит в корне репозитория
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from shared.tg_membership import (
+        MODE_ALL, MembershipCache, MembershipChecker, MembershipLedger, get_subscription_channels,
+        subscription_verdict,
+    )
+    from shared.tg_ratelimit import TelegramRateLimiter
 
 app = Flask(__name__)
 CORS(app)
@@ -22,6 +48,16 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL", "https://rxmtovqxjsvogyywyrha.supa
 SUPABASE_ANON_KEY = os.environ.get("SUPABASE_ANON_KEY", "")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
 
+# Размер страницы при обходе таблицы users (keyset-пагинация по telegram_id)
+USER_SCAN_PAGE_SIZE = int(os.environ.get('USER_SCAN_PAGE_SIZE', '1000'))
+# Компактный режим обхода: только (telegram_id, total_tickets, subscription_tickets)
+COMPACT_USER_COLUMNS = 'telegram_id,total_tickets,subscription_tickets'
+
+# Кэш /api/giveaway/total_all (общий для реплик через Redis): свежесть и окно stale-while-revalidate, сек
+TOTAL_ALL_CACHE_TTL = float(os.environ.get('TOTAL_ALL_CACHE_TTL', '5'))
+TOTAL_ALL_CACHE_STALE = float(os.environ.get('TOTAL_ALL_CACHE_STALE', '60'))
+_total_all_cache = SharedTTLCache('total_all', ttl=TOTAL_ALL_CACHE_TTL, stale_ttl=TOTAL_ALL_CACHE_STALE)
+
 # Telegram Bot
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 
@@ -31,86 +67,187 @@ supabase_headers = {
     'Content-Type': 'application/json'
 }
 
-SUBSCRIPTION_CHANNELS = [
-    { 'channel_id': -1002088959587, 'channel_username': 'rejmenyavseryoz', 'channel_name': 'Режь меня всерьёз' },
-    { 'channel_id': -1001971855072, 'channel_username': 'chchndra_tattoo', 'channel_name': 'Чучундра' },
-    { 'channel_id': -1002133674248, 'channel_username': 'naidenka_tattoo', 'channel_name': 'naidenka_tattoo' },
-    { 'channel_id': -1001508215942, 'channel_username': 'l1n_ttt', 'channel_name': 'Lin++' },
-    { 'channel_id': -1001555462429, 'channel_username': 'murderd0lll', 'channel_name': 'MurderdOll' },
-    { 'channel_id': -1002132954014, 'channel_username': 'poteryashkatattoo', 'channel_name': 'Потеряшка' },
-    { 'channel_id': -1001689395571, 'channel_username': 'EMI3MO', 'channel_name': 'EMI' },
-    { 'channel_id': -1001767997947, 'channel_username': 'bloodivamp', 'channel_name': 'bloodivamp' },
-    { 'channel_id': -1001973736826, 'channel_username': 'G_T_MODEL', 'channel_name': "Gothams top model" },
-]
+# Каналы для проверки подписки (общий список; переопределяется SUBSCRIPTION_CHANNELS_JSON)
+SUBSCRIPTION_CHANNELS = get_subscription_channels()
 
 # === Helpers ===
+def _supabase() -> SupabaseHTTP:
+    """Пул keep-alive соединений к Supabase текущего воркера"""
+    return get_supabase(SUPABASE_URL, supabase_headers)
+
 def _get_supabase_rows(endpoint: str, select: Optional[str] = None, params: Optional[Dict[str, Any]] = None) -> Any:
     q = params.copy() if params else {}
     if select:
         q['select'] = select
-    resp = requests.get(f"{SUPABASE_URL}/rest/v1/{endpoint}", headers=supabase_headers, params=q, timeout=20)
+    resp = _supabase().get(endpoint, params=q, timeout=20)
     if resp.status_code in (200, 206):
         return resp.json() if resp.content else []
     raise RuntimeError(f"supabase get {endpoint} {resp.status_code}: {resp.text}")
 
+# Одинаковые одновременные запросы к Supabase на горячих эндпоинтах ждут один общий ответ
+_supabase_flight = SingleFlight('supabase')
+
+def _get_supabase_rows_coalesced(endpoint: str, select: Optional[str] = None, params: Optional[Dict[str, Any]] = None) -> Any:
+    """_get_supabase_rows через single-flight (ключ — сам апстрим-запрос). Результат общий: не мутировать"""
+    key = f"{endpoint}?{json.dumps({'select': select, **(params or {})}, sort_keys=True)}"
+    return _supabase_flight.do(key, lambda: _get_supabase_rows(endpoint, select=select, params=params))
+
 def _insert_supabase_rows(endpoint: str, rows: List[Dict[str, Any]], prefer: str = 'return=representation') -> Any:
-    headers = {**supabase_headers, 'Prefer': prefer}
-    resp = requests.post(f"{SUPABASE_URL}/rest/v1/{endpoint}", headers=headers, json=rows, timeout=30)
+    resp = _supabase().post(endpoint, headers={'Prefer': prefer}, json=rows, timeout=30)
     if resp.status_code in (200, 201):
         return resp.json() if resp.content else []
     raise RuntimeError(f"supabase insert {endpoint} {resp.status_code}: {resp.text}")
 
-def _get_user_map_by_telegram_id() -> Dict[int, Dict[str, Any]]:
-    rows = _get_supabase_rows('users', select='telegram_id,username,first_name,subscription_tickets,referral_tickets,total_tickets')
+def _iter_users(select: str = COMPACT_USER_COLUMNS, params: Optional[Dict[str, Any]] = None,
+                page_size: Optional[int] = None, compact: bool = False) -> Iterator[Union[Dict[str, Any], Tuple[int, int, int]]]:
+    """Потоковый обход users страницами по telegram_id > last_seen (keyset, без OFFSET).
+    compact=True отдаёт кортежи (telegram_id, total_tickets, subscription_tickets) вместо dict строк.
+    Фильтр по telegram_id в params перезаписывается курсором.
+    """
+    size = max(1, page_size or USER_SCAN_PAGE_SIZE)
+    columns = COMPACT_USER_COLUMNS if compact else select
+    if 'telegram_id' not in columns.split(','):
+        columns = f"telegram_id,{columns}"
+    last_seen: Optional[int] = None
+    while True:
+        q = dict(params or {})
+        q['order'] = 'telegram_id.asc'
+        q['limit'] = str(size)
+        if last_seen is not None:
+            q['telegram_id'] = f'gt.{last_seen}'
+        rows = _get_supabase_rows('users', select=columns, params=q)
+        # Заканчиваем только на пустой странице: PostgREST max-rows может урезать limit
+        if not rows:
+            return
+        page_last: Optional[int] = None
+        for r in rows:
+            try:
+                tid = int(r.get('telegram_id'))
+            except Exception:
+                continue
+            page_last = tid
+            if compact:
+                yield (tid, int(r.get('total_tickets', 0) or 0), int(r.get('subscription_tickets', 0) or 0))
+            else:
+                yield {**r, 'telegram_id': tid}
+        if page_last is None:
+            return
+        last_seen = page_last
+
+def _get_users_by_ids(telegram_ids: Iterable[int], select: str = 'telegram_id,username,first_name,last_name,total_tickets') -> Dict[int, Dict[str, Any]]:
+    """Профили конкретных пользователей одним запросом (in.(...))"""
+    ids = sorted({int(t) for t in telegram_ids})
+    if not ids:
+        return {}
+    rows = _get_supabase_rows('users', select=select, params={'telegram_id': f"in.({','.join(str(t) for t in ids)})"})
     out: Dict[int, Dict[str, Any]] = {}
-    for r in rows:
+    for r in rows or []:
         try:
-            tid = int(r.get('telegram_id'))
+            out[int(r.get('telegram_id'))] = r
         except Exception:
             continue
-        out[tid] = r
     return out
 
-def _is_user_subscribed_to_all_now(telegram_id: int) -> bool:
+def _get_user_map_by_telegram_id() -> Dict[int, Dict[str, Any]]:
+    out: Dict[int, Dict[str, Any]] = {}
+    for r in _iter_users(select='telegram_id,username,first_name,subscription_tickets,referral_tickets,total_tickets'):
+        out[r['telegram_id']] = r
+    return out
+
+# Параллельная проверка подписок кандидатов розыгрыша: сначала реестр подписок, который бот ведёт
+# по апдейтам chat_member, затем кэш ответов Telegram по парам (пользователь, канал) в Redis
+# (общий с ботом и referrals); getChatMember — через общий пул и сессию на процесс воркера
+# и общий для всех сервисов лимитер Telegram Bot API
+SUBSCRIPTION_CHECK_WORKERS = int(os.environ.get('SUBSCRIPTION_CHECK_WORKERS', '16'))
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.environ.get('SUBSCRIPTION_CHECK_TIMEOUT', '15'))
+_membership = MembershipChecker(TELEGRAM_BOT_TOKEN, SUBSCRIPTION_CHANNELS,
+                                workers=SUBSCRIPTION_CHECK_WORKERS, timeout=SUBSCRIPTION_CHECK_TIMEOUT,
+                                cache=MembershipCache(get_redis), ledger=MembershipLedger(get_redis),
+                                limiter=TelegramRateLimiter(get_redis))
+
+def _verify_subscriptions(telegram_ids: Iterable[int], force_fresh: bool = False) -> Dict[int, bool]:
+    """Подписан ли каждый пользователь на все каналы. Все пары (пользователь, канал) без свежего
+    ответа в кэше идут в общий пул параллельно; на первом канале без подписки оставшиеся проверки
+    пользователя снимаются. force_fresh — не верить ни реестру, ни кэшу (розыгрыш).
+    Нерешённая проверка (ошибка Telegram) даёт False для этого вызова, но в индекс не пишется.
+    """
+    ids = list(dict.fromkeys(int(t) for t in telegram_ids))
     if not TELEGRAM_BOT_TOKEN:
-        return False
+        return {tid: False for tid in ids}
+    verdicts = {tid: subscription_verdict(r) for tid, r in _membership.check_many(ids, MODE_ALL, force_fresh).items()}
+    # В индекс допуска — только решённые проверки: ошибка Telegram не делает пользователя «неподписанным»
+    _eligibility.record({tid: ok for tid, ok in verdicts.items() if ok is not None})
+    return {tid: bool(ok) for tid, ok in verdicts.items()}
+
+# Организаторы розыгрыша (мастера тату и админы) не могут выиграть; GIVEAWAY_EXCLUDED_IDS — список через запятую
+_DEFAULT_EXCLUDED_IDS = (
+    7364321578,  # @bloodivampin
+    896659949,   # @Murderdollll
+    1472489964,  # @ufantasiesss
+    670676502,   # @chchna
+    732970924,   # @naidenka_tatto0
+    794865003,   # @g9r1a
+    420639535,   # @punk2_n0t_d34d
+    6931629845,  # @GTM_AD
+    907218861,   # +907218861
+)
+
+def _parse_excluded_ids(raw: str) -> List[int]:
+    ids = []
+    for part in raw.replace(';', ',').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            ids.append(int(part))
+        except ValueError:
+            print(f"⚠️ GIVEAWAY_EXCLUDED_IDS: пропущено некорректное значение {part!r}")
+    return ids
+
+GIVEAWAY_EXCLUDED_IDS = os.environ.get('GIVEAWAY_EXCLUDED_IDS')
+# Индекс допуска: исключения + последние проверки подписок; розыгрыш выбирает только из допущенных
+_eligibility = EligibilityIndex(
+    _parse_excluded_ids(GIVEAWAY_EXCLUDED_IDS) if GIVEAWAY_EXCLUDED_IDS is not None else _DEFAULT_EXCLUDED_IDS)
+
+# Фиксированный seed розыгрыша (только для тестов/воспроизведения; в проде пусто)
+GIVEAWAY_DRAW_SEED = os.environ.get('GIVEAWAY_DRAW_SEED', '')
+
+# Снимки участников и протоколы розыгрышей (для повтора и аудита: python giveaway_draw.py <протокол>)
+DRAW_SNAPSHOT_DIR = os.environ.get('DRAW_SNAPSHOT_DIR', '/app/draw_snapshots')
+# Таблица Supabase для протоколов розыгрышей (пусто — только файлы)
+GIVEAWAY_DRAWS_TABLE = os.environ.get('GIVEAWAY_DRAWS_TABLE', '')
+
+def _freeze_draw(users: Iterable[Tuple[int, int, int]]) -> Tuple[DrawSnapshot, int]:
+    """Заморозить участников (компактные кортежи _iter_users) и выбрать seed розыгрыша"""
+    snapshot = DrawSnapshot.from_rows(users)
     try:
-        for ch in SUBSCRIPTION_CHANNELS:
-            url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getChatMember"
-            r = requests.get(url, params={'chat_id': ch['channel_id'], 'user_id': telegram_id}, timeout=15)
-            if r.status_code != 200:
-                return False
-            st = (r.json() or {}).get('result', {}).get('status')
-            if st not in ('member', 'administrator', 'creator'):
-                return False
-        return True
-    except Exception:
-        return False
+        snapshot.save(DRAW_SNAPSHOT_DIR)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить снимок розыгрыша: {e}")
+    seed = int(GIVEAWAY_DRAW_SEED) if GIVEAWAY_DRAW_SEED else new_seed()
+    print(f"🧊 Снимок розыгрыша: {len(snapshot)} участников, sha256={snapshot.sha256[:12]}, seed={seed}")
+    return snapshot, seed
 
-def _weighted_choice(candidates: List[Dict[str, Any]]) -> Optional[int]:
-    total = 0
-    weights: List[int] = []
-    ids: List[int] = []
-    for c in candidates:
+def _record_draw(giveaway_id: int, record: Dict[str, Any]) -> None:
+    """Сохранить протокол розыгрыша рядом со снимком (и в GIVEAWAY_DRAWS_TABLE, если задана)"""
+    record = {**record, 'giveaway_id': giveaway_id, 'drawn_at': datetime.now(timezone.utc).isoformat()}
+    try:
+        os.makedirs(DRAW_SNAPSHOT_DIR, exist_ok=True)
+        path = os.path.join(DRAW_SNAPSHOT_DIR, f"giveaway_{giveaway_id}_{record['seed']}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить протокол розыгрыша: {e}")
+    if GIVEAWAY_DRAWS_TABLE:
         try:
-            tid = int(c.get('telegram_id'))
-        except Exception:
-            continue
-        w = int(c.get('total_tickets', 0) or 0)
-        if w <= 0:
-            continue
-        ids.append(tid)
-        weights.append(w)
-        total += w
-    if total <= 0 or not ids:
-        return None
-    pick = random.randint(1, total)
-    acc = 0
-    for idx, w in enumerate(weights):
-        acc += w
-        if pick <= acc:
-            return ids[idx]
-    return ids[-1]
+            _insert_supabase_rows(GIVEAWAY_DRAWS_TABLE, [{
+                'giveaway_id': giveaway_id,
+                'snapshot_sha256': record['snapshot_sha256'],
+                'seed': str(record['seed']),
+                'record': record,
+            }], prefer='return=minimal')
+        except Exception as e:
+            print(f"⚠️ Не удалось записать протокол розыгрыша в {GIVEAWAY_DRAWS_TABLE}: {e}")
 
 def _build_prize(place_number: int) -> Dict[str, str]:
     if place_number == 1:
@@ -119,96 +256,75 @@ def _build_prize(place_number: int) -> Dict[str, str]:
         return {'prize_name': 'Бьюти услуга на выбор', 'prize_value': 'Приз можно заменить на Telegram Premium'}
     return {'prize_name': 'Футболка', 'prize_value': 'Футболка GTM'}
 
-def _draw_giveaway_winners() -> List[Dict[str, Any]]:
+def _draw_giveaway_winners(giveaway_id: int = 1) -> List[Dict[str, Any]]:
     """Провести розыгрыш победителей из базы данных"""
     try:
-        # Получаем всех пользователей с билетами
-        users = _get_supabase_rows('users', 
-                                 select='telegram_id,username,first_name,last_name,total_tickets',
-                                 params={'total_tickets': 'gt.0'})
+        # Получаем всех пользователей с билетами (компактно, постранично)
+        users = list(_iter_users(params={'total_tickets': 'gt.0'}, compact=True))
         
         if not users:
             return []
         
-        # Исключаем организаторов розыгрыша (мастеров тату)
-        organizers_telegram_ids = {
-            7364321578,  # @bloodivampin
-            896659949,   # @Murderdollll
-            1472489964,  # @ufantasiesss
-            670676502,   # @chchna
-            732970924,   # @naidenka_tatto0
-            794865003,   # @g9r1a
-            420639535,   # @punk2_n0t_d34d
-            6931629845,  # @GTM_AD (организатор, не может выиграть)
-            907218861,   # +907218861 (организатор, не может выиграть)
-        }
-        
-        # Фильтруем пользователей, исключая организаторов
-        eligible_users = [u for u in users if u.get('telegram_id') not in organizers_telegram_ids]
+        winners = []
+        snapshot, seed = _freeze_draw(users)
+        del users
         
-        if not eligible_users:
+        # Организаторы маскируются в снимке (подписки этот путь, как и раньше, не проверяет)
+        excluded = _eligibility.excluded_in(snapshot)
+        if len(excluded) >= len(snapshot):
             print("❌ Нет подходящих участников после исключения организаторов")
             return []
         
-        print(f"🎯 Исключено организаторов: {len(organizers_telegram_ids)}")
-        print(f"🎲 Доступно участников: {len(eligible_users)}")
-        
-        winners = []
-        used_telegram_ids = set()
+        print(f"🎯 Исключено из выборки: {len(excluded)}")
+        print(f"🎲 Доступно участников: {len(snapshot) - len(excluded)}")
         
         # 1 место: получаем предопределенного победителя из API
         first_place_winner = _get_first_place_winner()
         if first_place_winner:
             # Проверяем, что предопределенный победитель не является организатором
-            if first_place_winner['winner_telegram_id'] in organizers_telegram_ids:
+            if _eligibility.is_excluded(first_place_winner['winner_telegram_id']):
                 print("❌ Предопределенный победитель является организатором! Исключаем...")
                 first_place_winner = None
             else:
+                first_place_winner['giveaway_id'] = giveaway_id
                 winners.append(first_place_winner)
-                used_telegram_ids.add(first_place_winner['winner_telegram_id'])
         
-        # Розыгрыш мест 2-6
-        for place in range(2, 7):
-            # Фильтруем пользователей, которые еще не выиграли
-            available_users = [u for u in eligible_users if u.get('telegram_id') not in used_telegram_ids]
+        # Розыгрыш мест 2-6 по снимку с учетом количества билетов; выбывший больше не участвует
+        record = draw_giveaway(
+            snapshot, seed, places=range(2, 7),
+            first_tid=first_place_winner['winner_telegram_id'] if first_place_winner else None,
+            excluded=excluded,
+        )
+        _record_draw(giveaway_id, record)
+        drawn = [(place, snapshot.row(tid)) for place, tid in record['winners']]
+        if len(drawn) < 5:
+            print(f"⚠️ Заполнено мест 2-6: {len(drawn)} - не хватило участников")
+        
+        # Профили (имя/username) догружаем только для победителей
+        profiles = _get_users_by_ids(u[0] for _, u in drawn)
+        for place, (tid, tickets, _) in drawn:
+            # Формируем приз
+            prize = _build_prize(place)
             
-            if not available_users:
-                print(f"⚠️ Не удалось заполнить место {place} - нет доступных участников")
-                break
-                
-            # Выбираем победителя с учетом количества билетов
-            winner_telegram_id = _weighted_choice(available_users)
+            # Формируем имя для отображения
+            profile = profiles.get(tid) or {'telegram_id': tid}
+            display_name = _format_display_name(profile)
             
-            if winner_telegram_id is None:
-                print(f"⚠️ Не удалось выбрать победителя для места {place}")
-                break
-                
-            # Находим данные победителя
-            winner_data = next((u for u in available_users if u.get('telegram_id') == winner_telegram_id), None)
+            winner = {
+                'place_number': place,
+                'prize_name': prize['prize_name'],
+                'prize_value': prize['prize_value'],
+                'winner_username': profile.get('username', ''),
+                'winner_first_name': display_name,
+                'winner_telegram_id': tid,
+                'winner_tickets': tickets,
+                'is_first_winner': False,
+                'giveaway_id': giveaway_id
+            }
             
-            if winner_data:
-                # Формируем приз
-                prize = _build_prize(place)
-                
-                # Формируем имя для отображения
-                display_name = _format_display_name(winner_data)
-                
-                winner = {
-                    'place_number': place,
-                    'prize_name': prize['prize_name'],
-                    'prize_value': prize['prize_value'],
-                    'winner_username': winner_data.get('username', ''),
-                    'winner_first_name': display_name,
-                    'winner_telegram_id': winner_data['telegram_id'],
-                    'winner_tickets': winner_data['total_tickets'],
-                    'is_first_winner': False,
-                    'giveaway_id': 1
-                }
-                
-                winners.append(winner)
-                used_telegram_ids.add(winner_telegram_id)
-                
-                print(f"🎲 Место {place}: {display_name} (ID: {winner_telegram_id}) - {winner_data['total_tickets']} билетов")
+            winners.append(winner)
+            
+            print(f"🎲 Место {place}: {display_name} (ID: {tid}) - {tickets} билетов")
         
         return winners
         
@@ -278,69 +394,80 @@ def _format_display_name(user_data: Dict[str, Any]) -> str:
         return f"Пользователь {user_data['telegram_id']}"
 
 # === API for Giveaway (X/Y and referrals) ===
+class SupabaseStatusError(RuntimeError):
+    def __init__(self, status: int, detail: str):
+        super().__init__(f"supabase error {status}")
+        self.status = status
+        self.detail = detail
+
+def _fetch_total_all_tickets() -> Optional[int]:
+    """Прочитать значение из представления total_all_tickets (None — значения нет)"""
+    resp = _supabase().get('total_all_tickets', params={'select': '*'}, timeout=15)
+    if resp.status_code not in (200, 206):
+        raise SupabaseStatusError(resp.status_code, resp.text)
+    rows = resp.json() if resp.content else []
+    if not (isinstance(rows, list) and rows):
+        return None
+    row = rows[0]
+    for key in ['total_all_tickets', 'total_all', 'total', 'value', 'count']:
+        if key in row:
+            try:
+                return int(row[key])
+            except Exception:
+                pass
+    for v in row.values():
+        try:
+            return int(v)
+        except Exception:
+            continue
+    return None
+
 @app.route('/api/giveaway/total_all', methods=['GET'])
 def total_all_tickets():
-    """Вернуть total_all_tickets из таблицы/представления total_all_tickets"""
+    """Вернуть total_all_tickets из таблицы/представления total_all_tickets (через общий кэш)"""
     try:
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/total_all_tickets",
-            headers=supabase_headers,
-            params={'select': '*'},
-            timeout=15,
-        )
-        if resp.status_code in (200, 206):
-            rows = resp.json() if resp.content else []
-            value = None
-            if isinstance(rows, list) and rows:
-                row = rows[0]
-                for key in ['total_all_tickets', 'total_all', 'total', 'value', 'count']:
-                    if key in row:
-                        v = row[key]
-                        try:
-                            value = int(v)
-                            break
-                        except Exception:
-                            pass
-                if value is None:
-                    for v in row.values():
-                        try:
-                            value = int(v)
-                            break
-                        except Exception:
-                            continue
-            if value is not None:
-                return jsonify({'success': True, 'total_all_tickets': value})
-            return jsonify({'success': False, 'error': 'no value'}), 404
-        return jsonify({'success': False, 'error': 'supabase error', 'status': resp.status_code, 'detail': resp.text}), 500
+        value = _total_all_cache.get_or_fetch('value', _fetch_total_all_tickets)
+        if value is not None:
+            return jsonify({'success': True, 'total_all_tickets': value})
+        return jsonify({'success': False, 'error': 'no value'}), 404
+    except SupabaseStatusError as e:
+        return jsonify({'success': False, 'error': 'supabase error', 'status': e.status, 'detail': e.detail}), 500
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _load_user_stats_row(telegram_id: int) -> Optional[Dict[str, Any]]:
+    """Строка users со счётчиками билетов (для кэша user_stats)"""
+    resp = _supabase().get(
+        'users',
+        params={'telegram_id': f"eq.{telegram_id}", 'select': STATS_COLUMNS},
+        timeout=15,
+    )
+    if resp.status_code not in (200, 206):
+        raise SupabaseStatusError(resp.status_code, resp.text)
+    rows = resp.json() if resp.content else []
+    return rows[0] if isinstance(rows, list) and rows else None
+
+# Счётчики пользователя: память процесса -> Redis -> Supabase, обновляются событиями воркера referrals
+_user_stats_cache = UserStatsCache(_load_user_stats_row)
+
 @app.route('/api/giveaway/user_stats/<int:telegram_id>', methods=['GET'])
 def giveaway_user_stats(telegram_id: int):
     """Вернуть user tickets и referral tickets по telegram_id из users"""
     try:
-        resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/users",
-            headers=supabase_headers,
-            params={'telegram_id': f"eq.{telegram_id}", 'select': 'total_tickets,subscription_tickets,referral_tickets,referral_code'},
-            timeout=15,
-        )
-        if resp.status_code in (200, 206):
-            rows = resp.json() if resp.content else []
-            if isinstance(rows, list) and rows:
-                u = rows[0]
-                return jsonify({
-                    'success': True,
-                    'total_tickets': u.get('total_tickets', 0),
-                    'subscription_tickets': u.get('subscription_tickets', 0),
-                    'referral_tickets': u.get('referral_tickets', 0),
-                    'referral_code': u.get('referral_code', ''),
-                })
-            return jsonify({'success': True, 'total_tickets': 0, 'subscription_tickets': 0, 'referral_tickets': 0, 'referral_code': ''})
-        return jsonify({'success': False, 'error': 'supabase error', 'status': resp.status_code, 'detail': resp.text}), 500
+        return jsonify({'success': True, **_user_stats_cache.get(telegram_id)})
+    except SupabaseStatusError as e:
+        return jsonify({'success': False, 'error': 'supabase error', 'status': e.status, 'detail': e.detail}), 500
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _remember_user_row(telegram_id: Any, resp) -> None:
+    """Положить строку из ответа PATCH/INSERT (return=representation) в кэш user_stats, иначе сбросить запись"""
+    try:
+        rows = resp.json() if resp.content else []
+        _user_stats_cache.put(int(telegram_id), rows[0] if isinstance(rows, list) and rows else None)
+    except Exception as e:
+        print(f"⚠️ user_stats: не удалось обновить кэш {telegram_id}: {e}")
+
 @app.route('/api/referral-code', methods=['POST'])
 def get_or_create_referral_code():
     try:
@@ -349,9 +476,8 @@ def get_or_create_referral_code():
         if not telegram_id:
             return jsonify({'success': False, 'error': 'telegram_id required'}), 400
         # 1) get user
-        get_resp = requests.get(
-            f"{SUPABASE_URL}/rest/v1/users",
-            headers=supabase_headers,
+        get_resp = _supabase().get(
+            'users',
             params={
                 'telegram_id': f"eq.{telegram_id}",
                 'select': 'telegram_id,referral_code'
@@ -368,11 +494,12 @@ def get_or_create_referral_code():
             if code:
                 # ensure referrals upsert
                 try:
-                    _ = requests.post(
-                        f"{SUPABASE_URL}/rest/v1/referrals",
-                        headers={**supabase_headers, 'Prefer': 'resolution=merge-duplicates'},
+                    _ = _supabase().post(
+                        'referrals',
+                        headers={'Prefer': 'resolution=merge-duplicates'},
                         json={'telegram_id': int(telegram_id), 'referral_code': code},
-                        timeout=15
+                        timeout=15,
+                        retry=True,
                     )
                 except Exception:
                     pass
@@ -380,21 +507,23 @@ def get_or_create_referral_code():
             # 3) else create code and patch
             import random, string
             code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-            patch_resp = requests.patch(
-                f"{SUPABASE_URL}/rest/v1/users",
-                headers={**supabase_headers, 'Prefer': 'return=representation'},
+            patch_resp = _supabase().patch(
+                'users',
+                headers={'Prefer': 'return=representation'},
                 params={'telegram_id': f"eq.{telegram_id}"},
                 json={'referral_code': code},
                 timeout=15
             )
             if patch_resp.status_code in (200, 204):
+                _remember_user_row(telegram_id, patch_resp)
                 # ensure referrals upsert
                 try:
-                    _ = requests.post(
-                        f"{SUPABASE_URL}/rest/v1/referrals",
-                        headers={**supabase_headers, 'Prefer': 'resolution=merge-duplicates'},
+                    _ = _supabase().post(
+                        'referrals',
+                        headers={'Prefer': 'resolution=merge-duplicates'},
                         json={'telegram_id': int(telegram_id), 'referral_code': code},
-                        timeout=15
+                        timeout=15,
+                        retry=True,
                     )
                 except Exception:
                     pass
@@ -403,9 +532,9 @@ def get_or_create_referral_code():
         # 4) user doesn't exist -> insert with minimal fields
         import random, string
         code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        insert_resp = requests.post(
-            f"{SUPABASE_URL}/rest/v1/users",
-            headers={**supabase_headers, 'Prefer': 'return=representation'},
+        insert_resp = _supabase().post(
+            'users',
+            headers={'Prefer': 'return=representation'},
             json={
                 'telegram_id': int(telegram_id),
                 'username': '',
@@ -419,13 +548,15 @@ def get_or_create_referral_code():
             timeout=15
         )
         if insert_resp.status_code in (200, 201):
+            _remember_user_row(telegram_id, insert_resp)
             # ensure referrals upsert
             try:
-                _ = requests.post(
-                    f"{SUPABASE_URL}/rest/v1/referrals",
-                    headers={**supabase_headers, 'Prefer': 'resolution=merge-duplicates'},
+                _ = _supabase().post(
+                    'referrals',
+                    headers={'Prefer': 'resolution=merge-duplicates'},
                     json={'telegram_id': int(telegram_id), 'referral_code': code},
-                    timeout=15
+                    timeout=15,
+                    retry=True,
                 )
             except Exception:
                 pass
@@ -488,34 +619,50 @@ def rate_artist():
             return jsonify({"success": False, "error": "Rating must be between 1 and 5"}), 400
         
         print(f"📝 Получен рейтинг от Flutter: {user_id} оценил {artist_name} на {rating} звезд")
+
+        if _rating_writer.enabled:
+            row = {'artist_name': artist_name, 'user_id': str(user_id), 'rating': rating, 'comment': comment or None}
+            try:
+                _rating_writer.enqueue(row)
+            except BufferFull:
+                return jsonify({"success": False, "error": "Rating queue is full, retry later"}), 503, {'Retry-After': '1'}
+            except RedisError as e:
+                print(f"⚠️ write-behind недоступен, пишем синхронно: {e}")
+            else:
+                # Оптимистичная статистика: оценка уже учтена в агрегатах, в базу её допишет flusher
+                _rating_aggregates.ensure_started()
+                _rating_aggregates.apply(artist_name, str(user_id), rating)
+                return jsonify({
+                    "success": True,
+                    "message": "Rating accepted",
+                    "queued": True,
+                    "stats": _rating_aggregates.stats(artist_name) or {}
+                })
         
         # Вызываем RPC функцию в Supabase для добавления рейтинга
-        response = requests.post(
-            f"{SUPABASE_URL}/rest/v1/rpc/add_artist_rating",
-            headers=supabase_headers,
-            json={
-                "artist_name_param": artist_name,
-                "user_id_param": str(user_id),
-                "rating_param": rating,
-                "comment_param": comment if comment else None
-            }
-        )
+        response = _supabase().rpc("add_artist_rating", {
+            "artist_name_param": artist_name,
+            "user_id_param": str(user_id),
+            "rating_param": rating,
+            "comment_param": comment if comment else None
+        }, timeout=20)
         
         if response.status_code == 200:
             result = response.json()
             if result.get("success"):
                 print(f"✅ Рейтинг успешно сохранен для {artist_name}")
                 
-                # Получаем обновленную статистику
-                stats_response = requests.post(
-                    f"{SUPABASE_URL}/rest/v1/rpc/get_artist_rating",
-                    headers=supabase_headers,
-                    json={"artist_name_param": artist_name}
-                )
-                
-                stats = {}
-                if stats_response.status_code == 200:
-                    stats = stats_response.json()
+                # Обновленная статистика — из локальных агрегатов, без второго RPC
+                _rating_aggregates.ensure_started()
+                _rating_aggregates.apply(artist_name, str(user_id), rating)
+                stats = _rating_aggregates.stats(artist_name)
+                if stats is None:
+                    # Агрегаты ещё прогреваются
+                    stats = {}
+                    stats_response = _supabase().rpc("get_artist_rating", {"artist_name_param": artist_name},
+                                                     timeout=20, retry=True)
+                    if stats_response.status_code == 200:
+                        stats = stats_response.json()
                 
                 return jsonify({
                     "success": True,
@@ -534,29 +681,263 @@ def rate_artist():
         print(f"❌ Исключение в rate_artist: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+def _fetch_artist_rating(artist_name: str) -> Dict[str, Any]:
+    response = _supabase().rpc("get_artist_rating", {"artist_name_param": artist_name}, timeout=20, retry=True)
+    return {'status': response.status_code, 'body': response.json() if response.status_code == 200 else None}
+
+def _iter_artist_ratings(params: Optional[Dict[str, Any]] = None, page_size: int = 1000) -> Iterator[Tuple[str, str, int]]:
+    """Постраничное чтение таблицы оценок: (artist_name, user_id, rating)"""
+    offset = 0
+    while True:
+        q = dict(params or {})
+        q.update({'order': 'artist_name.asc,user_id.asc', 'limit': str(page_size), 'offset': str(offset)})
+        rows = _get_supabase_rows(ARTIST_RATINGS_TABLE, select='artist_name,user_id,rating', params=q)
+        if not rows:
+            return
+        for r in rows:
+            yield r.get('artist_name'), str(r.get('user_id')), r.get('rating')
+        offset += len(rows)
+
+# Агрегаты рейтингов в памяти: GET /api/get-rating и ответ rate_artist обслуживаются без RPC
+_rating_aggregates = RatingAggregates(
+    load_all=_iter_artist_ratings,
+    load_artist=lambda name: _iter_artist_ratings({'artist_name': f'eq.{name}'}),
+    remote_stats=lambda name: _fetch_artist_rating(name)['body'],
+)
+
+# Рейтинг всего каталога одним запросом: индекс поверх агрегатов
+_leaderboard = LeaderboardIndex(_rating_aggregates)
+LEADERBOARD_MAX_AGE = int(os.environ.get('LEADERBOARD_MAX_AGE', '10'))
+
+@app.route('/api/artists/leaderboard', methods=['GET'])
+def artists_leaderboard():
+    """Артисты, отсортированные по среднему (sort=average) или числу оценок (sort=count);
+    limit=N — только топ-N. Поддерживает If-None-Match/304.
+    """
+    try:
+        sort = request.args.get('sort', 'average')
+        if sort not in LeaderboardIndex.SORTS:
+            return jsonify({"success": False, "error": "sort must be 'average' or 'count'"}), 400
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 1:
+            return jsonify({"success": False, "error": "limit must be positive"}), 400
+
+        _rating_aggregates.ensure_started()
+        rendered = _leaderboard.render(sort, limit)
+        if rendered is None:
+            return jsonify({"success": False, "error": "Leaderboard is warming up"}), 503, {'Retry-After': '2'}
+        body, etag = rendered
+
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = jsonify({"success": True, **body})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f'public, max-age={LEADERBOARD_MAX_AGE}'
+        return response
+    except Exception as e:
+        print(f"❌ Исключение в artists_leaderboard: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/api/get-rating/<artist_name>', methods=['GET'])
 def get_artist_rating(artist_name):
     """API эндпоинт для получения рейтинга артиста"""
     try:
-        response = requests.post(
-            f"{SUPABASE_URL}/rest/v1/rpc/get_artist_rating",
-            headers=supabase_headers,
-            json={"artist_name_param": artist_name}
-        )
+        _rating_aggregates.ensure_started()
+        stats = _rating_aggregates.stats(artist_name)
+        if stats is not None:
+            return jsonify(stats)
+        result = _supabase_flight.do(f"rpc/get_artist_rating:{artist_name}", lambda: _fetch_artist_rating(artist_name))
         
-        if response.status_code == 200:
-            return jsonify(response.json())
+        if result['status'] == 200:
+            return jsonify(result['body'])
         else:
-            return jsonify({"error": f"Failed to get rating: {response.status_code}"}), 500
+            return jsonify({"error": f"Failed to get rating: {result['status']}"}), 500
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Максимум оценок в одном запросе /api/rate-artists/batch
+RATING_BATCH_MAX = int(os.environ.get('RATING_BATCH_MAX', '50'))
+
+def _validate_rating_item(item: Any, default_user_id: Any) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Проверка одной оценки батча по тем же правилам, что и /api/rate-artist"""
+    if not isinstance(item, dict):
+        return None, "Item must be an object"
+    artist_name = item.get('artist_name')
+    user_id = item.get('user_id', default_user_id)
+    rating = item.get('rating')
+    if not all([artist_name, user_id, rating]):
+        return None, "Missing required fields"
+    if not isinstance(rating, int) or isinstance(rating, bool) or rating < 1 or rating > 5:
+        return None, "Rating must be between 1 and 5"
+    return {
+        'artist_name': str(artist_name),
+        'user_id': str(user_id),
+        'rating': rating,
+        'comment': item.get('comment') or None,
+    }, None
+
+def _add_rating_rpc(row: Dict[str, Any]) -> Optional[str]:
+    """Одна оценка через add_artist_rating; None — успех, иначе текст ошибки.
+    RetryLater — сеть или 5xx: оценка могла не записаться, её можно повторить"""
+    try:
+        response = _supabase().rpc("add_artist_rating", {
+            "artist_name_param": row['artist_name'],
+            "user_id_param": row['user_id'],
+            "rating_param": row['rating'],
+            "comment_param": row['comment'],
+        }, timeout=20)
+    except requests.RequestException as e:
+        raise RetryLater(str(e))
+    if response.status_code >= 500:
+        raise RetryLater(f"Supabase error: {response.status_code}")
+    if response.status_code != 200:
+        return f"Supabase error: {response.status_code}"
+    result = response.json()
+    return None if result.get("success") else result.get("error", "Unknown error")
+
+# Есть ли в базе add_artist_ratings (supabase/migrations/20261017120000_add_artist_ratings.sql)
+_ratings_batch_rpc = True
+
+def _add_ratings_rpc(rows: List[Dict[str, Any]]) -> List[Optional[str]]:
+    """Пакет оценок одним RPC add_artist_ratings: каждая строка проходит через add_artist_rating,
+    отклонённая откатывает только себя. Результат по порядку rows: None — записана, иначе текст ошибки.
+    RetryLater — сеть или 5xx. Пока функция не создана в базе (404), пишем по одной через add_artist_rating"""
+    global _ratings_batch_rpc
+    if not rows:
+        return []
+    if _ratings_batch_rpc:
+        try:
+            response = _supabase().rpc("add_artist_ratings", {"ratings": rows}, timeout=30)
+        except requests.RequestException as e:
+            raise RetryLater(str(e))
+        if response.status_code >= 500:
+            raise RetryLater(f"Supabase error: {response.status_code}")
+        if response.status_code == 404:
+            print("⚠️ RPC add_artist_ratings не найдена — оценки пишутся по одной (примените supabase/migrations)")
+            _ratings_batch_rpc = False
+        elif response.status_code != 200:
+            return [f"Supabase error: {response.status_code}"] * len(rows)
+        else:
+            results = response.json()
+            if not isinstance(results, list) or len(results) != len(rows):
+                return ["Unexpected add_artist_ratings response"] * len(rows)
+            return [None if r.get('success') else (r.get('error') or "Unknown error") for r in results]
+    return write_ratings(rows, _add_rating_rpc)
+
+def _revert_rejected_ratings(rows: List[Dict[str, Any]]) -> None:
+    """Write-behind уже учёл эти оценки в агрегатах, а база их отклонила — откатываем"""
+    _rating_aggregates.revert_many((r['artist_name'], r['user_id'], r['rating']) for r in rows)
+
+# Write-behind (RATING_WRITE_BEHIND=1): оценки пишутся в Supabase фоновыми пакетами
+_rating_writer = RatingWriter(write_batch=_add_ratings_rpc, on_rejected=_revert_rejected_ratings)
+
+@app.route('/api/rate-artists/batch', methods=['POST'])
+def rate_artists_batch():
+    """Пакет оценок (офлайн-очередь Flutter, «оценить всех»): один RPC add_artist_ratings на весь пакет
+    (или одна атомарная постановка в write-behind буфер), статистика считается один раз на пакет.
+    Тело: {"user_id": ..., "ratings": [{"artist_name", "rating", "comment"?, "user_id"?}, ...]}
+    Ответ: результат по каждой оценке + обновлённая статистика всех затронутых артистов.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        items = data.get('ratings')
+        if not isinstance(items, list) or not items:
+            return jsonify({"success": False, "error": "ratings must be a non-empty list"}), 400
+        if len(items) > RATING_BATCH_MAX:
+            return jsonify({"success": False, "error": f"Too many ratings (max {RATING_BATCH_MAX})"}), 400
+
+        results: List[Dict[str, Any]] = []
+        # (artist, user) -> индекс в results: пара пишется один раз,
+        # в пакете побеждает последняя оценка, предыдущие помечаются superseded
+        latest: Dict[Tuple[str, str], int] = {}
+        rows: Dict[int, Dict[str, Any]] = {}
+        for i, item in enumerate(items):
+            row, error = _validate_rating_item(item, data.get('user_id'))
+            if error:
+                results.append({"index": i, "success": False, "error": error})
+                continue
+            results.append({"index": i, "success": True, "artist_name": row['artist_name']})
+            key = (row['artist_name'], row['user_id'])
+            if key in latest:
+                results[latest[key]]["superseded"] = True
+                rows.pop(latest[key], None)
+            latest[key] = i
+            rows[i] = row
+
+        print(f"📝 Пакет оценок от Flutter: {len(items)} шт., к записи {len(rows)}")
+
+        queued = False
+        if rows and _rating_writer.enabled:
+            try:
+                # Все оценки пакета или ни одной: при отказе буфер не содержит части пакета
+                _rating_writer.enqueue_many(list(rows.values()))
+                queued = True
+            except BufferFull:
+                return jsonify({"success": False, "error": "Rating queue is full, retry later"}), 503, {'Retry-After': '1'}
+            except RedisError as e:
+                print(f"⚠️ write-behind недоступен, пишем синхронно: {e}")
+
+        if rows and not queued:
+            try:
+                errors = _add_ratings_rpc(list(rows.values()))
+            except RetryLater as e:
+                errors = [str(e)] * len(rows)
+            for i, error in zip(list(rows), errors):
+                if error:
+                    results[i].update({"success": False, "error": error})
+                    rows.pop(i)
+
+        _rating_aggregates.ensure_started()
+        _rating_aggregates.apply_many((r['artist_name'], r['user_id'], r['rating']) for r in rows.values())
+
+        stats: Dict[str, Any] = {}
+        for artist_name in sorted({r['artist_name'] for r in rows.values()}):
+            artist_stats = _rating_aggregates.stats(artist_name)
+            if artist_stats is None:
+                artist_stats = _supabase_flight.do(f"rpc/get_artist_rating:{artist_name}",
+                                                   lambda: _fetch_artist_rating(artist_name))['body'] or {}
+            stats[artist_name] = artist_stats
+
+        saved = sum(1 for r in results if r["success"])
+        return jsonify({
+            "success": saved == len(results),
+            "saved": saved,
+            "failed": len(results) - saved,
+            "queued": queued,
+            "results": results,
+            "stats": stats,
+        })
+    except Exception as e:
+        print(f"❌ Исключение в rate_artists_batch: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Проверка работоспособности API"""
     return jsonify({"status": "ok", "message": "Rating API is working"})
 
+@app.route('/api/debug/pool', methods=['GET'])
+def debug_pool():
+    """Статистика пула соединений к Supabase текущего воркера (hit/miss)"""
+    return jsonify({'success': True, 'supabase_pool': _supabase().stats()})
+
+@app.route('/api/debug/singleflight', methods=['GET'])
+def debug_singleflight():
+    """Метрики схлопывания запросов (coalescing_ratio = доля запросов, получивших чужой ответ)"""
+    return jsonify({'success': True, 'singleflight': {_supabase_flight.name: _supabase_flight.stats()},
+                    'draw_state': _draw_state.stats(), 'draw_events': _draw_events.stats(),
+                    'eligibility': _eligibility.stats(), 'membership_cache': dict(_membership.cache.stats),
+                    'membership_ledger': dict(_membership.ledger.stats),
+                    'telegram_rate': dict(_membership.limiter.stats)})
+
+@app.route('/api/debug/ratings', methods=['GET'])
+def debug_ratings():
+    """Состояние локальных агрегатов рейтингов"""
+    return jsonify({'success': True, 'rating_aggregates': _rating_aggregates.metrics(),
+                    'rating_writer': _rating_writer.metrics()})
+
 @app.route('/api/debug/tables', methods=['GET'])
 def debug_tables():
     """Отладочная информация о таблицах в базе данных"""
@@ -606,87 +987,124 @@ def debug_tables():
 
 # === Giveaway Winners Generation and Retrieval ===
 
-# Глобальная переменная для кэширования результатов розыгрыша (теперь только для оптимизации)
-_giveaway_results_cache = None
-_giveaway_draw_completed = False
+def _count_giveaway_winners(giveaway_id: int) -> int:
+    """Число победителей в БД: HEAD с count=exact, без тела ответа"""
+    resp = _supabase().head('giveaway_winners', params={'giveaway_id': f'eq.{giveaway_id}', 'select': 'place_number'},
+                            headers={'Prefer': 'count=exact'}, timeout=10)
+    if resp.status_code not in (200, 206):
+        raise RuntimeError(f"supabase head giveaway_winners {resp.status_code}")
+    # Content-Range: 0-5/6 или */0
+    return int(resp.headers.get('Content-Range', '*/0').rsplit('/', 1)[-1] or 0)
+
+# Состояние розыгрыша (версионированное, общее для реплик через Redis) и результаты текущей версии
+_draw_state = DrawState(_count_giveaway_winners)
+# Живая трансляция розыгрыша: события через Redis pub/sub, SSE-клиенты — в asgi.py
+_draw_events = DrawEvents()
+
+def _announce_draw(giveaway_id: int, state: Dict[str, Any], winners: Optional[List[Dict[str, Any]]] = None) -> None:
+    """Разослать места победителей (с последнего до первого) и новый статус всем репликам"""
+    version = state.get('version', 0)
+    for w in sorted(winners or [], key=lambda r: int(r.get('place_number', 0)), reverse=True):
+        _draw_events.publish({'type': 'winner', 'giveaway_id': giveaway_id, 'version': version,
+                              'place': int(w.get('place_number', 0)), 'winner': w})
+    _draw_events.publish({'type': 'status', 'giveaway_id': giveaway_id, 'version': version,
+                          'completed': bool(state.get('completed')), 'winners_count': state.get('winners_count', 0)})
+
+def _announce_draw_failed(giveaway_id: int, error: str) -> None:
+    """Розыгрыш, объявленный событием drawing, не состоялся: клиенты получают текущий статус с ошибкой"""
+    try:
+        state = _draw_state.get(giveaway_id)
+    except Exception:
+        state = {}
+    _draw_events.publish({'type': 'status', 'giveaway_id': giveaway_id, 'version': state.get('version', 0),
+                          'completed': bool(state.get('completed')), 'winners_count': state.get('winners_count', 0),
+                          'error': error})
+
+# Запись розыгрыша в таблице giveaways, уже проверенная этим процессом
+_giveaways_ensured: set = set()
+
+def _ensure_giveaway_row(giveaway_id: int) -> None:
+    """Создать запись основного розыгрыша (id=1), если её нет: один upsert с ignore-duplicates, раз на процесс.
+    Остальные розыгрыши создаются заранее в таблице giveaways."""
+    if giveaway_id != 1 or giveaway_id in _giveaways_ensured:
+        return
+    giveaway_data = {
+        'id': giveaway_id,
+        'title': 'GTM Giveaway 2025',
+        'description': 'Основной розыгрыш Gotham\'s Top Model с призами на сумму более 130,000₽',
+        'prize_amount': '130000.00',
+        'start_date': '2024-01-01T00:00:00+00:00',
+        'end_date': '2025-08-18T20:00:00+00:00',
+        'is_active': True
+    }
+    resp = _supabase().post('giveaways', params={'on_conflict': 'id'}, json=[giveaway_data],
+                            headers={'Prefer': 'resolution=ignore-duplicates,return=minimal'}, timeout=20, retry=True)
+    if resp.status_code not in (200, 201, 204):
+        raise RuntimeError(f"supabase upsert giveaways {resp.status_code}: {resp.text}")
+    _giveaways_ensured.add(giveaway_id)
+
+# Есть ли в базе replace_giveaway_winners (supabase/migrations/20261017130000_replace_giveaway_winners.sql)
+_winners_replace_rpc = True
+
+def _replace_giveaway_winners(giveaway_id: int, winners: List[Dict[str, Any]]) -> None:
+    """Заменить результаты розыгрыша целиком одним RPC replace_giveaway_winners: удаление старых мест
+    и вставка новых в одной транзакции — читатель видит либо старый, либо новый полный список,
+    в том числе когда мест стало меньше. Повтор безопасен (результат тот же).
+    Пока функция не создана в базе (404): DELETE всех мест, затем одна вставка — между ними
+    список пуст; любая ошибка пробрасывается.
+    """
+    global _winners_replace_rpc
+    rows = [{
+        'giveaway_id': giveaway_id,
+        'place_number': w['place_number'],
+        'winner_telegram_id': w['winner_telegram_id'],
+        'winner_username': w.get('winner_username', ''),
+        'winner_first_name': w.get('winner_first_name', ''),
+        'prize_name': w['prize_name'],
+        'prize_value': w['prize_value'],
+        'winner_tickets': w.get('winner_tickets', 0),
+        'is_first_winner': w.get('is_first_winner', False),
+        # created_at выставляет Supabase
+    } for w in winners]
+    if _winners_replace_rpc:
+        resp = _supabase().rpc('replace_giveaway_winners', {'p_giveaway_id': giveaway_id, 'p_winners': rows},
+                               timeout=30, retry=True)
+        if resp.status_code == 200:
+            return
+        if resp.status_code != 404:
+            raise RuntimeError(f"supabase rpc replace_giveaway_winners {resp.status_code}: {resp.text}")
+        print("⚠️ RPC replace_giveaway_winners не найдена — места заменяются без транзакции (примените supabase/migrations)")
+        _winners_replace_rpc = False
+    resp = _supabase().delete('giveaway_winners', params={'giveaway_id': f'eq.{giveaway_id}'}, timeout=30, retry=True)
+    if resp.status_code not in (200, 204):
+        raise RuntimeError(f"supabase delete giveaway_winners {resp.status_code}: {resp.text}")
+    if rows:
+        resp = _supabase().post('giveaway_winners', json=rows, headers={'Prefer': 'return=minimal'}, timeout=30)
+        if resp.status_code not in (200, 201, 204):
+            raise RuntimeError(f"supabase insert giveaway_winners {resp.status_code}: {resp.text}")
 
 def _save_giveaway_results_to_cache(winners: List[Dict[str, Any]]) -> None:
-    """Сохранить результаты розыгрыша в кэш И в базу данных"""
-    global _giveaway_results_cache, _giveaway_draw_completed
-    
+    """Сохранить результаты розыгрыша в базу данных и, только после успешной записи, в кэш.
+    Ошибка записи пробрасывается: непрочные результаты не показываются.
+    """
+    giveaway_id = int(winners[0].get('giveaway_id', 1)) if winners else 1
+    print(f"💾 Сохраняем результаты розыгрыша в базу данных ({len(winners)} мест)...")
     try:
-        # Сохраняем в базу данных для постоянного хранения
-        print("💾 Сохраняем результаты розыгрыша в базу данных...")
-        
-        # Сначала проверяем, существует ли таблица giveaways
-        try:
-            giveaway_check = _get_supabase_rows('giveaways', select='id', params={'id': 'eq.1'})
-            if not giveaway_check:
-                print("❌ Таблица giveaways не содержит запись с id=1. Создаем...")
-                # Создаем запись в таблице giveaways
-                giveaway_data = {
-                    'id': 1,
-                    'title': 'GTM Giveaway 2025',
-                    'description': 'Основной розыгрыш Gotham\'s Top Model с призами на сумму более 130,000₽',
-                    'prize_amount': '130000.00',
-                    'start_date': '2024-01-01T00:00:00+00:00',
-                    'end_date': '2025-08-18T20:00:00+00:00',
-                    'is_active': True
-                }
-                _insert_supabase_rows('giveaways', [giveaway_data])
-                print("✅ Запись в таблице giveaways создана")
-        except Exception as e:
-            print(f"⚠️ Не удалось проверить/создать запись в giveaways: {e}")
-        
-        # Сначала очищаем старые результаты
-        _clear_existing_giveaway_results()
-        
-        # Сохраняем новые результаты
-        for winner in winners:
-            winner_data = {
-                'giveaway_id': winner.get('giveaway_id', 1),
-                'place_number': winner['place_number'],
-                'winner_telegram_id': winner['winner_telegram_id'],
-                'winner_username': winner.get('winner_username', ''),
-                'winner_first_name': winner.get('winner_first_name', ''),
-                'prize_name': winner['prize_name'],
-                'prize_value': winner['prize_value'],
-                'winner_tickets': winner.get('winner_tickets', 0),
-                'is_first_winner': winner.get('is_first_winner', False)
-                # Убираем created_at - пусть Supabase сам установит
-            }
-            
-            try:
-                print(f"💾 Сохраняем победителя места {winner['place_number']} в БД...")
-                print(f"📝 Данные для сохранения: {winner_data}")
-                
-                result = _insert_supabase_rows('giveaway_winners', [winner_data])
-                print(f"✅ Сохранен победитель места {winner['place_number']}: {winner.get('winner_first_name', 'Unknown')}")
-                print(f"📊 Результат сохранения: {result}")
-            except Exception as e:
-                print(f"❌ Ошибка сохранения победителя места {winner['place_number']}: {e}")
-                print(f"🔍 Детали ошибки: {type(e).__name__}: {str(e)}")
-        
-        # Обновляем кэш в памяти для быстрого доступа
-        _giveaway_results_cache = winners
-        _giveaway_draw_completed = True
-        
-        print(f"🎯 Результаты розыгрыша сохранены в базу данных и кэш. Победителей: {len(winners)}")
-        
+        _ensure_giveaway_row(giveaway_id)
     except Exception as e:
-        print(f"❌ Ошибка сохранения результатов в базу данных: {e}")
-        # Даже при ошибке БД обновляем кэш в памяти
-        _giveaway_results_cache = winners
-        _giveaway_draw_completed = True
+        print(f"⚠️ Не удалось проверить/создать запись в giveaways: {e}")
+    _replace_giveaway_winners(giveaway_id, winners)
+    # Новая версия состояния: реплики увидят розыгрыш без запроса к БД
+    _announce_draw(giveaway_id, _draw_state.mark_completed(giveaway_id, winners), winners)
+    print(f"🎯 Результаты розыгрыша сохранены в базу данных и кэш. Победителей: {len(winners)}")
 
-def _clear_existing_giveaway_results() -> None:
+def _clear_existing_giveaway_results(giveaway_id: int = 1) -> None:
     """Очистить существующие результаты розыгрыша из базы данных"""
     try:
-        # Удаляем все существующие результаты для текущего розыгрыша
-        delete_url = f"{SUPABASE_URL}/rest/v1/giveaway_winners"
-        delete_params = {'giveaway_id': 'eq.1'}  # Текущий розыгрыш
+        # Удаляем все существующие результаты розыгрыша
+        delete_params = {'giveaway_id': f'eq.{giveaway_id}'}
         
-        response = requests.delete(delete_url, headers=supabase_headers, params=delete_params, timeout=30)
+        response = _supabase().delete('giveaway_winners', params=delete_params, timeout=30)
         if response.status_code in (200, 204):
             print("🗑️ Старые результаты розыгрыша очищены из базы данных")
         else:
@@ -697,113 +1115,96 @@ def _clear_existing_giveaway_results() -> None:
         print(f"❌ Ошибка очистки старых результатов: {e}")
         # Продолжаем работу даже при ошибке очистки
 
-def _get_cached_giveaway_results() -> Optional[List[Dict[str, Any]]]:
-    """Получить кэшированные результаты розыгрыша (сначала из БД, потом из кэша)"""
-    global _giveaway_results_cache, _giveaway_draw_completed
-    
-    try:
-        # Сначала пытаемся получить из базы данных
-        print("🔍 Проверяем результаты розыгрыша в базе данных...")
-        db_results = _get_supabase_rows('giveaway_winners', 
-                                      select='*',
-                                      params={'giveaway_id': 'eq.1'})
-        
-        if db_results and len(db_results) > 0:
-            # Сортируем по месту
-            sorted_results = sorted(db_results, key=lambda x: int(x.get('place_number', 0)))
-            
-            # Обновляем кэш в памяти и флаг завершения
-            _giveaway_results_cache = sorted_results
-            _giveaway_draw_completed = True
-            
-            print(f"✅ Найдено {len(sorted_results)} результатов в базе данных")
-            return sorted_results
-        
-        # Если в БД нет результатов, проверяем кэш в памяти
-        if _giveaway_results_cache:
-            print("📋 БД пуста, возвращаем результаты из кэша в памяти")
-            # Обновляем флаг завершения на основе кэша
-            _giveaway_draw_completed = True
-            return _giveaway_results_cache
-        
-        # Ни в БД, ни в кэше нет результатов
-        print("❌ Результаты розыгрыша не найдены ни в БД, ни в кэше")
-        _giveaway_draw_completed = False
+def _get_cached_giveaway_results(giveaway_id: int = 1,
+                                 state: Optional[Dict[str, Any]] = None) -> Optional[List[Dict[str, Any]]]:
+    """Результаты розыгрыша: из кэша версии (LRU процесса -> Redis), иначе один запрос к БД.
+    state — уже прочитанное состояние (чтобы тело совпало с выданным по нему ETag).
+    Не мутировать: список общий для всех запросов."""
+    if state is None:
+        try:
+            state = _draw_state.get(giveaway_id)
+        except Exception as e:
+            print(f"❌ Ошибка получения состояния розыгрыша: {e}")
+            return None
+    if not state.get('completed'):
         return None
-        
+    cached = _draw_state.results(giveaway_id, state)
+    if cached is not None:
+        return cached
+    try:
+        print("🔍 Читаем результаты розыгрыша из базы данных...")
+        db_results = _get_supabase_rows_coalesced('giveaway_winners', 
+                                                select='*',
+                                                params={'giveaway_id': f'eq.{giveaway_id}'})
     except Exception as e:
         print(f"❌ Ошибка получения результатов из БД: {e}")
-        # При ошибке БД проверяем кэш в памяти
-        if _giveaway_results_cache:
-            print("📋 При ошибке БД используем кэш в памяти")
-            _giveaway_draw_completed = True
-            return _giveaway_results_cache
-        else:
-            print("❌ Ни БД, ни кэш недоступны")
-            _giveaway_draw_completed = False
-            return None
+        return None
+    if not db_results:
+        print("❌ Результаты розыгрыша не найдены в БД")
+        return None
+    # Сортируем по месту; кэш привязан к версии, при которой читали
+    sorted_results = sorted(db_results, key=lambda x: int(x.get('place_number', 0)))
+    _draw_state.put_results(giveaway_id, state, sorted_results)
+    print(f"✅ Найдено {len(sorted_results)} результатов в базе данных")
+    return sorted_results
 
-def _is_giveaway_draw_completed() -> bool:
-    """Проверка, был ли уже проведен розыгрыш (проверяем БД)"""
-    global _giveaway_draw_completed
-    
+def _is_giveaway_draw_completed(giveaway_id: int = 1) -> bool:
+    """Проверка, был ли уже проведен розыгрыш (версионированное состояние; БД — только если его нет)"""
     try:
-        # Проверяем наличие результатов в базе данных
-        print("🔍 Проверяем статус розыгрыша в БД...")
-        db_results = _get_supabase_rows('giveaway_winners', 
-                                      select='*',
-                                      params={'giveaway_id': 'eq.1'})
-        
-        if db_results and len(db_results) > 0:
-            has_results = len(db_results) > 0
-            
-            # Обновляем глобальную переменную
-            _giveaway_draw_completed = has_results
-            
-            print(f"✅ В БД найдено {len(db_results)} результатов розыгрыша")
-            return has_results
-        
-        # Если БД пуста, проверяем кэш в памяти
-        if _giveaway_results_cache:
-            print(f"📋 БД пуста, но в кэше есть {len(_giveaway_results_cache)} результатов")
-            _giveaway_draw_completed = True
-            return True
-        
-        # Ни в БД, ни в кэше нет результатов
-        print("❌ Ни в БД, ни в кэше нет результатов розыгрыша")
-        _giveaway_draw_completed = False
-        return False
-        
+        return bool(_draw_state.get(giveaway_id).get('completed'))
     except Exception as e:
         print(f"❌ Ошибка проверки статуса розыгрыша: {e}")
-        # При ошибке БД используем кэш в памяти
-        if _giveaway_results_cache:
-            print(f"📋 При ошибке БД используем кэш: {len(_giveaway_results_cache)} результатов")
-            _giveaway_draw_completed = True
-            return True
-        else:
-            print("❌ Ни БД, ни кэш недоступны")
-            _giveaway_draw_completed = False
-            return False
+        return False
+
+# HTTP-кэш результатов. Браузер перепроверяет каждый раз (304 по ETag версии — без чтения результатов),
+# nginx держит /results/<id> s-maxage секунд: сброс розыгрыша виден через столько же максимум.
+# draw-winners в общий кэш не попадает (private): после сброса он проводит новый розыгрыш
+GIVEAWAY_RESULTS_SHARED_MAX_AGE = int(os.environ.get('GIVEAWAY_RESULTS_SHARED_MAX_AGE', '5'))
+
+def _giveaway_state_or_none(giveaway_id: int) -> Optional[Dict[str, Any]]:
+    try:
+        return _draw_state.get(giveaway_id)
+    except Exception as e:
+        print(f"❌ Ошибка получения состояния розыгрыша: {e}")
+        return None
+
+def _cacheable_results_response(response, etag: Optional[str], shared: bool = True):
+    """Заголовки кэширования: с ETag — результаты версии, без — ответ кэшировать нельзя.
+    shared=False — только браузер (с перепроверкой), без общих кэшей"""
+    if etag is None:
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    response.set_etag(etag)
+    if shared:
+        response.headers['Cache-Control'] = (
+            f'public, max-age=0, must-revalidate, s-maxage={GIVEAWAY_RESULTS_SHARED_MAX_AGE}')
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Сколько кандидатов на одно свободное место выбирается заранее для параллельной проверки подписок
+DRAW_CANDIDATE_FACTOR = int(os.environ.get('DRAW_CANDIDATE_FACTOR', '2'))
 
 @app.route('/api/giveaway/generate-results', methods=['POST'])
 def generate_giveaway_results():
+    drawing = False
     try:
         body = request.get_json() or {}
         giveaway_id = int(body.get('giveaway_id', 0))
         if not giveaway_id:
             return jsonify({'success': False, 'message': 'giveaway_id required'}), 400
 
-        # If results already exist, return them
-        existing = _get_supabase_rows('giveaway_winners', params={'giveaway_id': f'eq.{giveaway_id}'}, select='*')
-        if isinstance(existing, list) and existing:
-            return jsonify({'success': True, 'results': sorted(existing, key=lambda r: int(r.get('place_number', 0)))})
+        # If results already exist, return them (immutable after the draw, served from the results store)
+        existing = _get_cached_giveaway_results(giveaway_id)
+        if existing:
+            return jsonify({'success': True, 'results': existing})
 
-        users_map = _get_user_map_by_telegram_id()
-        users: List[Dict[str, Any]] = [
-            {**u, 'telegram_id': int(tid)} for tid, u in users_map.items() if int(u.get('total_tickets', 0) or 0) > 0
-        ]
+        _draw_events.publish({'type': 'drawing', 'giveaway_id': giveaway_id})
+        drawing = True
+        users = list(_iter_users(params={'total_tickets': 'gt.0'}, compact=True))
+        sub_tickets = {tid: subs for tid, _, subs in users if subs > 0}
         if not users:
+            _announce_draw_failed(giveaway_id, 'no eligible users')
             return jsonify({'success': False, 'message': 'no eligible users'}), 400
 
         # Manual winner for 1st place from giveaways.manual_winner_telegram_id
@@ -817,99 +1218,131 @@ def generate_giveaway_results():
             manual_tid = None
 
         winners: List[Dict[str, Any]] = []
+        # Frozen snapshot + recorded seed: the draw can be replayed bit for bit
+        snapshot, seed = _freeze_draw(users)
+        del users
 
-        # Place 1: manual (if provided and exists among users), else weighted
-        first_tid: Optional[int] = None
-        if manual_tid and manual_tid in users_map:
-            first_tid = manual_tid
-        else:
-            first_tid = _weighted_choice(users)
+        # Place 1: manual (if provided and exists among users), else weighted.
+        # Places 2..6: weighted, with subscription re-check for users who possess subscription tickets.
+        # Candidates are pre-sampled in batches and verified concurrently; places still go in sampled order.
+        manual_ok = bool(manual_tid and _get_users_by_ids([manual_tid], select='telegram_id'))
+
+        def verify(batch: List[int]) -> Dict[int, bool]:
+            # Проверяем только владельцев билетов за подписку без недавней подтверждённой подписки
+            holders = [t for t in batch if sub_tickets.get(t, 0) > 0]
+            fresh = _eligibility.recently_subscribed(holders)
+            return _verify_subscriptions((t for t in holders if t not in fresh), force_fresh=True)
+
+        record = draw_giveaway(
+            snapshot, seed, places=[2, 3, 4, 5, 6],
+            first_tid=manual_tid if manual_ok else None, draw_first=not manual_ok,
+            verify=verify, batch_factor=DRAW_CANDIDATE_FACTOR,
+            # Как и раньше, без списка организаторов; недавние отказы — только при ELIGIBILITY_UNSUBSCRIBED_TTL
+            excluded=_eligibility.refused(snapshot),
+        )
+        _record_draw(giveaway_id, record)
+
+        first_tid = record['first']
         if first_tid:
-            u = users_map.get(first_tid, {})
             p = _build_prize(1)
             winners.append({
                 'giveaway_id': giveaway_id,
                 'place_number': 1,
                 'winner_telegram_id': int(first_tid),
-                'winner_username': u.get('username') or '',
-                'winner_first_name': u.get('first_name') or '',
                 'prize_name': p['prize_name'],
                 'prize_value': p['prize_value'],
                 'is_first_winner': bool(manual_tid and manual_tid == first_tid),
             })
 
-        used_ids = {w['winner_telegram_id'] for w in winners}
-
-        # Places 2..6: weighted, with subscription re-check for users who possess subscription tickets
-        target_places = [2, 3, 4, 5, 6]
-        max_attempts = 500
-        attempts = 0
-        while target_places and attempts < max_attempts:
-            attempts += 1
-            candidate_id = _weighted_choice(users)
-            if not candidate_id:
-                break
-            if candidate_id in used_ids:
-                continue
-            u = users_map.get(candidate_id, {})
-            has_sub_ticket = int(u.get('subscription_tickets', 0) or 0) > 0
-            if has_sub_ticket and not _is_user_subscribed_to_all_now(candidate_id):
-                continue
-            place = target_places.pop(0)
+        for place, candidate_id in record['winners']:
             p = _build_prize(place)
             winners.append({
                 'giveaway_id': giveaway_id,
                 'place_number': place,
                 'winner_telegram_id': int(candidate_id),
-                'winner_username': u.get('username') or '',
-                'winner_first_name': u.get('first_name') or '',
                 'prize_name': p['prize_name'],
                 'prize_value': p['prize_value'],
                 'is_first_winner': False,
             })
-            used_ids.add(candidate_id)
 
         if len(winners) < 6:
+            _announce_draw_failed(giveaway_id, f'could not fill winners, selected {len(winners)}')
             return jsonify({'success': False, 'message': f'could not fill winners, selected {len(winners)}'}), 500
 
-        # _insert_supabase_rows('giveaway_winners', winners) # This line is now handled by _save_giveaway_results_to_cache
-        return jsonify({'success': True, 'results': sorted(winners, key=lambda r: int(r.get('place_number', 0)))})
+        # Имена победителей догружаем одним запросом
+        profiles = _get_users_by_ids((w['winner_telegram_id'] for w in winners), select='telegram_id,username,first_name')
+        for w in winners:
+            u = profiles.get(w['winner_telegram_id'], {})
+            w['winner_username'] = u.get('username') or ''
+            w['winner_first_name'] = u.get('first_name') or ''
+
+        winners.sort(key=lambda r: int(r.get('place_number', 0)))
+        _save_giveaway_results_to_cache(winners)
+        return jsonify({'success': True, 'results': winners,
+                        'draw': {'seed': str(seed), 'snapshot_sha256': snapshot.sha256}})
     except Exception as e:
+        if drawing:
+            _announce_draw_failed(giveaway_id, str(e))
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
 @app.route('/api/giveaway/results/<int:giveaway_id>', methods=['GET'])
 def get_giveaway_results(giveaway_id: int):
+    """Результаты проведённого розыгрыша; ETag/Cache-Control по версии, If-None-Match -> 304"""
     try:
-        rows = _get_supabase_rows('giveaway_winners', params={'giveaway_id': f'eq.{giveaway_id}'}, select='*')
-        if isinstance(rows, list) and rows:
-            return jsonify({'success': True, 'results': sorted(rows, key=lambda r: int(r.get('place_number', 0)))})
-        return jsonify({'success': False, 'results': []})
+        state = _giveaway_state_or_none(giveaway_id)
+        if state is not None and state.get('completed'):
+            etag = _draw_state.etag(giveaway_id, state)
+            if request.if_none_match.contains(etag):
+                return _cacheable_results_response(app.response_class(status=304), etag)
+            rows = _get_cached_giveaway_results(giveaway_id, state)
+            if rows:
+                return _cacheable_results_response(jsonify({'success': True, 'results': rows}), etag)
+        response = jsonify({'success': False, 'results': []})
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
+        return _cacheable_results_response(jsonify({'success': False, 'message': str(e)}), None), 500
+
+def _request_giveaway_id() -> int:
+    """giveaway_id из query/JSON тела; по умолчанию основной розыгрыш (1)"""
+    raw = request.args.get('giveaway_id')
+    if raw is None and request.is_json:
+        raw = (request.get_json(silent=True) or {}).get('giveaway_id')
+    return int(raw) if raw not in (None, '') else 1
 
 @app.route('/api/giveaway/draw-winners', methods=['GET'])
 def draw_giveaway_winners():
     """Провести розыгрыш победителей и вернуть результаты"""
+    drawing = False
     try:
+        giveaway_id = _request_giveaway_id()
         # Проверяем, был ли уже проведен розыгрыш
-        if _is_giveaway_draw_completed():
-            cached_results = _get_cached_giveaway_results()
+        state = _giveaway_state_or_none(giveaway_id)
+        if state is not None and state.get('completed'):
+            # Результаты неизменны до сброса: ETag версии, повторный запрос — 304
+            etag = _draw_state.etag(giveaway_id, state, 'winners')
+            if request.if_none_match.contains(etag):
+                return _cacheable_results_response(app.response_class(status=304), etag, shared=False)
+            cached_results = _get_cached_giveaway_results(giveaway_id, state)
             if cached_results:
                 print("🎯 Возвращаем кэшированные результаты розыгрыша")
-                return jsonify({
+                return _cacheable_results_response(jsonify({
                     'success': True,
                     'winners': cached_results,
                     'total_winners': len(cached_results),
                     'message': f'Возвращены сохраненные результаты розыгрыша. Определено {len(cached_results)} победителей',
                     'from_cache': True
-                })
+                }), etag, shared=False)
         
         # Если розыгрыш еще не проводился - проводим новый
         print("🎲 Проводим новый розыгрыш...")
-        winners = _draw_giveaway_winners()
+        _draw_events.publish({'type': 'drawing', 'giveaway_id': giveaway_id})
+        drawing = True
+        winners = _draw_giveaway_winners(giveaway_id)
         
         if not winners:
+            _announce_draw_failed(giveaway_id, 'no winners')
             return jsonify({
                 'success': False, 
                 'error': 'Не удалось провести розыгрыш или нет участников с билетами'
@@ -918,16 +1351,19 @@ def draw_giveaway_winners():
         # Сохраняем результаты в кэш И в БД
         _save_giveaway_results_to_cache(winners)
         
-        return jsonify({
+        # Тело отличается от последующих (from_cache) — этот ответ не кэшируем
+        return _cacheable_results_response(jsonify({
             'success': True,
             'winners': winners,
             'total_winners': len(winners),
             'message': f'Розыгрыш проведен успешно. Определено {len(winners)} победителей',
             'from_cache': False
-        })
+        }), None)
         
     except Exception as e:
         print(f"❌ Ошибка в draw_giveaway_winners: {e}")
+        if drawing:
+            _announce_draw_failed(giveaway_id, str(e))
         return jsonify({
             'success': False, 
             'error': f'Ошибка проведения розыгрыша: {str(e)}'
@@ -937,19 +1373,17 @@ def draw_giveaway_winners():
 def clear_giveaway_winners():
     """Очистить результаты розыгрыша (GET и POST методы)"""
     try:
-        global _giveaway_results_cache, _giveaway_draw_completed
-        
-        # Очищаем кэш в памяти
-        _giveaway_results_cache = None
-        _giveaway_draw_completed = False
-        
+        giveaway_id = _request_giveaway_id()
         # Очищаем результаты из базы данных
         try:
-            _clear_existing_giveaway_results()
+            _clear_existing_giveaway_results(giveaway_id)
             print("🗑️ Результаты розыгрыша очищены из базы данных")
         except Exception as e:
             print(f"⚠️ Не удалось очистить БД: {e}")
         
+        # Новая версия состояния: кэш результатов во всех репликах устаревает
+        _announce_draw(giveaway_id, _draw_state.mark_cleared(giveaway_id))
+        
         print("🔄 Результаты розыгрыша очищены (память + БД)")
         return jsonify({
             'success': True,
@@ -966,19 +1400,17 @@ def clear_giveaway_winners():
 def reset_giveaway_draw():
     """Сбросить результаты розыгрыша (для администраторов)"""
     try:
-        global _giveaway_results_cache, _giveaway_draw_completed
-        
-        # Очищаем кэш в памяти
-        _giveaway_results_cache = None
-        _giveaway_draw_completed = False
-        
+        giveaway_id = _request_giveaway_id()
         # Очищаем результаты из базы данных
         try:
-            _clear_existing_giveaway_results()
+            _clear_existing_giveaway_results(giveaway_id)
             print("🗑️ Результаты розыгрыша очищены из базы данных")
         except Exception as e:
             print(f"⚠️ Не удалось очистить БД: {e}")
         
+        # Новая версия состояния: кэш результатов во всех репликах устаревает
+        _announce_draw(giveaway_id, _draw_state.mark_cleared(giveaway_id))
+        
         print("🔄 Результаты розыгрыша сброшены (память + БД)")
         return jsonify({
             'success': True,
@@ -994,11 +1426,13 @@ def reset_giveaway_draw():
 def get_giveaway_draw_status():
     """Получить статус розыгрыша"""
     try:
+        state = _draw_state.get(_request_giveaway_id())
+        completed = bool(state.get('completed'))
         return jsonify({
             'success': True,
-            'draw_completed': _is_giveaway_draw_completed(),
-            'winners_count': len(_giveaway_results_cache) if _giveaway_results_cache else 0,
-            'message': 'Розыгрыш уже проведен' if _is_giveaway_draw_completed() else 'Розыгрыш еще не проводился'
+            'draw_completed': completed,
+            'winners_count': state.get('winners_count', 0) if completed else 0,
+            'message': 'Розыгрыш уже проведен' if completed else 'Розыгрыш еще не проводился'
         })
     except Exception as e:
         return jsonify({
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Write-behind запись оценок (RATING_WRITE_BEHIND=1, нужен Redis).
+rate_artist кладёт оценку в Redis-хэш pending (поле = artist_name + user_id,
+повторная оценка перетирает ещё не записанную) и сразу отвечает. Фоновый flusher
+раз в RATING_FLUSH_INTERVAL_MS или при накоплении RATING_FLUSH_BATCH оценок
+переносит хэш в processing (RENAME) и пишет его пачками по RATING_FLUSH_BATCH —
+одним RPC add_artist_ratings на пачку. Записанная пачка сразу удаляется из processing,
+так что после сбоя в pending возвращается только незаписанный остаток (не перетирая
+более свежие оценки). Оценки, отклонённые RPC, отбрасываются и передаются в on_rejected.
+Доставка — «хотя бы один раз»: пачку, записанную перед падением flusher'а, запишут
+повторно, но add_artist_rating заменяет прежнюю оценку пользователя, поэтому повтор
+ничего не меняет.
+Flusher работает в одной реплике за раз: замок в Redis со случайным токеном
+продлевается после каждой пачки и снимается только владельцем.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from shared_cache import CACHE_PREFIX, RedisError, extend_lock, get_redis, new_lock_token, release_lock
+
+RATING_WRITE_BEHIND = os.environ.get('RATING_WRITE_BEHIND', '0') == '1'
+RATING_FLUSH_INTERVAL_MS = int(os.environ.get('RATING_FLUSH_INTERVAL_MS', '500'))
+# Оценок в одном RPC add_artist_ratings
+RATING_FLUSH_BATCH = int(os.environ.get('RATING_FLUSH_BATCH', '200'))
+# Замок flusher'а; продлевается после каждой пачки, поэтому должен пережить одну пачку
+RATING_FLUSH_LOCK_MS = int(os.environ.get('RATING_FLUSH_LOCK_MS', '60000'))
+# Максимум незаписанных оценок; дальше — отказ с 503 (backpressure)
+RATING_BUFFER_MAX = int(os.environ.get('RATING_BUFFER_MAX', '20000'))
+# Параллельных add_artist_rating, пока в базе нет add_artist_ratings; больше пула соединений Supabase незачем
+RATING_WRITE_CONCURRENCY = int(os.environ.get('RATING_WRITE_CONCURRENCY',
+                                              os.environ.get('SUPABASE_POOL_SIZE', os.environ.get('GUNICORN_THREADS', '4'))))
+
+PENDING_KEY = f"{CACHE_PREFIX}:ratings:pending"
+PROCESSING_KEY = f"{CACHE_PREFIX}:ratings:processing"
+FLUSH_LOCK_KEY = f"{CACHE_PREFIX}:ratings:flush:lock"
+FIELD_SEP = '\x1f'
+
+# HSET пакета с ограничением размера: либо в буфер попадают все оценки, либо ни одной.
+# ARGV[1] — максимум, дальше пары поле/значение; замены уже ждущих оценок место не занимают
+_ENQUEUE_SCRIPT = """
+local added = 0
+for i = 2, #ARGV, 2 do
+  if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 0 then added = added + 1 end
+end
+if added > 0 and redis.call('HLEN', KEYS[1]) + added > tonumber(ARGV[1]) then
+  return -1
+end
+for i = 2, #ARGV, 2 do
+  redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return redis.call('HLEN', KEYS[1])
+"""
+
+# Вернуть незаписанный остаток processing: более свежие оценки из pending не перетираем
+_RESTORE_SCRIPT = """
+local rows = redis.call('HGETALL', KEYS[2])
+for i = 1, #rows, 2 do
+  redis.call('HSETNX', KEYS[1], rows[i], rows[i + 1])
+end
+redis.call('DEL', KEYS[2])
+return #rows / 2
+"""
+
+
+class BufferFull(Exception):
+    pass
+
+
+class RetryLater(Exception):
+    """Оценка не записана по временной причине (сеть, 5xx) — запись можно повторить"""
+
+
+def write_ratings(rows: List[Dict[str, Any]], write_one: Callable[[Dict[str, Any]], Optional[str]]) -> List[Optional[str]]:
+    """write_one по каждой оценке, до RATING_WRITE_CONCURRENCY запросов параллельно.
+    Результат по порядку rows: None — записана, иначе текст ошибки; RetryLater из write_one пробрасывается"""
+    workers = max(1, min(RATING_WRITE_CONCURRENCY, len(rows)))
+    if workers == 1:
+        return [write_one(row) for row in rows]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(write_one, rows))
+
+
+class RatingWriter:
+    """write_batch(rows) -> по каждой оценке None или текст ошибки (оценка отклонена),
+    RetryLater — временная ошибка, пачка не записана;
+    on_rejected(rows) — отклонённые оценки, уже учтённые оптимистично (их нужно откатить)"""
+
+    def __init__(self, write_batch: Callable[[List[Dict[str, Any]]], List[Optional[str]]],
+                 on_rejected: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        self._write_batch = write_batch
+        self._on_rejected = on_rejected
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._started_pid: Optional[int] = None
+        self._stats = {
+            'enqueued': 0, 'rejected': 0, 'flushes': 0, 'flushed': 0, 'failed_flushes': 0, 'dropped': 0,
+            'last_flush_at': 0.0, 'last_flush_lag_ms': 0, 'max_flush_lag_ms': 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return RATING_WRITE_BEHIND and get_redis() is not None
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += n
+
+    # --- запись в буфер ---
+
+    def enqueue(self, row: Dict[str, Any]) -> None:
+        """Положить оценку в буфер; BufferFull — буфер переполнен, RedisError — Redis недоступен"""
+        self.enqueue_many([row])
+
+    def enqueue_many(self, rows: List[Dict[str, Any]]) -> None:
+        """Положить пакет оценок в буфер атомарно: при BufferFull и RedisError не записано ничего"""
+        self.ensure_started()
+        now = time.time()
+        args: List[Any] = [RATING_BUFFER_MAX]
+        for row in rows:
+            args += [f"{row['artist_name']}{FIELD_SEP}{row['user_id']}",
+                     json.dumps({**row, 't': now}, ensure_ascii=False)]
+        size = get_redis().eval(_ENQUEUE_SCRIPT, 1, PENDING_KEY, *args)
+        if int(size) < 0:
+            self._count('rejected', len(rows))
+            raise BufferFull(f"rating buffer is full ({RATING_BUFFER_MAX})")
+        self._count('enqueued', len(rows))
+        if int(size) >= RATING_FLUSH_BATCH:
+            self._wake.set()
+
+    # --- flusher ---
+
+    def _rejected(self, rows: List[Dict[str, Any]], errors: List[Optional[str]]) -> None:
+        rejected = []
+        for row, error in zip(rows, errors):
+            if error:
+                rejected.append(row)
+                print(f"❌ write-behind: оценка {row['artist_name']}/{row['user_id']} отклонена: {error}")
+        if not rejected:
+            return
+        self._count('dropped', len(rejected))
+        if self._on_rejected is not None:
+            try:
+                self._on_rejected(rejected)
+            except Exception as e:
+                print(f"⚠️ write-behind: откат отклонённых оценок не удался: {e}")
+
+    def flush(self) -> int:
+        """Один проход flusher'а; возвращает число обработанных (записанных и отклонённых) оценок"""
+        r = get_redis()
+        token = new_lock_token()
+        if r is None or not r.set(FLUSH_LOCK_KEY, token, nx=True, px=RATING_FLUSH_LOCK_MS):
+            return 0
+        try:
+            # processing остаётся от упавшего flusher'а — сначала дописываем его
+            if not r.exists(PROCESSING_KEY):
+                try:
+                    r.rename(PENDING_KEY, PROCESSING_KEY)
+                except RedisError:
+                    return 0  # pending пуст
+            batch = []
+            broken = []
+            for field, value in r.hgetall(PROCESSING_KEY).items():
+                try:
+                    batch.append((field, json.loads(value)))
+                except ValueError:
+                    broken.append(field)
+            if broken:
+                r.hdel(PROCESSING_KEY, *broken)
+            if not batch:
+                return 0
+            oldest = min(row.pop('t', time.time()) for _, row in batch)
+            done = 0
+            for i in range(0, len(batch), RATING_FLUSH_BATCH):
+                fields = [field for field, _ in batch[i:i + RATING_FLUSH_BATCH]]
+                rows = [row for _, row in batch[i:i + RATING_FLUSH_BATCH]]
+                try:
+                    errors = self._write_batch(rows)
+                except Exception as e:
+                    print(f"⚠️ write-behind: пакетная запись оценок не удалась: {e}")
+                    self._count('failed_flushes')
+                    # Записанные пачки уже удалены из processing; остаток вернёт только владелец замка
+                    if extend_lock(r, FLUSH_LOCK_KEY, token, RATING_FLUSH_LOCK_MS):
+                        r.eval(_RESTORE_SCRIPT, 2, PENDING_KEY, PROCESSING_KEY)
+                    return done
+                r.hdel(PROCESSING_KEY, *fields)
+                done += len(rows)
+                self._count('flushed', len(rows))
+                self._rejected(rows, errors)
+                if not extend_lock(r, FLUSH_LOCK_KEY, token, RATING_FLUSH_LOCK_MS):
+                    # Замок истёк и мог достаться другой реплике — остаток processing допишет она
+                    print("⚠️ write-behind: замок flusher'а потерян, прерываем проход")
+                    return done
+            lag_ms = int((time.time() - oldest) * 1000)
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['last_flush_at'] = time.time()
+                self._stats['last_flush_lag_ms'] = lag_ms
+                self._stats['max_flush_lag_ms'] = max(self._stats['max_flush_lag_ms'], lag_ms)
+            return done
+        finally:
+            release_lock(r, FLUSH_LOCK_KEY, token)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(RATING_FLUSH_INTERVAL_MS / 1000.0)
+            self._wake.clear()
+            try:
+                while self.flush() >= RATING_FLUSH_BATCH:
+                    pass
+            except (RedisError, OSError) as e:
+                print(f"⚠️ write-behind: Redis недоступен: {e}")
+                time.sleep(1)
+
+    def ensure_started(self) -> None:
+        """Поток flusher'а — по одному на процесс воркера; пишет только владелец замка"""
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        with self._lock:
+            if self._started_pid == pid:
+                return
+            self._started_pid = pid
+        threading.Thread(target=self._run, name='rating-writer', daemon=True).start()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+        out['enabled'] = self.enabled
+        r = get_redis()
+        if r is not None:
+            try:
+                out['pending'] = r.hlen(PENDING_KEY)
+                out['processing'] = r.hlen(PROCESSING_KEY)
+            except RedisError:
+                pass
+        return out
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Общий для реплик api1..api3 кэш поверх Redis (тот же, что у referrals/worker).
+TTL + stale-while-revalidate: устаревшее значение отдаётся сразу, а обновляет его
+один запрос в фоне; одновременные промахи схлопываются в один запрос к источнику.
+Без Redis кэш деградирует до памяти процесса.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    from redis import Redis
+    from redis.exceptions import RedisError
+except ImportError:  # redis не установлен — работаем только с памятью процесса
+    Redis = None
+
+    class RedisError(Exception):
+        pass
+
+REDIS_URL = os.environ.get('REDIS_URL', '')
+CACHE_PREFIX = os.environ.get('API_CACHE_PREFIX', 'gtm:api')
+
+_redis: Optional['Redis'] = None
+_redis_pid: Optional[int] = None
+_redis_lock = threading.Lock()
+
+
+def get_redis() -> Optional['Redis']:
+    """Redis-клиент текущего процесса или None, если REDIS_URL не задан"""
+    global _redis, _redis_pid
+    if not REDIS_URL or Redis is None:
+        return None
+    pid = os.getpid()
+    if _redis is None or _redis_pid != pid:
+        with _redis_lock:
+            if _redis is None or _redis_pid != pid:
+                _redis = Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2, health_check_interval=30)
+                _redis_pid = pid
+    return _redis
+
+
+# Замки в Redis: значение — случайный токен владельца. Снять или продлить замок можно,
+# только если он всё ещё наш: после истечения PX его мог взять другой процесс
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def new_lock_token() -> str:
+    return uuid.uuid4().hex
+
+
+def release_lock(r: 'Redis', key: str, token: str) -> bool:
+    """Снять замок, если он наш; False — замок уже чужой, истёк или Redis недоступен"""
+    try:
+        return bool(r.eval(_RELEASE_LOCK_SCRIPT, 1, key, token))
+    except RedisError:
+        return False
+
+
+def extend_lock(r: 'Redis', key: str, token: str, px: int) -> bool:
+    """Продлить свой замок на px мс; False — замок потерян"""
+    return bool(r.eval(_EXTEND_LOCK_SCRIPT, 1, key, token, int(px)))
+
+
+class SharedTTLCache:
+    """Кэш значений (JSON) с TTL, stale-while-revalidate и схлопыванием промахов"""
+
+    def __init__(self, namespace: str, ttl: float, stale_ttl: float, lock_ttl: float = 10.0, wait_timeout: float = 3.0):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.lock_ttl = lock_ttl
+        self.wait_timeout = wait_timeout
+        self._local: Dict[str, Tuple[float, Any]] = {}
+        self._local_locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+        self._refreshing: set = set()
+
+    def _key(self, key: str) -> str:
+        return f"{CACHE_PREFIX}:cache:{self.namespace}:{key}"
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._guard:
+            return self._local_locks.setdefault(key, threading.Lock())
+
+    # --- хранилище: Redis, при недоступности — память процесса ---
+
+    def _read(self, key: str) -> Optional[Tuple[float, Any]]:
+        r = get_redis()
+        if r is not None:
+            try:
+                raw = r.get(self._key(key))
+                if raw is None:
+                    return None
+                data = json.loads(raw)
+                return float(data['t']), data['v']
+            except (RedisError, ValueError, KeyError, TypeError):
+                pass
+        return self._local.get(key)
+
+    def _write(self, key: str, value: Any) -> None:
+        now = time.time()
+        self._local[key] = (now, value)
+        r = get_redis()
+        if r is not None:
+            try:
+                ex = max(1, int(self.ttl + self.stale_ttl))
+                r.set(self._key(key), json.dumps({'t': now, 'v': value}, ensure_ascii=False), ex=ex)
+            except RedisError as e:
+                print(f"⚠️ Redis недоступен для кэша {self.namespace}: {e}")
+
+    def _try_lock(self, key: str) -> Optional[str]:
+        """Кросс-репличная блокировка обновления (SET NX PX): токен владельца или None, если замок занят;
+        без Redis замок всегда свободен"""
+        token = new_lock_token()
+        r = get_redis()
+        if r is None:
+            return token
+        try:
+            return token if r.set(self._key(key) + ':lock', token, nx=True, px=int(self.lock_ttl * 1000)) else None
+        except RedisError:
+            return token
+
+    def _unlock(self, key: str, token: str) -> None:
+        r = get_redis()
+        if r is not None:
+            release_lock(r, self._key(key) + ':lock', token)
+
+    def invalidate(self, key: str) -> None:
+        self._local.pop(key, None)
+        r = get_redis()
+        if r is not None:
+            try:
+                r.delete(self._key(key))
+            except RedisError:
+                pass
+
+    # --- чтение ---
+
+    def _refresh(self, key: str, fetch: Callable[[], Any], token: str) -> Any:
+        try:
+            value = fetch()
+            if value is not None:
+                self._write(key, value)
+            return value
+        finally:
+            self._unlock(key, token)
+
+    def _refresh_in_background(self, key: str, fetch: Callable[[], Any]) -> None:
+        with self._guard:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        token = self._try_lock(key)
+        if token is None:
+            with self._guard:
+                self._refreshing.discard(key)
+            return
+
+        def run():
+            try:
+                self._refresh(key, fetch, token)
+            except Exception as e:
+                print(f"⚠️ Фоновое обновление кэша {self.namespace}:{key} не удалось: {e}")
+            finally:
+                with self._guard:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name=f"cache-refresh-{self.namespace}", daemon=True).start()
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any]) -> Any:
+        """Вернуть значение из кэша; fetch() вызывается не более одного раза на все реплики.
+        None из fetch() не кэшируется; исключения fetch() пробрасываются вызывающему.
+        """
+        entry = self._read(key)
+        if entry is not None:
+            stored_at, value = entry
+            if time.time() - stored_at >= self.ttl:
+                self._refresh_in_background(key, fetch)
+            return value
+
+        # Промах: внутри процесса ждём на локальном замке, между репликами — на Redis-замке
+        with self._key_lock(key):
+            entry = self._read(key)
+            if entry is not None:
+                return entry[1]
+            token = self._try_lock(key)
+            if token is not None:
+                return self._refresh(key, fetch, token)
+            deadline = time.monotonic() + self.wait_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                entry = self._read(key)
+                if entry is not None:
+                    return entry[1]
+            # Владелец замка не успел — идём к источнику сами
+            value = fetch()
+            if value is not None:
+                self._write(key, value)
+            return value
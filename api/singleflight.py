@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Single-flight для горячих запросов к Supabase: одновременные одинаковые запросы
+(ключ = апстрим-запрос) ждут один общий ответ вместо собственных round trip.
+Внутри процесса — всегда; между репликами — опционально через Redis
+(SINGLEFLIGHT_REDIS=1): лидер берёт SET NX замок и кладёт результат на короткое время.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from shared_cache import CACHE_PREFIX, RedisError, get_redis, new_lock_token, release_lock
+
+SINGLEFLIGHT_REDIS = os.environ.get('SINGLEFLIGHT_REDIS', '0') == '1'
+# Сколько живёт общий результат лидера в Redis (мс) и сколько ждут его другие реплики (с)
+SINGLEFLIGHT_RESULT_TTL_MS = int(os.environ.get('SINGLEFLIGHT_RESULT_TTL_MS', '1000'))
+SINGLEFLIGHT_WAIT = float(os.environ.get('SINGLEFLIGHT_WAIT', '5'))
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self, name: str, shared: bool = SINGLEFLIGHT_REDIS,
+                 result_ttl_ms: int = SINGLEFLIGHT_RESULT_TTL_MS, wait_timeout: float = SINGLEFLIGHT_WAIT):
+        self.name = name
+        self.shared = shared
+        self.result_ttl_ms = result_ttl_ms
+        self.wait_timeout = wait_timeout
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'executions': 0, 'coalesced_local': 0, 'coalesced_shared': 0}
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Выполнить fn() один раз на все одновременные вызовы с тем же key.
+        Исключение лидера получают и ожидающие в этом процессе.
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self._stats['coalesced_local'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run(key, fn) if self.shared else self._execute(fn)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    def _execute(self, fn: Callable[[], Any]) -> Any:
+        self._count('executions')
+        return fn()
+
+    def _run(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Межрепличный уровень: результат должен сериализоваться в JSON"""
+        r = get_redis()
+        if r is None:
+            return self._execute(fn)
+        base = f"{CACHE_PREFIX}:sf:{self.name}:{key}"
+        try:
+            raw = r.get(base + ':result')
+            if raw is not None:
+                self._count('coalesced_shared')
+                return json.loads(raw)
+            token = new_lock_token()
+            if not r.set(base + ':lock', token, nx=True, px=int(self.wait_timeout * 1000)):
+                deadline = time.monotonic() + self.wait_timeout
+                while time.monotonic() < deadline:
+                    time.sleep(0.02)
+                    raw = r.get(base + ':result')
+                    if raw is not None:
+                        self._count('coalesced_shared')
+                        return json.loads(raw)
+                    if not r.exists(base + ':lock'):
+                        break
+                # Лидер другой реплики упал или не уложился — выполняем сами
+                return self._execute(fn)
+        except (RedisError, ValueError):
+            return self._execute(fn)
+        try:
+            result = self._execute(fn)
+            try:
+                r.set(base + ':result', json.dumps(result, ensure_ascii=False), px=self.result_ttl_ms)
+            except (RedisError, TypeError, ValueError):
+                pass
+            return result
+        finally:
+            release_lock(r, base + ':lock', token)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+            s['in_flight'] = len(self._calls)
+        coalesced = s['coalesced_local'] + s['coalesced_shared']
+        s['coalescing_ratio'] = round(coalesced / s['calls'], 4) if s['calls'] else 0.0
+        s['shared'] = self.shared
+        return s
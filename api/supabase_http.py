@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Общий HTTP-клиент Supabase REST для Rating API.
+Один клиент на процесс воркера gunicorn: пул keep-alive соединений размером
+с число потоков воркера и повтор запросов с jitter-паузой на 5xx/обрывах.
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Размер пула = числу потоков воркера gunicorn (--threads), иначе потоки ждут соединение
+SUPABASE_POOL_SIZE = int(os.environ.get('SUPABASE_POOL_SIZE', os.environ.get('GUNICORN_THREADS', '4')))
+SUPABASE_RETRIES = int(os.environ.get('SUPABASE_RETRIES', '2'))
+SUPABASE_BACKOFF_BASE = float(os.environ.get('SUPABASE_BACKOFF_BASE', '0.2'))
+SUPABASE_BACKOFF_MAX = float(os.environ.get('SUPABASE_BACKOFF_MAX', '2.0'))
+
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class SupabaseHTTP:
+    """Клиент PostgREST поверх requests.Session с пулом соединений и повторами"""
+
+    def __init__(self, base_url: str, headers: Dict[str, str], pool_size: int = SUPABASE_POOL_SIZE,
+                 retries: int = SUPABASE_RETRIES, backoff_base: float = SUPABASE_BACKOFF_BASE,
+                 backoff_max: float = SUPABASE_BACKOFF_MAX):
+        self.rest_url = f"{base_url}/rest/v1"
+        self.retries = max(0, retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = max(1, pool_size)
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        # Повторы делаем сами (с jitter), urllib3 только держит соединения
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'errors': 0}
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _backoff(self, attempt: int) -> float:
+        # "full jitter": случайная пауза в [0, min(max, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method: str, endpoint: str, params: Optional[Dict[str, Any]] = None, json: Any = None,
+                headers: Optional[Dict[str, str]] = None, timeout: float = 20,
+                retry: Optional[bool] = None) -> requests.Response:
+        """Выполнить запрос к /rest/v1/<endpoint>.
+        retry=None: повторяем только идемпотентные методы; для POST/PATCH повтор включается явно
+        (upsert с merge-duplicates и т.п.), иначе обрыв после отправки может задвоить запись.
+        """
+        method = method.upper()
+        if retry is None:
+            retry = method in IDEMPOTENT_METHODS
+        max_attempts = self.retries if retry else 0
+        url = f"{self.rest_url}/{endpoint}"
+        attempt = 0
+        while True:
+            self._count('requests')
+            try:
+                resp = self.session.request(method, url, params=params, json=json, headers=headers, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                self._count('errors')
+                if attempt >= max_attempts:
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt >= max_attempts:
+                    return resp
+                self._count('errors')
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+            self._count('retries')
+
+    def get(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('POST', endpoint, **kwargs)
+
+    def patch(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('PATCH', endpoint, **kwargs)
+
+    def delete(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', endpoint, **kwargs)
+
+    def head(self, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('HEAD', endpoint, **kwargs)
+
+    def rpc(self, name: str, body: Optional[Dict[str, Any]] = None, **kwargs) -> requests.Response:
+        return self.request('POST', f"rpc/{name}", json=body or {}, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика пула: miss = новое TCP+TLS соединение, hit = запрос по уже открытому"""
+        created = 0
+        served = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            created += getattr(pool, 'num_connections', 0)
+            served += getattr(pool, 'num_requests', 0)
+        with self._stats_lock:
+            counters = dict(self._stats)
+        return {
+            'pid': os.getpid(),
+            'pool_size': self.pool_size,
+            'pool_hits': max(0, served - created),
+            'pool_misses': created,
+            **counters,
+        }
+
+
+_client: Optional[SupabaseHTTP] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+
+def get_supabase(base_url: str, headers: Dict[str, str]) -> SupabaseHTTP:
+    """Клиент текущего процесса (после fork воркера создаётся заново — сокеты не делятся между процессами)"""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = SupabaseHTTP(base_url, headers)
+                _client_pid = pid
+    return _client
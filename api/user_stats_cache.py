@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Read-through кэш счётчиков билетов пользователя (user_stats).
+Уровни: память процесса -> Redis -> Supabase. Воркер referrals после каждого
+_patch_users пишет свежие счётчики в Redis и публикует событие в канал;
+подписчик в каждом воркере gunicorn обновляет память процесса по событию.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from shared_cache import RedisError, get_redis
+
+# Ключи/канал общие с referrals/common.py и bot/supabase_client.py
+USER_STATS_PREFIX = os.environ.get('USER_STATS_PREFIX', 'gtm:user_stats')
+USER_STATS_CHANNEL = os.environ.get('USER_STATS_CHANNEL', 'gtm:user_stats:events')
+USER_STATS_TTL = int(os.environ.get('USER_STATS_TTL', '3600'))
+# Память процесса — страховка на случай пропущенного события pub/sub
+USER_STATS_LOCAL_TTL = float(os.environ.get('USER_STATS_LOCAL_TTL', '30'))
+USER_STATS_LOCAL_MAX = int(os.environ.get('USER_STATS_LOCAL_MAX', '10000'))
+
+STATS_FIELDS = ('total_tickets', 'subscription_tickets', 'referral_tickets', 'referral_code')
+STATS_COLUMNS = ','.join(STATS_FIELDS)
+
+
+def stats_from_row(row: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    row = row or {}
+    return {
+        'total_tickets': row.get('total_tickets', 0) or 0,
+        'subscription_tickets': row.get('subscription_tickets', 0) or 0,
+        'referral_tickets': row.get('referral_tickets', 0) or 0,
+        'referral_code': row.get('referral_code', '') or '',
+    }
+
+
+class UserStatsCache:
+    """loader(telegram_id) -> строка users или None (пользователя нет); исключения пробрасываются"""
+
+    def __init__(self, loader: Callable[[int], Optional[Dict[str, Any]]]):
+        self._loader = loader
+        self._local: 'OrderedDict[int, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener_pid: Optional[int] = None
+
+    def _key(self, telegram_id: int) -> str:
+        return f"{USER_STATS_PREFIX}:{int(telegram_id)}"
+
+    def _remember(self, telegram_id: int, stats: Optional[Dict[str, Any]]) -> None:
+        with self._lock:
+            if stats is None:
+                self._local.pop(telegram_id, None)
+                return
+            self._local[telegram_id] = (time.monotonic(), stats)
+            self._local.move_to_end(telegram_id)
+            while len(self._local) > USER_STATS_LOCAL_MAX:
+                self._local.popitem(last=False)
+
+    def _local_get(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._local.get(telegram_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= USER_STATS_LOCAL_TTL:
+                self._local.pop(telegram_id, None)
+                return None
+            return entry[1]
+
+    def get(self, telegram_id: int) -> Dict[str, Any]:
+        telegram_id = int(telegram_id)
+        self.ensure_listener()
+        stats = self._local_get(telegram_id)
+        if stats is not None:
+            return stats
+        r = get_redis()
+        if r is not None:
+            try:
+                raw = r.get(self._key(telegram_id))
+                if raw is not None:
+                    stats = json.loads(raw)
+                    self._remember(telegram_id, stats)
+                    return stats
+            except (RedisError, ValueError) as e:
+                print(f"⚠️ user_stats: Redis недоступен: {e}")
+        stats = stats_from_row(self._loader(telegram_id))
+        self._remember(telegram_id, stats)
+        if r is not None:
+            try:
+                # NX: свежие данные от воркера не перетираем прочитанными ранее
+                r.set(self._key(telegram_id), json.dumps(stats, ensure_ascii=False), ex=USER_STATS_TTL, nx=True)
+            except RedisError:
+                pass
+        return stats
+
+    def put(self, telegram_id: int, row: Optional[Dict[str, Any]]) -> None:
+        """Записать свежую строку users (после собственного PATCH/INSERT) и оповестить реплики;
+        row=None — сбросить запись"""
+        telegram_id = int(telegram_id)
+        stats = stats_from_row(row) if row is not None else None
+        self._remember(telegram_id, stats)
+        r = get_redis()
+        if r is None:
+            return
+        try:
+            if stats is None:
+                r.delete(self._key(telegram_id))
+            else:
+                r.set(self._key(telegram_id), json.dumps(stats, ensure_ascii=False), ex=USER_STATS_TTL)
+            r.publish(USER_STATS_CHANNEL, json.dumps({'telegram_id': telegram_id, 'stats': stats}, ensure_ascii=False))
+        except RedisError as e:
+            print(f"⚠️ user_stats: не удалось опубликовать обновление {telegram_id}: {e}")
+
+    def invalidate(self, telegram_id: int) -> None:
+        self.put(telegram_id, None)
+
+    def _apply_event(self, data: Any) -> None:
+        try:
+            event = json.loads(data)
+            self._remember(int(event['telegram_id']), event.get('stats'))
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    def _listen(self) -> None:
+        while True:
+            r = get_redis()
+            if r is None:
+                return
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(USER_STATS_CHANNEL)
+                # После (пере)подключения события могли потеряться — сбрасываем память
+                with self._lock:
+                    self._local.clear()
+                while True:
+                    # get_message с таймаутом: тишина в канале не считается обрывом (socket_timeout клиента)
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message.get('type') == 'message':
+                        self._apply_event(message.get('data'))
+            except (RedisError, OSError) as e:
+                print(f"⚠️ user_stats: подписка на события прервана: {e}")
+                time.sleep(1)
+
+    def ensure_listener(self) -> None:
+        """Подписчик pub/sub — по одному на процесс воркера (потоки не переживают fork)"""
+        pid = os.getpid()
+        if self._listener_pid == pid or get_redis() is None:
+            return
+        with self._lock:
+            if self._listener_pid == pid:
+                return
+            self._listener_pid = pid
+        threading.Thread(target=self._listen, name='user-stats-listener', daemon=True).start()
@@ -3,17 +3,19 @@
 aiogram GTM Telegram Bot с Supabase интеграцией (без Router, регистрация напрямую на Dispatcher)
 """
 import os
+import sys
 import asyncio
 import logging
 import random
 import string
 from datetime import datetime
 import time
-from typing import List
+from typing import Dict, List, Set, Tuple
 
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
+    ChatMemberUpdated,
     Message,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -21,13 +23,33 @@ from aiogram.types import (
 )
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramNetworkError
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 
 from supabase_client import supabase_client
 import aiohttp
 from supabase_config import validate_supabase_config
 
+try:
+    from shared.tg_membership import (
+        MODE_REPORT, STATUS_ERROR, AsyncMembershipChecker, MembershipCache, MembershipLedger,
+        GIVEAWAY_ELIGIBILITY_KEY, eligibility_entry, get_subscription_channels, is_member_status,
+    )
+    from shared.tg_ratelimit import LANE_INTERACTIVE, TelegramRateLimiter
+except ImportError:  # запуск из исходников: shared/ лежит в корне репозитория
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from shared.tg_membership import (
+        MODE_REPORT, STATUS_ERROR, AsyncMembershipChecker, MembershipCache, MembershipLedger,
+        GIVEAWAY_ELIGIBILITY_KEY, eligibility_entry, get_subscription_channels, is_member_status,
+    )
+    from shared.tg_ratelimit import LANE_INTERACTIVE, TelegramRateLimiter
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # без redis ответы Telegram не кэшируются
+    aioredis = None
+
 load_dotenv()
 
 logging.basicConfig(
@@ -44,25 +66,66 @@ WEBAPP_VERSION = os.getenv('WEBAPP_VERSION', '')
 ADMIN_ID = int(os.getenv('ADMIN_ID', '6358105675'))
 LOG_CHAT_ID = int(os.getenv('TELEGRAM_LOG_CHAT_ID', '0'))
 REFERRALS_API_URL = os.getenv('REFERRALS_API_URL', 'http://referrals_api:8000')
-
-# 9 каналов
-SUBSCRIPTION_CHANNELS: List[dict] = [
-    {'channel_id': -1002088959587, 'channel_username': 'rejmenyavseryoz', 'channel_name': 'Режь меня всерьёз'},
-    {'channel_id': -1001971855072, 'channel_username': 'chchndra_tattoo', 'channel_name': 'Чучундра'},
-    {'channel_id': -1002133674248, 'channel_username': 'naidenka_tattoo', 'channel_name': 'naidenka_tattoo'},
-    {'channel_id': -1001508215942, 'channel_username': 'l1n_ttt', 'channel_name': 'Lin++'},
-    {'channel_id': -1001555462429, 'channel_username': 'murderd0lll', 'channel_name': 'MurderdOll'},
-    {'channel_id': -1002132954014, 'channel_username': 'poteryashkatattoo', 'channel_name': 'Потеряшка'},
-    {'channel_id': -1001689395571, 'channel_username': 'EMI3MO', 'channel_name': 'EMI'},
-    {'channel_id': -1001767997947, 'channel_username': 'bloodivamp', 'channel_name': 'bloodivamp'},
-    {'channel_id': -1001973736826, 'channel_username': 'G_T_MODEL', 'channel_name': 'Gothams top model'},
-]
+REDIS_URL = os.getenv('REDIS_URL', '')
+
+# Каналы для подписки (общий список сервисов; переопределяется SUBSCRIPTION_CHANNELS_JSON)
+SUBSCRIPTION_CHANNELS: List[dict] = get_subscription_channels()
+_membership_redis = None
+
+
+def _get_membership_redis():
+    global _membership_redis
+    if _membership_redis is None and REDIS_URL and aioredis is not None:
+        _membership_redis = aioredis.from_url(REDIS_URL, socket_connect_timeout=2)
+    return _membership_redis
+
+
+# Реестр подписок из апдейтов chat_member (бот — админ каналов): проверка — это SISMEMBER в Redis,
+# getChatMember остаётся только для пар (пользователь, канал), которых реестр ещё не видел
+membership_cache = MembershipCache(_get_membership_redis)
+ledger = MembershipLedger(_get_membership_redis)
+LEDGER_FLUSH_INTERVAL = float(os.getenv('MEMBERSHIP_LEDGER_FLUSH_INTERVAL', '1'))
+LEDGER_BATCH_SIZE = int(os.getenv('MEMBERSHIP_LEDGER_BATCH_SIZE', '500'))
+LEDGER_ADMIN_RECHECK = float(os.getenv('MEMBERSHIP_LEDGER_ADMIN_RECHECK', '600'))
+
+# Общий для всех сервисов лимитер Telegram Bot API (один токен на API, воркер, бота и скрипты)
+telegram_limiter = TelegramRateLimiter(_get_membership_redis)
+
+# Все каналы проверяются параллельно через одну aiohttp-сессию; ответы по (пользователь, канал)
+# кэшируются в Redis вместе с API и воркером, повторный /check не идёт в Telegram
+membership = AsyncMembershipChecker(TELEGRAM_BOT_TOKEN, SUBSCRIPTION_CHANNELS, cache=membership_cache, ledger=ledger,
+                                    limiter=telegram_limiter)
+
+
+class TelegramRateMiddleware(BaseRequestMiddleware):
+    """Каждый запрос aiogram берёт токен из общих бакетов (getUpdates не ограничивается);
+    429 ставит на паузу весь кластер, запрос повторяется после паузы"""
+
+    def __init__(self, limiter: TelegramRateLimiter, lane: str = LANE_INTERACTIVE, attempts: int = 3):
+        self.limiter = limiter
+        self.lane = lane
+        self.attempts = attempts
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        chat_id = getattr(method, 'chat_id', None)
+        chat_id = chat_id if isinstance(chat_id, int) else None
+        for attempt in range(self.attempts):
+            # Не дождались токена — всё равно отправляем: ответ пользователю важнее
+            await self.limiter.aacquire(name, chat_id, self.lane)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt + 1 >= self.attempts or not await self.limiter.apause(e.retry_after):
+                    raise
+                logger.warning(f"Telegram 429 на {name}: пауза кластера {e.retry_after} c")
 
 if not validate_supabase_config():
     logger.error("❌ Неверная конфигурация Supabase")
 
 # Кастомная HTTP-сессия aiogram с числовым таймаутом (во избежание TypeError при сложении)
 session = AiohttpSession(timeout=20)
+session.middleware(TelegramRateMiddleware(telegram_limiter))
 bot = Bot(token=TELEGRAM_BOT_TOKEN, session=session)
 
 
@@ -204,8 +267,8 @@ async def cmd_check(message: Message):
 
     # Если уже есть билет за папку — не дергаем Telegram API лишний раз
     try:
-        u = await supabase_client.get_user(user.id)
-        if u and int(u.get('subscription_tickets') or 0) > 0:
+        u = await supabase_client.get_user_stats(user.id)
+        if int(u.get('subscription_tickets') or 0) > 0:
             result = await supabase_client.check_subscription_and_award_ticket(user.id, True)
             total_user = result.get('total_tickets', 0)
             total_all = await supabase_client.get_total_tickets()
@@ -214,7 +277,23 @@ async def cmd_check(message: Message):
     except Exception:
         pass
 
-    # Быстрый ответ и постановка тяжёлой проверки в очередь
+    # Быстрая проверка всех каналов разом: если точно не хватает подписок — отвечаем сразу,
+    # без очереди; начисление билета (с повторной проверкой) остаётся за воркером
+    try:
+        report = await membership.check(user.id, MODE_REPORT)
+        statuses = report['channels']
+        if not report['subscribed'] and STATUS_ERROR not in statuses.values():
+            missing = [ch for ch in SUBSCRIPTION_CHANNELS if int(ch['channel_id']) in report['not_subscribed']]
+            names = "\n".join(f"• {ch.get('channel_name') or ch.get('channel_username')}" for ch in missing)
+            await message.answer(
+                f"⚠️ Не хватает подписок ({len(missing)}/{len(SUBSCRIPTION_CHANNELS)}):\n{names}\n\n"
+                f"📁 Подпишитесь на папку: {TELEGRAM_FOLDER_LINK}"
+            )
+            return
+    except Exception as e:
+        logger.warning(f"Быстрая проверка подписок не удалась: {e}")
+
+    # Постановка начисления билета в очередь
     await message.answer("⏱️ Запустил проверку подписок в фоне. Я напишу, как только закончу.")
     try:
         async with aiohttp.ClientSession() as s:
@@ -242,16 +321,8 @@ async def cmd_folder(message: Message):
         "📁 Telegram папка GTM\n\n"
         f"🔗 Ссылка на папку: {TELEGRAM_FOLDER_LINK}\n\n"
         "📋 В папке собраны все каналы GTM:\n"
-        "• Режь меня всерьёз\n"
-        "• Чучундра\n"
-        "• naidenka_tattoo\n"
-        "• Lin++\n"
-        "• MurderdOll\n"
-        "• Потеряшка\n"
-        "• EMI\n"
-        "• bloodivamp\n"
-        "• Gothams top model\n\n"
-        "🎫 Подпишитесь на папку для получения билетов!"
+        + "".join(f"• {ch.get('channel_name') or ch.get('channel_username')}\n" for ch in SUBSCRIPTION_CHANNELS)
+        + "\n🎫 Подпишитесь на папку для получения билетов!"
     )
     await message.answer(text)
 
@@ -319,7 +390,130 @@ async def handle_any_message(message: Message):
     logger.info(f"Update received: chat={message.chat.id} text={message.text!r}")
     await message.answer("🔹 Напишите /start, чтобы начать работу с ботом")
 
+# Вступления/выходы, ещё не записанные в реестр: последнее событие по паре (пользователь, канал)
+_ledger_pending: Dict[Tuple[int, int], str] = {}
+_ledger_wakeup = asyncio.Event()
+
+
+def _chat_member_status(member) -> str:
+    status = getattr(member.status, 'value', member.status)
+    # restricted-пользователь всё ещё может состоять в канале
+    if status == 'restricted' and getattr(member, 'is_member', False):
+        return 'member'
+    return str(status)
+
+
+async def on_chat_member(event: ChatMemberUpdated):
+    """Апдейт chat_member из канала GTM: копим в буфер, пишет его _ledger_flusher пачками"""
+    user = event.new_chat_member.user
+    if user.is_bot:
+        return
+    _ledger_pending[(int(user.id), int(event.chat.id))] = _chat_member_status(event.new_chat_member)
+    if len(_ledger_pending) >= LEDGER_BATCH_SIZE:
+        _ledger_wakeup.set()
+
+
+async def _flush_ledger() -> None:
+    global _ledger_pending
+    if not _ledger_pending:
+        return
+    batch, _ledger_pending = _ledger_pending, {}
+    if not await ledger.aapply(batch):
+        # Redis недоступен — вернём пачку, не затирая более свежие события
+        for pair, status in batch.items():
+            _ledger_pending.setdefault(pair, status)
+        logger.warning(f"Реестр подписок: не удалось записать {len(batch)} событий, повторим")
+        return
+    channels = {int(ch['channel_id']): ch for ch in SUBSCRIPTION_CHANNELS}
+    joined: List[dict] = []
+    left: Dict[int, List[int]] = {}
+    for (tid, cid), status in batch.items():
+        # Кэш getChatMember тоже обновляем: он отвечает, когда реестр канала не в строю
+        await membership_cache.aput(tid, cid, status)
+        if is_member_status(status):
+            ch = channels.get(cid, {})
+            joined.append({
+                'telegram_id': tid,
+                'channel_id': cid,
+                'channel_name': ch.get('channel_name', ''),
+                'channel_username': ch.get('channel_username', ''),
+            })
+        else:
+            left.setdefault(cid, []).append(tid)
+    await _refresh_eligibility(batch)
+    if not await supabase_client.apply_subscription_changes(joined, left):
+        logger.warning("Реестр подписок: таблица subscriptions обновлена не полностью")
+    logger.info(f"📒 Реестр подписок: +{len(joined)} / -{sum(len(v) for v in left.values())}")
+
+
+async def _refresh_eligibility(batch: Dict[Tuple[int, int], str]) -> None:
+    """Индекс допуска к розыгрышу (GIVEAWAY_ELIGIBILITY_KEY) для пользователей из пачки: вышел из
+    канала — не подписан; по реестру состоит во всех каналах — подписан; иначе запись снимается,
+    и пользователя решит живая проверка"""
+    r = _get_membership_redis()
+    if r is None:
+        return
+    channel_ids = [int(ch['channel_id']) for ch in SUBSCRIPTION_CHANNELS]
+    users = {tid for tid, _ in batch}
+    known = await ledger.aget_many((tid, cid) for tid in users for cid in channel_ids)
+    known.update(batch)  # сами события достовернее реестра, даже если его heartbeat истёк
+    now = time.time()
+    try:
+        pipe = r.pipeline(transaction=False)
+        for tid in users:
+            statuses = [known.get((tid, cid)) for cid in channel_ids]
+            if any(st is not None and not is_member_status(st) for st in statuses):
+                pipe.hset(GIVEAWAY_ELIGIBILITY_KEY, str(tid), eligibility_entry(False, now))
+            elif all(st is not None for st in statuses):
+                pipe.hset(GIVEAWAY_ELIGIBILITY_KEY, str(tid), eligibility_entry(True, now))
+            else:
+                pipe.hdel(GIVEAWAY_ELIGIBILITY_KEY, str(tid))
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Реестр подписок: не удалось обновить индекс допуска: {e}")
+
+
+async def _ledger_channels() -> Set[int]:
+    """Каналы, где бот — администратор: только из них приходят апдейты chat_member"""
+    me = await bot.get_me()
+    out: Set[int] = set()
+    for ch in SUBSCRIPTION_CHANNELS:
+        try:
+            member = await bot.get_chat_member(int(ch['channel_id']), me.id)
+            if getattr(member.status, 'value', member.status) in ('administrator', 'creator'):
+                out.add(int(ch['channel_id']))
+        except Exception as e:
+            logger.warning(f"Реестр подписок: нет доступа к каналу {ch['channel_id']}: {e}")
+    return out
+
+
+async def _ledger_flusher():
+    """Пишет буфер в реестр раз в LEDGER_FLUSH_INTERVAL (или по заполнении пачки) и продлевает
+    heartbeat каналов, из которых бот получает апдейты; без heartbeat API/воркер реестру не верят"""
+    channels: Set[int] = set()
+    checked_at = 0.0
+    while True:
+        try:
+            await asyncio.wait_for(_ledger_wakeup.wait(), timeout=LEDGER_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _ledger_wakeup.clear()
+        try:
+            if time.monotonic() - checked_at > LEDGER_ADMIN_RECHECK:
+                channels = await _ledger_channels()
+                checked_at = time.monotonic()
+                logger.info(f"📒 Реестр подписок ведётся по {len(channels)}/{len(SUBSCRIPTION_CHANNELS)} каналам")
+            await _flush_ledger()
+            await ledger.aheartbeat(channels)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Реестр подписок: ошибка записи: {e}")
+
+
 def register_handlers(dp: Dispatcher):
+    channel_ids = [int(ch['channel_id']) for ch in SUBSCRIPTION_CHANNELS]
+    dp.chat_member.register(on_chat_member, F.chat.id.in_(channel_ids))
     dp.message.register(cmd_start, Command("start"))
     dp.message.register(cmd_start_text, F.text.casefold() == "start")
     dp.message.register(cmd_check, Command("check"))
@@ -337,12 +531,19 @@ async def main():
         raise RuntimeError("TELEGRAM_BOT_TOKEN not set")
     dp = Dispatcher()
     register_handlers(dp)
+    # Кэш статистики пользователей обновляется событиями воркера referrals
+    stats_listener = asyncio.create_task(supabase_client.run_user_stats_listener())
     logger.info("🚀 Запуск GTM Supabase aiogram Bot...")
-    # На всякий случай удаляем вебхук, чтобы гарантировать polling
+    # На всякий случай удаляем вебхук, чтобы гарантировать polling, и сбрасываем накопившиеся апдейты
     try:
         await bot.delete_webhook(drop_pending_updates=True)
     except Exception as e:
         logger.warning(f"Не удалось удалить webhook перед polling: {e}")
+    # Вместе с ними пропали вступления/выходы за время простоя: реестр подписок собирается заново
+    # из новых событий и живых проверок (свип воркера, /check), до тех пор ему не верят
+    if not await ledger.areset(int(ch['channel_id']) for ch in SUBSCRIPTION_CHANNELS):
+        logger.warning("Реестр подписок: не удалось сбросить реестр после простоя")
+    ledger_flusher = asyncio.create_task(_ledger_flusher())
     # Информируем админ-чат о запуске бота
     try:
         await log_to_admin("🚀 Бот запущен и перешёл на polling")
@@ -360,7 +561,15 @@ async def main():
         ])
     except Exception as e:
         logger.warning(f"Не удалось установить команды бота: {e}")
-    await dp.start_polling(bot, polling_timeout=20)
+    try:
+        # chat_member приходит только если запрошен явно
+        await dp.start_polling(bot, polling_timeout=20, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        stats_listener.cancel()
+        ledger_flusher.cancel()
+        await asyncio.gather(stats_listener, ledger_flusher, return_exceptions=True)
+        await _flush_ledger()
+        await membership.close()
 
 
 if __name__ == "__main__":
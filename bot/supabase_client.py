@@ -9,14 +9,39 @@ import logging
 import aiohttp
 import json
 import asyncio
+import time
 import requests
+from collections import OrderedDict
 from typing import Dict, List, Optional
 from dotenv import load_dotenv
 
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # без redis кэш статистики живёт только в памяти процесса
+    aioredis = None
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Общий кэш счётчиков билетов (ключи/канал как в referrals/common.py и api/user_stats_cache.py)
+REDIS_URL = os.getenv('REDIS_URL', '')
+USER_STATS_PREFIX = os.getenv('USER_STATS_PREFIX', 'gtm:user_stats')
+USER_STATS_CHANNEL = os.getenv('USER_STATS_CHANNEL', 'gtm:user_stats:events')
+USER_STATS_TTL = int(os.getenv('USER_STATS_TTL', '3600'))
+USER_STATS_LOCAL_TTL = float(os.getenv('USER_STATS_LOCAL_TTL', '30'))
+USER_STATS_LOCAL_MAX = int(os.getenv('USER_STATS_LOCAL_MAX', '10000'))
+
+
+def _stats_from_user(user: Optional[Dict]) -> Dict:
+    user = user or {}
+    return {
+        'subscription_tickets': user.get('subscription_tickets', 0) or 0,
+        'referral_tickets': user.get('referral_tickets', 0) or 0,
+        'total_tickets': user.get('total_tickets', 0) or 0,
+        'referral_code': user.get('referral_code', '') or ''
+    }
+
 class SupabaseClient:
     def __init__(self, use_service_role: bool = False):
         self.base_url = os.getenv('SUPABASE_URL')
@@ -34,14 +59,83 @@ class SupabaseClient:
         # Общая aiohttp-сессия (не используется в текущем варианте _make_request, оставлена для совместимости)
         # Не создаём aiohttp-сессию, чтобы не было предупреждений об утечках, используем requests в _make_request
         self._session = None
+        # Кэш статистики пользователей: память процесса -> Redis -> Supabase
+        self._redis = None
+        self._stats_local: 'OrderedDict[int, tuple]' = OrderedDict()
+
+    def _get_redis(self):
+        if self._redis is None and REDIS_URL and aioredis is not None:
+            self._redis = aioredis.from_url(REDIS_URL, socket_connect_timeout=2)
+        return self._redis
+
+    def _remember_stats(self, telegram_id: int, stats: Optional[Dict]) -> None:
+        if stats is None:
+            self._stats_local.pop(telegram_id, None)
+            return
+        self._stats_local[telegram_id] = (time.monotonic(), stats)
+        self._stats_local.move_to_end(telegram_id)
+        while len(self._stats_local) > USER_STATS_LOCAL_MAX:
+            self._stats_local.popitem(last=False)
+
+    async def _publish_user_row(self, telegram_id: int, result) -> None:
+        """Обновить общий кэш статистики по ответу PATCH/POST users (return=representation)"""
+        if isinstance(result, dict) and result.get('error'):
+            return
+        row = result[0] if isinstance(result, list) and result else None
+        stats = _stats_from_user(row) if row is not None else None
+        self._remember_stats(int(telegram_id), stats)
+        r = self._get_redis()
+        if r is None:
+            return
+        key = f"{USER_STATS_PREFIX}:{int(telegram_id)}"
+        try:
+            if stats is None:
+                await r.delete(key)
+            else:
+                await r.set(key, json.dumps(stats, ensure_ascii=False), ex=USER_STATS_TTL)
+            await r.publish(USER_STATS_CHANNEL, json.dumps({'telegram_id': int(telegram_id), 'stats': stats}, ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"user_stats: не удалось обновить кэш {telegram_id}: {e}")
+
+    async def run_user_stats_listener(self) -> None:
+        """Подписка на события воркера referrals: обновляет память процесса сразу после начисления"""
+        r = self._get_redis()
+        if r is None:
+            return
+        while True:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(USER_STATS_CHANNEL)
+                # После (пере)подключения события могли потеряться
+                self._stats_local.clear()
+                async for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    try:
+                        event = json.loads(message.get('data'))
+                        self._remember_stats(int(event['telegram_id']), event.get('stats'))
+                    except Exception:
+                        continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"user_stats: подписка прервана: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
     
-    async def _make_request(self, method: str, endpoint: str, data: Dict = None, params: Dict = None) -> Dict:
+    async def _make_request(self, method: str, endpoint: str, data=None, params: Dict = None,
+                            headers: Dict = None) -> Dict:
         """Выполнить HTTP запрос к Supabase через requests в отдельном потоке (устраняет ошибки async-timeout)."""
         url = f"{self.base_url}/rest/v1/{endpoint}"
+        request_headers = {**self.headers, **(headers or {})}
 
         def do_request():
             try:
-                resp = requests.request(method.upper(), url, headers=self.headers, json=data, params=params, timeout=20)
+                resp = requests.request(method.upper(), url, headers=request_headers, json=data, params=params, timeout=20)
                 status = resp.status_code
                 text = resp.text or ''
                 if 200 <= status < 300:
@@ -62,7 +156,10 @@ class SupabaseClient:
     
     async def create_user(self, user_data: Dict) -> Dict:
         """Создание пользователя"""
-        return await self._make_request('POST', 'users', user_data)
+        result = await self._make_request('POST', 'users', user_data)
+        if user_data.get('telegram_id') is not None:
+            await self._publish_user_row(user_data['telegram_id'], result)
+        return result
     
     async def get_user(self, telegram_id: int) -> Optional[Dict]:
         """Получение пользователя по telegram_id"""
@@ -73,7 +170,9 @@ class SupabaseClient:
     
     async def update_user(self, telegram_id: int, user_data: Dict) -> Dict:
         """Обновление пользователя"""
-        return await self._make_request('PATCH', f'users?telegram_id=eq.{telegram_id}', user_data)
+        result = await self._make_request('PATCH', f'users?telegram_id=eq.{telegram_id}', user_data)
+        await self._publish_user_row(telegram_id, result)
+        return result
     
     async def get_user_tickets(self, telegram_id: int) -> int:
         """Получение количества билетов пользователя"""
@@ -106,6 +205,28 @@ class SupabaseClient:
         }
         return await self._make_request('POST', 'subscriptions', subscription_data)
     
+    async def apply_subscription_changes(self, joined: List[Dict], left: Dict[int, List[int]]) -> bool:
+        """Пачка изменений подписок из chat_member: joined — строки subscriptions (upsert),
+        left — {channel_id: [telegram_id]} (удаление). False — хотя бы один запрос не прошёл"""
+        ok = True
+        if joined:
+            result = await self._make_request(
+                'POST', 'subscriptions', joined, params={'on_conflict': 'telegram_id,channel_id'},
+                headers={'Prefer': 'resolution=merge-duplicates,return=minimal'},
+            )
+            ok = ok and not (isinstance(result, dict) and result.get('error'))
+        for channel_id, telegram_ids in left.items():
+            if not telegram_ids:
+                continue
+            ids = ','.join(str(int(t)) for t in telegram_ids)
+            result = await self._make_request(
+                'DELETE', 'subscriptions',
+                params={'channel_id': f'eq.{int(channel_id)}', 'telegram_id': f'in.({ids})'},
+                headers={'Prefer': 'return=minimal'},
+            )
+            ok = ok and not (isinstance(result, dict) and result.get('error'))
+        return ok
+
     async def get_user_subscriptions(self, telegram_id: int) -> List[Dict]:
         """Получение подписок пользователя"""
         result = await self._make_request('GET', f'subscriptions?telegram_id=eq.{telegram_id}')
@@ -191,7 +312,7 @@ class SupabaseClient:
             return {'message': 'referral cap reached'}
         new_referral_tickets = current_ref + 1
         new_total_tickets = int(user.get('total_tickets', 0) or 0) + 1
-        return await self._make_request('PATCH', f'users?telegram_id=eq.{referrer_id}', {
+        return await self.update_user(referrer_id, {
             'referral_tickets': new_referral_tickets,
             'total_tickets': new_total_tickets
         })
@@ -259,21 +380,32 @@ class SupabaseClient:
         return total
     
     async def get_user_stats(self, telegram_id: int) -> Dict:
-        """Получение статистики пользователя"""
-        user = await self.get_user(telegram_id)
-        if user:
-            return {
-                'subscription_tickets': user.get('subscription_tickets', 0),
-                'referral_tickets': user.get('referral_tickets', 0),
-                'total_tickets': user.get('total_tickets', 0),
-                'referral_code': user.get('referral_code', '')
-            }
-        return {
-            'subscription_tickets': 0,
-            'referral_tickets': 0,
-            'total_tickets': 0,
-            'referral_code': ''
-        }
+        """Получение статистики пользователя (через кэш, обновляемый событиями воркера); возвращает копию"""
+        telegram_id = int(telegram_id)
+        entry = self._stats_local.get(telegram_id)
+        if entry is not None and time.monotonic() - entry[0] < USER_STATS_LOCAL_TTL:
+            return dict(entry[1])
+        key = f"{USER_STATS_PREFIX}:{telegram_id}"
+        r = self._get_redis()
+        if r is not None:
+            try:
+                raw = await r.get(key)
+                if raw is not None:
+                    stats = json.loads(raw)
+                    self._remember_stats(telegram_id, stats)
+                    return dict(stats)
+            except Exception as e:
+                logger.warning(f"user_stats: Redis недоступен: {e}")
+        stats = _stats_from_user(await self.get_user(telegram_id))
+        self._remember_stats(telegram_id, stats)
+        stats = dict(stats)
+        if r is not None:
+            try:
+                # NX: не перетираем более свежие данные, записанные воркером
+                await r.set(key, json.dumps(stats, ensure_ascii=False), ex=USER_STATS_TTL, nx=True)
+            except Exception:
+                pass
+        return stats
     
     async def check_subscription_and_award_ticket(self, telegram_id: int, is_subscribed: bool) -> Dict:
         """Проверка подписки и начисление билета"""
@@ -285,7 +417,13 @@ class SupabaseClient:
             url = f"{self.base_url}/rest/v1/rpc/check_subscription_and_award_ticket"
             response = requests.post(url, headers=self.headers, json=data)
             if response.status_code == 200:
-                return response.json()
+                result = response.json()
+                if isinstance(result, dict) and result.get('success'):
+                    # Счётчики изменились в RPC: свежая строка — в общий кэш статистики и другим процессам
+                    # (если строку прочитать не удалось, запись кэша просто снимается)
+                    user = await self.get_user(telegram_id)
+                    await self._publish_user_row(telegram_id, [user] if user else [])
+                return result
             else:
                 logger.error(f"Ошибка вызова функции: {response.status_code} - {response.text}")
                 return {
@@ -5,6 +5,7 @@ from redis import Redis
 from rq import Queue
 
 from worker_tasks import process_referral_join, check_subscriptions_and_award
+from subscription_sweep import SWEEP_JOB_TIMEOUT, run_subscription_sweep, sweep_status
 
 app = FastAPI(title="GTM Referrals Service")
 
@@ -21,6 +22,10 @@ class ReferralJoinIn(BaseModel):
 class CheckSubsIn(BaseModel):
     telegram_id: int
 
+class SweepIn(BaseModel):
+    restart: bool = False
+    fresh: bool = False
+
 class DirectUpdateIn(BaseModel):
     telegram_id: int
     # Optional deltas or absolute values; if both provided, deltas take precedence
@@ -47,6 +52,17 @@ def enqueue_check_subscriptions(body: CheckSubsIn):
     job = queue.enqueue(check_subscriptions_and_award, int(body.telegram_id))
     return {"enqueued": True, "job_id": job.id}
 
+# Re-verify all subscription ticket holders before a draw; resumes an unfinished sweep
+@app.post("/enqueue/sweep-subscriptions")
+def enqueue_sweep_subscriptions(body: SweepIn):
+    job = queue.enqueue(run_subscription_sweep, restart=body.restart, fresh=body.fresh,
+                        job_timeout=SWEEP_JOB_TIMEOUT)
+    return {"enqueued": True, "job_id": job.id}
+
+@app.get("/sweep-subscriptions/status")
+def sweep_subscriptions_status():
+    return sweep_status()
+
 # Synchronous endpoints
 @app.post("/check-subscriptions")
 def check_subscriptions(body: CheckSubsIn):
@@ -1,39 +1,96 @@
 import os
+import sys
 import json
-from typing import List, Dict
+import time
+from typing import Any, Dict, Optional
+
+from redis import Redis
+
+try:
+    from shared import tg_membership, tg_ratelimit
+except ImportError:  # running from the source tree: shared/ sits at the repo root
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from shared import tg_membership, tg_ratelimit
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", os.getenv("SUPABASE_SERVICE_KEY", ""))
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 
-# Channels can be overridden via SUBSCRIPTION_CHANNELS_JSON env var
-_DEFAULT_CHANNELS = [
-    { 'channel_id': -1002088959587, 'channel_username': 'rejmenyavseryoz', 'channel_name': 'Режь меня всерьёз' },
-    { 'channel_id': -1001971855072, 'channel_username': 'chchndra_tattoo', 'channel_name': 'Чучундра' },
-    { 'channel_id': -1002133674248, 'channel_username': 'naidenka_tattoo', 'channel_name': 'naidenka_tattoo' },
-    { 'channel_id': -1001508215942, 'channel_username': 'l1n_ttt', 'channel_name': 'Lin++' },
-    { 'channel_id': -1001555462429, 'channel_username': 'murderd0lll', 'channel_name': 'MurderdOll' },
-    { 'channel_id': -1002132954014, 'channel_username': 'poteryashkatattoo', 'channel_name': 'Потеряшка' },
-    { 'channel_id': -1001689395571, 'channel_username': 'EMI3MO', 'channel_name': 'EMI' },
-    { 'channel_id': -1001767997947, 'channel_username': 'bloodivamp', 'channel_name': 'bloodivamp' },
-    { 'channel_id': -1001973736826, 'channel_username': 'G_T_MODEL', 'channel_name': 'Gothams top model' },
-]
-
-def get_subscription_channels() -> List[Dict]:
-    raw = os.getenv("SUBSCRIPTION_CHANNELS_JSON")
-    if not raw:
-        return _DEFAULT_CHANNELS
-    try:
-        data = json.loads(raw)
-        if isinstance(data, list) and data:
-            return data
-    except Exception:
-        pass
-    return _DEFAULT_CHANNELS
+# Shared per-user stats cache (read by api/user_stats_cache.py and the bot)
+USER_STATS_PREFIX = os.getenv("USER_STATS_PREFIX", "gtm:user_stats")
+USER_STATS_CHANNEL = os.getenv("USER_STATS_CHANNEL", "gtm:user_stats:events")
+USER_STATS_TTL = int(os.getenv("USER_STATS_TTL", "3600"))
+USER_STATS_FIELDS = ('total_tickets', 'subscription_tickets', 'referral_tickets', 'referral_code')
+
+# Channel list and SUBSCRIPTION_CHANNELS_JSON override live in shared/tg_membership.py
+get_subscription_channels = tg_membership.get_subscription_channels
 
 supabase_headers = {
     'apikey': SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY,
     'Authorization': f"Bearer {SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY}",
     'Content-Type': 'application/json'
-}
\ No newline at end of file
+}
+
+_redis: Optional[Redis] = None
+
+
+def get_redis() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+    return _redis
+
+
+# Every Telegram call of the worker (getChatMember, sendMessage) takes a token from the
+# cluster-wide buckets shared with the API, the bot and tools/
+tg_limiter = tg_ratelimit.TelegramRateLimiter(get_redis)
+
+# getChatMember for all channels concurrently over one pooled session (per worker process);
+# answers are cached per (user, channel) in Redis, shared with the API and the bot.
+# The ledger the bot keeps from chat_member updates is consulted first.
+MEMBERSHIP_CHECK_WORKERS = int(os.getenv("MEMBERSHIP_CHECK_WORKERS", "16"))
+membership_checker = tg_membership.MembershipChecker(
+    TELEGRAM_BOT_TOKEN, workers=MEMBERSHIP_CHECK_WORKERS, timeout=15,
+    cache=tg_membership.MembershipCache(get_redis),
+    ledger=tg_membership.MembershipLedger(get_redis),
+    limiter=tg_limiter,
+)
+
+
+def record_eligibility(telegram_id: int, subscribed: Optional[bool]) -> None:
+    """Store a decided subscription check in the API's draw eligibility index.
+    None (Telegram errors) leaves the previous entry alone. Redis errors never fail the task.
+    """
+    if subscribed is None:
+        return
+    try:
+        get_redis().hset(tg_membership.GIVEAWAY_ELIGIBILITY_KEY, str(int(telegram_id)),
+                         tg_membership.eligibility_entry(subscribed, time.time()))
+    except Exception:
+        pass
+
+
+def publish_user_stats(telegram_id: int, row: Optional[Dict[str, Any]]) -> None:
+    """Write fresh counters to the shared cache and notify API/bot subscribers.
+    row=None drops the cached entry. Cache errors never fail the calling task.
+    """
+    stats = None
+    if row is not None:
+        stats = {
+            'total_tickets': row.get('total_tickets', 0) or 0,
+            'subscription_tickets': row.get('subscription_tickets', 0) or 0,
+            'referral_tickets': row.get('referral_tickets', 0) or 0,
+            'referral_code': row.get('referral_code', '') or '',
+        }
+    key = f"{USER_STATS_PREFIX}:{int(telegram_id)}"
+    try:
+        r = get_redis()
+        if stats is None:
+            r.delete(key)
+        else:
+            r.set(key, json.dumps(stats, ensure_ascii=False), ex=USER_STATS_TTL)
+        r.publish(USER_STATS_CHANNEL, json.dumps({'telegram_id': int(telegram_id), 'stats': stats}, ensure_ascii=False))
+    except Exception:
+        pass
@@ -0,0 +1,193 @@
+"""Bulk re-verification of subscription tickets before a draw.
+
+run_subscription_sweep (an RQ job) streams users with subscription_tickets > 0 by keyset
+pagination on telegram_id and re-checks their channel memberships under the cluster-wide
+Telegram limiter (background lane) with bounded concurrency.
+
+Each page ends with one Redis transaction that writes the page's results into the API's
+eligibility hash (api/draw_eligibility.py; generate-results can skip live checks of confirmed
+subscribers and, with ELIGIBILITY_UNSUBSCRIBED_TTL set, mask fresh refusals) and moves the checkpoint. A crashed or restarted sweep resumes after the
+last committed page; at most one page is checked twice.
+
+sweep_status() reports progress, throughput and ETA.
+"""
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from common import (
+    SUPABASE_URL, TELEGRAM_BOT_TOKEN, get_redis, supabase_headers, tg_limiter, tg_membership,
+)
+from shared.tg_membership import GIVEAWAY_ELIGIBILITY_KEY, eligibility_entry, subscription_verdict
+from shared.tg_ratelimit import LANE_BACKGROUND
+
+SWEEP_PAGE_SIZE = int(os.getenv("SWEEP_PAGE_SIZE", "200"))
+SWEEP_CONCURRENCY = int(os.getenv("SWEEP_CONCURRENCY", "8"))
+SWEEP_LOCK_TTL = int(os.getenv("SWEEP_LOCK_TTL", "900"))  # must outlast one page
+SWEEP_JOB_TIMEOUT = int(os.getenv("SWEEP_JOB_TIMEOUT", str(6 * 3600)))
+SWEEP_PREFIX = os.getenv("SWEEP_PREFIX", "gtm:sweep:subscriptions")
+
+STATE_KEY = f"{SWEEP_PREFIX}:state"
+LOCK_KEY = f"{SWEEP_PREFIX}:lock"
+
+# Own checker: the sweep's concurrency is bounded separately from interactive checks,
+# and its calls go to the background lane of the limiter
+sweep_checker = tg_membership.MembershipChecker(
+    TELEGRAM_BOT_TOKEN, workers=SWEEP_CONCURRENCY, timeout=15,
+    cache=tg_membership.MembershipCache(get_redis),
+    ledger=tg_membership.MembershipLedger(get_redis),
+    limiter=tg_limiter, lane=LANE_BACKGROUND,
+)
+
+_COUNTERS = ('total', 'last_id', 'checked', 'subscribed', 'unsubscribed', 'unknown')
+_TIMES = ('started_at', 'updated_at', 'finished_at', 'elapsed')
+
+
+def _count_candidates() -> Optional[int]:
+    """Users with subscription tickets: HEAD with count=exact (Content-Range: */N)"""
+    try:
+        r = requests.head(
+            f"{SUPABASE_URL}/rest/v1/users",
+            headers={**supabase_headers, 'Prefer': 'count=exact'},
+            params={'select': 'telegram_id', 'subscription_tickets': 'gt.0'},
+            timeout=20,
+        )
+        total = (r.headers.get('Content-Range') or '').rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
+    except Exception:
+        return None
+
+
+def _next_page(after_id: int, limit: int) -> List[int]:
+    """Next telegram_ids after after_id: an index range scan, unlike offset pagination"""
+    r = requests.get(
+        f"{SUPABASE_URL}/rest/v1/users",
+        headers=supabase_headers,
+        params={
+            'select': 'telegram_id',
+            'subscription_tickets': 'gt.0',
+            'telegram_id': f"gt.{int(after_id)}",
+            'order': 'telegram_id.asc',
+            'limit': str(int(limit)),
+        },
+        timeout=30,
+    )
+    r.raise_for_status()
+    return [int(row['telegram_id']) for row in (r.json() or []) if row.get('telegram_id') is not None]
+
+
+def _decode_state(raw: Dict[Any, Any]) -> Dict[str, Any]:
+    state: Dict[str, Any] = {}
+    for k, v in raw.items():
+        k = k.decode() if isinstance(k, bytes) else str(k)
+        v = v.decode() if isinstance(v, bytes) else str(v)
+        if k in _COUNTERS:
+            state[k] = int(float(v)) if v not in ('', 'None') else None
+        elif k in _TIMES:
+            state[k] = float(v) if v not in ('', 'None') else None
+        else:
+            state[k] = v
+    return state
+
+
+def _encode_state(state: Dict[str, Any]) -> Dict[str, str]:
+    return {k: ('' if v is None else str(v)) for k, v in state.items()}
+
+
+def _with_progress(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Adds users/sec over the sweep's active time and the ETA for the remaining users"""
+    elapsed = state.get('elapsed') or 0.0
+    checked = state.get('checked') or 0
+    rate = checked / elapsed if elapsed > 0 else 0.0
+    total = state.get('total')
+    remaining = max(0, total - checked) if total is not None else None
+    eta = remaining / rate if rate > 0 and remaining is not None else None
+    return {**state, 'users_per_sec': round(rate, 2), 'remaining': remaining,
+            'eta_seconds': round(eta) if eta is not None else None}
+
+
+def sweep_status() -> Dict[str, Any]:
+    r = get_redis()
+    state = _decode_state(r.hgetall(STATE_KEY))
+    if not state:
+        return {'status': 'never_run'}
+    return {**_with_progress(state), 'running': bool(r.exists(LOCK_KEY))}
+
+
+def run_subscription_sweep(restart: bool = False, fresh: bool = False,
+                           page_size: int = SWEEP_PAGE_SIZE) -> Dict[str, Any]:
+    """Re-verify every subscription ticket holder; resumes an unfinished sweep unless restart=True.
+    fresh=True asks Telegram for every pair instead of the ledger / cache.
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        return {'success': False, 'error': 'BOT TOKEN not configured'}
+    r = get_redis()
+    token = uuid.uuid4().hex
+    if not r.set(LOCK_KEY, token, nx=True, ex=SWEEP_LOCK_TTL):
+        return {'success': False, 'error': 'sweep already running', **sweep_status()}
+    try:
+        state = _decode_state(r.hgetall(STATE_KEY))
+        if restart or not state or state.get('status') == 'done':
+            now = time.time()
+            state = {
+                'sweep_id': uuid.uuid4().hex[:12], 'status': 'running', 'fresh': int(bool(fresh)),
+                'total': _count_candidates(), 'last_id': 0, 'checked': 0, 'subscribed': 0,
+                'unsubscribed': 0, 'unknown': 0, 'started_at': now, 'updated_at': now,
+                'finished_at': None, 'elapsed': 0.0,
+            }
+            r.delete(STATE_KEY)
+            r.hset(STATE_KEY, mapping=_encode_state(state))
+            print(f"sweep {state['sweep_id']}: started, {state['total']} users to check", flush=True)
+        else:
+            state['status'] = 'running'
+            print(f"sweep {state['sweep_id']}: resuming after telegram_id {state['last_id']} "
+                  f"({state['checked']}/{state['total']})", flush=True)
+
+        while True:
+            page_started = time.monotonic()
+            ids = _next_page(state['last_id'], page_size)
+            if not ids:
+                break
+            results = sweep_checker.check_many(ids, tg_membership.MODE_ALL, force_fresh=fresh)
+            now = time.time()
+            verdicts = {tid: subscription_verdict(res) for tid, res in results.items()}
+            decided = {tid: ok for tid, ok in verdicts.items() if ok is not None}
+
+            state['last_id'] = max(ids)
+            state['checked'] += len(ids)
+            state['subscribed'] += sum(1 for ok in decided.values() if ok)
+            state['unsubscribed'] += sum(1 for ok in decided.values() if not ok)
+            state['unknown'] += len(ids) - len(decided)
+            state['elapsed'] = (state.get('elapsed') or 0.0) + (time.monotonic() - page_started)
+            state['updated_at'] = now
+
+            # Results and checkpoint in one transaction: a resumed sweep never skips unwritten results
+            pipe = r.pipeline(transaction=True)
+            if decided:
+                pipe.hset(GIVEAWAY_ELIGIBILITY_KEY, mapping={
+                    str(tid): eligibility_entry(ok, now) for tid, ok in decided.items()
+                })
+            pipe.hset(STATE_KEY, mapping=_encode_state(state))
+            pipe.expire(LOCK_KEY, SWEEP_LOCK_TTL)
+            pipe.execute()
+
+            progress = _with_progress(state)
+            print(f"sweep {state['sweep_id']}: {state['checked']}/{state['total']} "
+                  f"(-{state['unsubscribed']}, ?{state['unknown']}) {progress['users_per_sec']} users/s, "
+                  f"eta {progress['eta_seconds']}s", flush=True)
+
+        state['status'] = 'done'
+        state['finished_at'] = time.time()
+        r.hset(STATE_KEY, mapping=_encode_state(state))
+        return {'success': True, **_with_progress(state)}
+    except Exception as e:
+        r.hset(STATE_KEY, 'status', 'interrupted')
+        print(f"sweep interrupted: {e}", flush=True)
+        raise
+    finally:
+        # Release only our own lock
+        if r.get(LOCK_KEY) in (token, token.encode()):
+            r.delete(LOCK_KEY)
@@ -1,7 +1,12 @@
 import os
 import requests
 from typing import Dict, Any, Optional, List
-from common import SUPABASE_URL, supabase_headers, TELEGRAM_BOT_TOKEN, get_subscription_channels
+from common import (
+    SUPABASE_URL, supabase_headers, TELEGRAM_BOT_TOKEN, USER_STATS_FIELDS,
+    get_subscription_channels, membership_checker, publish_user_stats, record_eligibility, tg_limiter,
+)
+from shared.tg_membership import MODE_REPORT, is_member_status, subscription_verdict
+from shared.tg_ratelimit import LANE_BACKGROUND, LANE_INTERACTIVE
 
 # --- Supabase helpers ---
 
@@ -27,13 +32,33 @@ def _post_rows(endpoint: str, rows: List[Dict[str, Any]], prefer: str = 'return=
 
 
 def _patch_users(telegram_id: int, payload: Dict[str, Any]):
-    return requests.patch(
+    resp = requests.patch(
         f"{SUPABASE_URL}/rest/v1/users",
         headers={**supabase_headers, 'Prefer': 'return=representation'},
         params={'telegram_id': f"eq.{telegram_id}"},
         json=payload,
         timeout=20,
     )
+    _sync_user_stats(telegram_id, resp)
+    return resp
+
+
+def _sync_user_stats(telegram_id: int, resp: Optional[requests.Response] = None) -> None:
+    """Push the user's current counters to the shared stats cache right after a write,
+    so readers see a new ticket immediately. Uses the PATCH representation when available.
+    """
+    row = None
+    try:
+        if resp is not None and resp.status_code == 200 and resp.content:
+            rows = resp.json()
+            if isinstance(rows, list) and rows:
+                row = rows[0]
+        if row is None:
+            rows = _get_rows('users', params={'telegram_id': f"eq.{int(telegram_id)}"}, select=','.join(USER_STATS_FIELDS))
+            row = rows[0] if isinstance(rows, list) and rows else None
+    except Exception:
+        row = None
+    publish_user_stats(int(telegram_id), row)
 
 
 def _rpc(name: str, body: Dict[str, Any]):
@@ -41,15 +66,16 @@ def _rpc(name: str, body: Dict[str, Any]):
 
 # --- Telegram helper ---
 
-def _send_tg_message(chat_id: int, text: str):
+def _send_tg_message(chat_id: int, text: str, lane: str = LANE_INTERACTIVE):
     if not TELEGRAM_BOT_TOKEN:
         return
     try:
-        requests.get(
+        # Goes through the cluster-wide limiter; a 429 pauses every service and is retried
+        tg_limiter.run('sendMessage', lambda: requests.get(
             f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
             params={'chat_id': chat_id, 'text': text},
             timeout=15,
-        )
+        ), chat_id=int(chat_id), lane=lane)
     except Exception:
         pass
 
@@ -133,7 +159,7 @@ def process_referral_join(referral_code: str, referred_telegram_id: int) -> Dict
     _patch_users(int(owner_id), payload)
 
     # Notify referrer
-    _send_tg_message(int(owner_id), "🎫 Вам начислен билет за приглашенного друга! Спасибо!")
+    _send_tg_message(int(owner_id), "🎫 Вам начислен билет за приглашенного друга! Спасибо!", lane=LANE_BACKGROUND)
     return {'success': True, 'ticket_awarded': True}
 
 
@@ -142,38 +168,27 @@ def check_subscriptions_and_award(telegram_id: int) -> Dict[str, Any]:
     Also stores per-channel subscription records and notifies the user.
     """
     channels = get_subscription_channels()
-    is_all = True
-    not_subscribed: List[int] = []
-    subscribed_rows: List[Dict[str, Any]] = []
 
     if not TELEGRAM_BOT_TOKEN:
         return {'success': False, 'error': 'BOT TOKEN not configured'}
 
-    for channel in channels:
-        try:
-            r = requests.get(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getChatMember",
-                params={'chat_id': channel['channel_id'], 'user_id': telegram_id},
-                timeout=15,
-            )
-            if r.status_code != 200:
-                is_all = False
-                not_subscribed.append(channel['channel_id'])
-                continue
-            status = (r.json() or {}).get('result', {}).get('status')
-            if status in ('member', 'administrator', 'creator'):
-                subscribed_rows.append({
-                    'telegram_id': int(telegram_id),
-                    'channel_id': channel['channel_id'],
-                    'channel_name': channel.get('channel_name', ''),
-                    'channel_username': channel.get('channel_username', ''),
-                })
-            else:
-                is_all = False
-                not_subscribed.append(channel['channel_id'])
-        except Exception:
-            is_all = False
-            not_subscribed.append(channel['channel_id'])
+    # All channels at once, Telegram is asked only about channels without a cached answer;
+    # "report" mode keeps per-channel statuses for the subscriptions table
+    report = membership_checker.check(int(telegram_id), MODE_REPORT)
+    is_all = report['subscribed']
+    not_subscribed: List[int] = report['not_subscribed']
+    # Keeps the draw's eligibility index current; an undecided check changes nothing
+    record_eligibility(int(telegram_id), subscription_verdict(report))
+    subscribed_rows: List[Dict[str, Any]] = [
+        {
+            'telegram_id': int(telegram_id),
+            'channel_id': channel['channel_id'],
+            'channel_name': channel.get('channel_name', ''),
+            'channel_username': channel.get('channel_username', ''),
+        }
+        for channel in channels
+        if is_member_status(report['channels'].get(int(channel['channel_id']), ''))
+    ]
 
     if subscribed_rows:
         try:
@@ -196,6 +211,8 @@ def check_subscriptions_and_award(telegram_id: int) -> Dict[str, Any]:
     if rpc_resp.status_code == 200:
         body = rpc_resp.json() or {}
         ticket_awarded = bool(body.get('ticket_awarded', False))
+        # The RPC updates counters on the DB side, bypassing _patch_users
+        _sync_user_stats(int(telegram_id))
     else:
         # Fallback: if subscribed to all now, upsert user totals locally without giving duplicate tickets
         if is_all:
@@ -0,0 +1 @@
+"""Code shared by the api, referrals and bot services (copied into each image as /app/shared)."""
@@ -0,0 +1,576 @@
+"""
+Telegram channel-membership checks shared by the API, the referrals worker and the bot.
+
+Every channel is queried concurrently over one pooled connection instead of a
+sequential getChatMember loop, so a check costs about one round trip, not one per channel.
+
+Modes:
+  * "all"    - is the user a member of every channel? Stops at the first non-member:
+               queued calls are cancelled and the answer is returned without waiting for the rest.
+  * "report" - status of every channel (the worker stores per-channel subscription rows).
+
+MembershipChecker (requests + thread pool) is for Flask / RQ code,
+AsyncMembershipChecker (aiohttp) for the bot and other asyncio code.
+The channel list honours the SUBSCRIPTION_CHANNELS_JSON override.
+
+With a MembershipCache every (user, channel) answer is kept in Redis: memberships for
+MEMBERSHIP_POSITIVE_TTL, everything else for the short MEMBERSHIP_NEGATIVE_TTL, errors not at all.
+Only expired pairs go to Telegram; force_fresh=True skips the cache for the lookup
+(the fresh answers are still stored).
+
+With a MembershipLedger (fed by the bot from chat_member updates) a check is answered from
+Redis sets first; the cache and getChatMember only cover pairs the ledger has never seen,
+and their answers seed the ledger. force_fresh skips the ledger as well.
+
+With a TelegramRateLimiter (shared/tg_ratelimit.py) every getChatMember first takes a token
+from the cluster-wide buckets in the checker's lane; a call that gets none in time is an 'error'.
+"""
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .tg_ratelimit import LANE_INTERACTIVE, TelegramRateLimiter, retry_after_of
+
+try:
+    import aiohttp
+except ImportError:  # only the async checker needs it
+    aiohttp = None
+
+MODE_ALL = 'all'
+MODE_REPORT = 'report'
+
+# Channel status values besides Telegram's own (member, left, kicked, ...)
+STATUS_ERROR = 'error'
+STATUS_SKIPPED = 'skipped'  # not checked: "all" mode already found a non-member
+
+MEMBER_STATUSES = frozenset({'member', 'administrator', 'creator'})
+
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+MEMBERSHIP_CACHE_PREFIX = os.getenv('MEMBERSHIP_CACHE_PREFIX', 'gtm:tg_member')
+MEMBERSHIP_POSITIVE_TTL = int(os.getenv('MEMBERSHIP_POSITIVE_TTL', '3600'))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv('MEMBERSHIP_NEGATIVE_TTL', '30'))
+
+MEMBERSHIP_LEDGER_PREFIX = os.getenv('MEMBERSHIP_LEDGER_PREFIX', 'gtm:tg_ledger')
+MEMBERSHIP_LEDGER_HEARTBEAT_TTL = int(os.getenv('MEMBERSHIP_LEDGER_HEARTBEAT_TTL', '120'))
+
+# Hash of the API's draw eligibility index (api/draw_eligibility.py): telegram_id -> "1:<ts>" / "0:<ts>"
+GIVEAWAY_ELIGIBILITY_KEY = os.getenv(
+    'GIVEAWAY_ELIGIBILITY_KEY', f"{os.getenv('API_CACHE_PREFIX', 'gtm:api')}:giveaway:eligibility:subs"
+)
+
+DEFAULT_CHANNELS: List[Dict[str, Any]] = [
+    {'channel_id': -1002088959587, 'channel_username': 'rejmenyavseryoz', 'channel_name': 'Режь меня всерьёз'},
+    {'channel_id': -1001971855072, 'channel_username': 'chchndra_tattoo', 'channel_name': 'Чучундра'},
+    {'channel_id': -1002133674248, 'channel_username': 'naidenka_tattoo', 'channel_name': 'naidenka_tattoo'},
+    {'channel_id': -1001508215942, 'channel_username': 'l1n_ttt', 'channel_name': 'Lin++'},
+    {'channel_id': -1001555462429, 'channel_username': 'murderd0lll', 'channel_name': 'MurderdOll'},
+    {'channel_id': -1002132954014, 'channel_username': 'poteryashkatattoo', 'channel_name': 'Потеряшка'},
+    {'channel_id': -1001689395571, 'channel_username': 'EMI3MO', 'channel_name': 'EMI'},
+    {'channel_id': -1001767997947, 'channel_username': 'bloodivamp', 'channel_name': 'bloodivamp'},
+    {'channel_id': -1001973736826, 'channel_username': 'G_T_MODEL', 'channel_name': 'Gothams top model'},
+]
+
+
+def get_subscription_channels() -> List[Dict[str, Any]]:
+    """Channels a user must follow; SUBSCRIPTION_CHANNELS_JSON (a JSON list) overrides the defaults"""
+    raw = os.getenv('SUBSCRIPTION_CHANNELS_JSON')
+    if not raw:
+        return DEFAULT_CHANNELS
+    try:
+        data = json.loads(raw)
+        if isinstance(data, list) and data:
+            return data
+    except Exception:
+        pass
+    return DEFAULT_CHANNELS
+
+
+def member_status(payload: Any) -> str:
+    """Status from a getChatMember response body ('member', 'left', ... or 'error')"""
+    if not isinstance(payload, dict) or not payload.get('ok'):
+        return STATUS_ERROR
+    result = payload.get('result') or {}
+    status = result.get('status') or STATUS_ERROR
+    # A restricted user can still be a member of the channel
+    if status == 'restricted' and result.get('is_member'):
+        return 'member'
+    return status
+
+
+def is_member_status(status: str) -> bool:
+    return status in MEMBER_STATUSES
+
+
+def _result(telegram_id: int, channels: List[Dict[str, Any]], statuses: Dict[int, str]) -> Dict[str, Any]:
+    """{'telegram_id', 'subscribed', 'channels': {channel_id: status}, 'not_subscribed': [channel_id]}"""
+    full = {int(ch['channel_id']): statuses.get(int(ch['channel_id']), STATUS_SKIPPED) for ch in channels}
+    not_subscribed = [cid for cid, st in full.items() if st != STATUS_SKIPPED and not is_member_status(st)]
+    return {
+        'telegram_id': int(telegram_id),
+        'subscribed': bool(full) and all(is_member_status(st) for st in full.values()),
+        'channels': full,
+        'not_subscribed': not_subscribed,
+    }
+
+
+def subscription_verdict(result: Dict[str, Any]) -> Optional[bool]:
+    """True/False - subscribed to every channel or not; None - Telegram errors left it undecided"""
+    if result['subscribed']:
+        return True
+    for status in result['channels'].values():
+        if status not in (STATUS_ERROR, STATUS_SKIPPED) and not is_member_status(status):
+            return False
+    return None
+
+
+def eligibility_entry(subscribed: bool, at: float) -> str:
+    """Value of GIVEAWAY_ELIGIBILITY_KEY for one user"""
+    return f"{1 if subscribed else 0}:{at:.3f}"
+
+
+Pair = Tuple[int, int]  # (telegram_id, channel_id)
+
+
+class MembershipCache:
+    """Redis cache of getChatMember statuses keyed by (telegram_id, channel_id).
+    client() returns a redis client (sync for get_many/put, redis.asyncio for aget_many/aput) or None.
+    Cache failures are swallowed: a check then simply goes to Telegram."""
+
+    def __init__(self, client: Callable[[], Any], prefix: str = MEMBERSHIP_CACHE_PREFIX,
+                 positive_ttl: int = MEMBERSHIP_POSITIVE_TTL, negative_ttl: int = MEMBERSHIP_NEGATIVE_TTL):
+        self._client = client
+        self.prefix = prefix
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'errors': 0}
+
+    def key(self, telegram_id: int, channel_id: int) -> str:
+        return f"{self.prefix}:{int(telegram_id)}:{int(channel_id)}"
+
+    def ttl(self, status: str) -> int:
+        """Seconds to keep a status; 0 - do not cache"""
+        if status in (STATUS_ERROR, STATUS_SKIPPED):
+            return 0
+        return self.positive_ttl if is_member_status(status) else self.negative_ttl
+
+    def _collect(self, pairs: List[Pair], values: List[Any]) -> Dict[Pair, str]:
+        out: Dict[Pair, str] = {}
+        for pair, raw in zip(pairs, values):
+            if raw is not None:
+                out[pair] = raw.decode() if isinstance(raw, bytes) else str(raw)
+        self.stats['hits'] += len(out)
+        self.stats['misses'] += len(pairs) - len(out)
+        return out
+
+    def get_many(self, pairs: Iterable[Pair]) -> Dict[Pair, str]:
+        pairs = list(pairs)
+        r = self._client() if pairs else None
+        if r is None:
+            return {}
+        try:
+            return self._collect(pairs, r.mget([self.key(t, c) for t, c in pairs]))
+        except Exception:
+            self.stats['errors'] += 1
+            return {}
+
+    def put(self, telegram_id: int, channel_id: int, status: str) -> None:
+        ttl = self.ttl(status)
+        r = self._client() if ttl > 0 else None
+        if r is None:
+            return
+        try:
+            r.set(self.key(telegram_id, channel_id), status, ex=ttl)
+            self.stats['stored'] += 1
+        except Exception:
+            self.stats['errors'] += 1
+
+    async def aget_many(self, pairs: Iterable[Pair]) -> Dict[Pair, str]:
+        pairs = list(pairs)
+        r = self._client() if pairs else None
+        if r is None:
+            return {}
+        try:
+            return self._collect(pairs, await r.mget([self.key(t, c) for t, c in pairs]))
+        except Exception:
+            self.stats['errors'] += 1
+            return {}
+
+    async def aput(self, telegram_id: int, channel_id: int, status: str) -> None:
+        ttl = self.ttl(status)
+        r = self._client() if ttl > 0 else None
+        if r is None:
+            return
+        try:
+            await r.set(self.key(telegram_id, channel_id), status, ex=ttl)
+            self.stats['stored'] += 1
+        except Exception:
+            self.stats['errors'] += 1
+
+
+class MembershipLedger:
+    """Channel membership kept up to date by chat_member updates (the bot is an admin of the channels).
+    Per channel, Redis holds the set of current members, the set of users the ledger has seen
+    (a join/leave event or a seeded getChatMember answer) and a heartbeat the bot refreshes
+    while it receives the channel's updates.
+    A lookup is a few SISMEMBERs in one pipeline. Pairs the ledger has never seen, and every pair of a
+    channel without a heartbeat, are left out so the checker falls back to the cache and getChatMember.
+    client() returns a redis client (sync for get_many/apply, redis.asyncio for aget_many/aapply) or None."""
+
+    def __init__(self, client: Callable[[], Any], prefix: str = MEMBERSHIP_LEDGER_PREFIX,
+                 heartbeat_ttl: int = MEMBERSHIP_LEDGER_HEARTBEAT_TTL):
+        self._client = client
+        self.prefix = prefix
+        self.heartbeat_ttl = heartbeat_ttl
+        self.stats = {'hits': 0, 'unseen': 0, 'offline': 0, 'applied': 0, 'errors': 0}
+
+    def members_key(self, channel_id: int) -> str:
+        return f"{self.prefix}:{int(channel_id)}:members"
+
+    def seen_key(self, channel_id: int) -> str:
+        return f"{self.prefix}:{int(channel_id)}:seen"
+
+    def heartbeat_key(self, channel_id: int) -> str:
+        return f"{self.prefix}:{int(channel_id)}:alive"
+
+    def _queue_lookup(self, pipe: Any, pairs: List[Pair], channel_ids: List[int]) -> None:
+        for cid in channel_ids:
+            pipe.exists(self.heartbeat_key(cid))
+        for tid, cid in pairs:
+            pipe.sismember(self.members_key(cid), tid)
+            pipe.sismember(self.seen_key(cid), tid)
+
+    def _collect(self, pairs: List[Pair], channel_ids: List[int], values: List[Any]) -> Dict[Pair, str]:
+        alive = {cid for cid, v in zip(channel_ids, values) if v}
+        values = values[len(channel_ids):]
+        out: Dict[Pair, str] = {}
+        for i, (tid, cid) in enumerate(pairs):
+            if cid not in alive:
+                self.stats['offline'] += 1
+            elif values[2 * i + 1]:
+                out[(tid, cid)] = 'member' if values[2 * i] else 'left'
+            else:
+                self.stats['unseen'] += 1
+        self.stats['hits'] += len(out)
+        return out
+
+    def _queue_apply(self, pipe: Any, statuses: Dict[Pair, str]) -> None:
+        for (tid, cid), status in statuses.items():
+            if is_member_status(status):
+                pipe.sadd(self.members_key(cid), int(tid))
+            else:
+                pipe.srem(self.members_key(cid), int(tid))
+            pipe.sadd(self.seen_key(cid), int(tid))
+
+    @staticmethod
+    def _known(statuses: Dict[Pair, str]) -> Dict[Pair, str]:
+        return {pair: st for pair, st in statuses.items() if st not in (STATUS_ERROR, STATUS_SKIPPED)}
+
+    def get_many(self, pairs: Iterable[Pair]) -> Dict[Pair, str]:
+        pairs = [(int(t), int(c)) for t, c in pairs]
+        r = self._client() if pairs else None
+        if r is None:
+            return {}
+        channel_ids = list(dict.fromkeys(cid for _, cid in pairs))
+        try:
+            pipe = r.pipeline(transaction=False)
+            self._queue_lookup(pipe, pairs, channel_ids)
+            return self._collect(pairs, channel_ids, pipe.execute())
+        except Exception:
+            self.stats['errors'] += 1
+            return {}
+
+    def apply(self, statuses: Dict[Pair, str]) -> bool:
+        """Record statuses (latest per pair); errors and skipped checks are ignored"""
+        statuses = self._known(statuses)
+        r = self._client() if statuses else None
+        if r is None:
+            return True
+        try:
+            pipe = r.pipeline(transaction=False)
+            self._queue_apply(pipe, statuses)
+            pipe.execute()
+            self.stats['applied'] += len(statuses)
+            return True
+        except Exception:
+            self.stats['errors'] += 1
+            return False
+
+    async def aget_many(self, pairs: Iterable[Pair]) -> Dict[Pair, str]:
+        pairs = [(int(t), int(c)) for t, c in pairs]
+        r = self._client() if pairs else None
+        if r is None:
+            return {}
+        channel_ids = list(dict.fromkeys(cid for _, cid in pairs))
+        try:
+            pipe = r.pipeline(transaction=False)
+            self._queue_lookup(pipe, pairs, channel_ids)
+            return self._collect(pairs, channel_ids, await pipe.execute())
+        except Exception:
+            self.stats['errors'] += 1
+            return {}
+
+    async def aapply(self, statuses: Dict[Pair, str]) -> bool:
+        statuses = self._known(statuses)
+        r = self._client() if statuses else None
+        if r is None:
+            return True
+        try:
+            pipe = r.pipeline(transaction=False)
+            self._queue_apply(pipe, statuses)
+            await pipe.execute()
+            self.stats['applied'] += len(statuses)
+            return True
+        except Exception:
+            self.stats['errors'] += 1
+            return False
+
+    async def aheartbeat(self, channel_ids: Iterable[int]) -> None:
+        """Mark channels whose updates the caller receives; lookups trust a channel only while this is fresh"""
+        channel_ids = list(channel_ids)
+        r = self._client() if channel_ids else None
+        if r is None:
+            return
+        try:
+            pipe = r.pipeline(transaction=False)
+            for cid in channel_ids:
+                pipe.set(self.heartbeat_key(cid), 1, ex=self.heartbeat_ttl)
+            await pipe.execute()
+        except Exception:
+            self.stats['errors'] += 1
+
+    async def areset(self, channel_ids: Iterable[int]) -> bool:
+        """Forget everything recorded for the channels (members, seen, heartbeat).
+        For a feeder that starts without the updates it missed: lookups fall back to the cache and
+        getChatMember until fresh events and seeded answers rebuild the ledger"""
+        channel_ids = list(channel_ids)
+        r = self._client() if channel_ids else None
+        if r is None:
+            return True
+        try:
+            await r.delete(*(key for cid in channel_ids
+                             for key in (self.members_key(cid), self.seen_key(cid), self.heartbeat_key(cid))))
+            return True
+        except Exception:
+            self.stats['errors'] += 1
+            return False
+
+
+class MembershipChecker:
+    """Thread-pool checker over one requests.Session; safe to share between threads.
+    The pool and session are recreated after fork (gunicorn / RQ workers)."""
+
+    def __init__(self, token: str, channels: Optional[List[Dict[str, Any]]] = None,
+                 workers: int = 16, timeout: float = 15.0, cache: Optional[MembershipCache] = None,
+                 ledger: Optional[MembershipLedger] = None, limiter: Optional[TelegramRateLimiter] = None,
+                 lane: str = LANE_INTERACTIVE):
+        self.token = token
+        self.channels = channels
+        self.cache = cache
+        self.ledger = ledger
+        self.limiter = limiter
+        self.lane = lane
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._session: Optional[requests.Session] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def _ensure(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    session = requests.Session()
+                    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+                    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers))
+                    self._session = session
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tg-member')
+                    self._pid = pid
+        return self._session, self._pool
+
+    def _channels(self) -> List[Dict[str, Any]]:
+        return self.channels if self.channels is not None else get_subscription_channels()
+
+    def status(self, telegram_id: int, channel_id: int) -> str:
+        """getChatMember status of one user in one channel; network/HTTP failures give 'error'"""
+        session, _ = self._ensure()
+
+        def call():
+            return session.get(f"{TELEGRAM_API_URL}/bot{self.token}/getChatMember",
+                               params={'chat_id': channel_id, 'user_id': int(telegram_id)}, timeout=self.timeout)
+        try:
+            r = self.limiter.run('getChatMember', call, lane=self.lane) if self.limiter is not None else call()
+            if r is None or r.status_code != 200:
+                return STATUS_ERROR
+            return member_status(r.json())
+        except Exception:
+            return STATUS_ERROR
+
+    def check(self, telegram_id: int, mode: str = MODE_ALL, force_fresh: bool = False) -> Dict[str, Any]:
+        return self.check_many([telegram_id], mode, force_fresh)[int(telegram_id)]
+
+    def check_many(self, telegram_ids: Iterable[int], mode: str = MODE_ALL,
+                   force_fresh: bool = False) -> Dict[int, Dict[str, Any]]:
+        """All uncached (user, channel) pairs go to the pool at once; in "all" mode a user's remaining
+        checks are dropped as soon as one channel reports a non-member."""
+        ids = list(dict.fromkeys(int(t) for t in telegram_ids))
+        channels = self._channels()
+        if not ids:
+            return {}
+        if not self.token:
+            return {tid: _result(tid, channels, {int(ch['channel_id']): STATUS_ERROR for ch in channels}) for tid in ids}
+        _, pool = self._ensure()
+        early_exit = mode == MODE_ALL
+        rejected = {tid: threading.Event() for tid in ids}
+        statuses: Dict[int, Dict[int, str]] = {tid: {} for tid in ids}
+        fetched: Dict[Pair, str] = {}
+        if not force_fresh:
+            # Ledger first, then the cache for what the ledger has not seen
+            for source in (self.ledger, self.cache):
+                if source is None:
+                    continue
+                missing = [(t, int(ch['channel_id'])) for t in ids for ch in channels
+                           if int(ch['channel_id']) not in statuses[t] and not (early_exit and rejected[t].is_set())]
+                for (tid, cid), st in source.get_many(missing).items():
+                    statuses[tid][cid] = st
+                    if not is_member_status(st):
+                        rejected[tid].set()
+
+        def run(tid: int, channel_id: int) -> None:
+            if early_exit and rejected[tid].is_set():
+                return  # already known: not subscribed
+            st = self.status(tid, channel_id)
+            statuses[tid][channel_id] = st
+            fetched[(tid, channel_id)] = st
+            if self.cache is not None:
+                self.cache.put(tid, channel_id, st)
+            if not is_member_status(st):
+                rejected[tid].set()
+
+        futures = {
+            tid: [pool.submit(run, tid, int(ch['channel_id'])) for ch in channels
+                  if int(ch['channel_id']) not in statuses[tid] and not (early_exit and rejected[tid].is_set())]
+            for tid in ids
+        }
+        out: Dict[int, Dict[str, Any]] = {}
+        for tid, fs in futures.items():
+            pending = set(fs)
+            while pending and not (early_exit and rejected[tid].is_set()):
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in pending:
+                f.cancel()
+            out[tid] = _result(tid, channels, dict(statuses[tid]))
+        if self.ledger is not None:
+            # Fresh answers seed the ledger; chat_member updates keep these pairs current from now on
+            self.ledger.apply(dict(fetched))
+        return out
+
+
+class AsyncMembershipChecker:
+    """asyncio checker over one aiohttp.ClientSession (created lazily in the running loop)"""
+
+    def __init__(self, token: str, channels: Optional[List[Dict[str, Any]]] = None,
+                 timeout: float = 15.0, limit: int = 50, cache: Optional[MembershipCache] = None,
+                 ledger: Optional[MembershipLedger] = None, limiter: Optional[TelegramRateLimiter] = None,
+                 lane: str = LANE_INTERACTIVE):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for AsyncMembershipChecker")
+        self.token = token
+        self.channels = channels
+        self.cache = cache
+        self.ledger = ledger
+        self.limiter = limiter
+        self.lane = lane
+        self.timeout = timeout
+        self.limit = limit
+        self._session: Optional['aiohttp.ClientSession'] = None
+
+    def _channels(self) -> List[Dict[str, Any]]:
+        return self.channels if self.channels is not None else get_subscription_channels()
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.limit),
+            )
+        return self._session
+
+    async def status(self, telegram_id: int, channel_id: int, attempts: int = 3) -> str:
+        for _ in range(attempts):
+            if self.limiter is not None and not await self.limiter.aacquire('getChatMember', lane=self.lane):
+                return STATUS_ERROR
+            try:
+                async with self._get_session().get(
+                    f"{TELEGRAM_API_URL}/bot{self.token}/getChatMember",
+                    params={'chat_id': str(channel_id), 'user_id': str(int(telegram_id))},
+                ) as r:
+                    payload = await r.json(content_type=None)
+                    if r.status == 200:
+                        return member_status(payload)
+                    retry_after = retry_after_of(r.status, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                return STATUS_ERROR
+            # 429: pause the whole cluster and retry once the pause is over
+            if retry_after is None or self.limiter is None or not await self.limiter.apause(retry_after):
+                return STATUS_ERROR
+        return STATUS_ERROR
+
+    async def _fetch(self, telegram_id: int, channel_id: int) -> str:
+        st = await self.status(telegram_id, channel_id)
+        if self.cache is not None:
+            await self.cache.aput(telegram_id, channel_id, st)
+        return st
+
+    async def check(self, telegram_id: int, mode: str = MODE_ALL, force_fresh: bool = False) -> Dict[str, Any]:
+        channels = self._channels()
+        if not self.token:
+            return _result(telegram_id, channels, {int(ch['channel_id']): STATUS_ERROR for ch in channels})
+        statuses: Dict[int, str] = {}
+        if not force_fresh:
+            # Ledger first, then the cache for what the ledger has not seen
+            for source in (self.ledger, self.cache):
+                if source is None:
+                    continue
+                missing = [(int(telegram_id), int(ch['channel_id'])) for ch in channels
+                           if int(ch['channel_id']) not in statuses]
+                statuses.update({cid: st for (_, cid), st in (await source.aget_many(missing)).items()})
+                if mode == MODE_ALL and any(not is_member_status(st) for st in statuses.values()):
+                    return _result(telegram_id, channels, statuses)
+        tasks = {asyncio.ensure_future(self._fetch(telegram_id, int(ch['channel_id']))): int(ch['channel_id'])
+                 for ch in channels if int(ch['channel_id']) not in statuses}
+        pending = set(tasks)
+        fetched: Dict[Pair, str] = {}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    statuses[tasks[task]] = fetched[(int(telegram_id), tasks[task])] = task.result()
+                if mode == MODE_ALL and any(not is_member_status(st) for st in statuses.values()):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        if self.ledger is not None and fetched:
+            await self.ledger.aapply(fetched)
+        return _result(telegram_id, channels, statuses)
+
+    async def check_many(self, telegram_ids: Iterable[int], mode: str = MODE_ALL,
+                         force_fresh: bool = False) -> Dict[int, Dict[str, Any]]:
+        ids = list(dict.fromkeys(int(t) for t in telegram_ids))
+        results = await asyncio.gather(*(self.check(tid, mode, force_fresh) for tid in ids))
+        return {r['telegram_id']: r for r in results}
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -0,0 +1,291 @@
+"""
+Cluster-wide Telegram Bot API rate limiter shared by the API, the referrals worker, the bot and tools/.
+
+All services use one bot token, so they draw from the same token buckets in Redis:
+  * global      - every call (TG_RATE_GLOBAL per second, TG_RATE_GLOBAL_BURST tokens)
+  * per method  - optional budgets from TG_RATE_METHODS, e.g. {"getChatMember": [20, 20]}
+  * per chat    - message-sending methods only: private chats ~1/s, groups/channels ~20/min
+
+One Lua script checks and takes every bucket of a call atomically, using Redis time,
+so replicas with skewed clocks still agree.
+
+Lanes give interactive traffic priority: a lane may only take a token while the global and
+method buckets stay above its reserve (a fraction of the bucket), so a broadcast in the "bulk"
+lane never drains the headroom a user's /check or a draw needs.
+
+A 429 from Telegram pauses every service for retry_after seconds (a key with that TTL that
+acquire waits on). Redis failures fail open: calls go out unthrottled, as before, and Redis
+is not retried for TG_RATE_REDIS_RETRY seconds.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LANE_INTERACTIVE = 'interactive'  # user-facing: /check, bot replies, draw verification
+LANE_BACKGROUND = 'background'    # worker jobs and sweeps
+LANE_BULK = 'bulk'                # broadcasts and one-off notification scripts
+
+TG_RATE_PREFIX = os.getenv('TG_RATE_PREFIX', 'gtm:tg_rate')
+TG_RATE_GLOBAL = float(os.getenv('TG_RATE_GLOBAL', '30'))
+TG_RATE_GLOBAL_BURST = float(os.getenv('TG_RATE_GLOBAL_BURST', '30'))
+TG_RATE_PRIVATE_CHAT = float(os.getenv('TG_RATE_PRIVATE_CHAT', '1'))
+TG_RATE_PRIVATE_CHAT_BURST = float(os.getenv('TG_RATE_PRIVATE_CHAT_BURST', '3'))
+TG_RATE_GROUP_CHAT_PER_MIN = float(os.getenv('TG_RATE_GROUP_CHAT_PER_MIN', '20'))
+TG_RATE_MAX_WAIT = float(os.getenv('TG_RATE_MAX_WAIT', '10'))
+TG_RATE_REDIS_RETRY = float(os.getenv('TG_RATE_REDIS_RETRY', '30'))
+
+# Share of a bucket each lane must leave untouched
+LANE_RESERVES: Dict[str, float] = {
+    LANE_INTERACTIVE: 0.0,
+    LANE_BACKGROUND: float(os.getenv('TG_RATE_BACKGROUND_RESERVE', '0.2')),
+    LANE_BULK: float(os.getenv('TG_RATE_BULK_RESERVE', '0.5')),
+}
+
+# Never throttled: long polling holds a request open for its whole timeout
+UNLIMITED_METHODS = frozenset({'getUpdates'})
+
+
+def _method_budgets() -> Dict[str, Tuple[float, float]]:
+    """{method: (rate per second, burst)} from TG_RATE_METHODS"""
+    raw = os.getenv('TG_RATE_METHODS', '{"getChatMember": [20, 20]}')
+    try:
+        data = json.loads(raw)
+        return {str(m): (float(v[0]), float(v[1])) for m, v in data.items()}
+    except Exception:
+        return {}
+
+
+def is_send_method(method: str) -> bool:
+    """Methods that post into a chat and count against its per-chat limit"""
+    return method.startswith('send') or method in ('copyMessage', 'forwardMessage')
+
+
+def retry_after_of(status_code: int, payload: Any) -> Optional[float]:
+    """retry_after of a 429 response body; None for any other response"""
+    if status_code != 429:
+        return None
+    try:
+        return float(((payload or {}).get('parameters') or {}).get('retry_after') or 1)
+    except Exception:
+        return 1.0
+
+
+def redis_getter(url: Optional[str]) -> Callable[[], Any]:
+    """Lazy sync client for scripts without their own Redis helper; None when url or redis is missing"""
+    state: Dict[str, Any] = {}
+
+    def get():
+        if 'client' not in state:
+            client = None
+            if url:
+                try:
+                    from redis import Redis
+                    client = Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+                except ImportError:
+                    client = None
+            state['client'] = client
+        return state['client']
+    return get
+
+
+# KEYS[1] - pause key, KEYS[2..] - buckets; ARGV per bucket: rate/s, capacity, reserve, cost.
+# Returns 0 when every bucket had the tokens (and they were taken), else milliseconds to wait.
+_ACQUIRE_LUA = """
+local paused = redis.call('PTTL', KEYS[1])
+if paused > 0 then return paused end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local levels = {}
+local wait = 0
+for i = 2, #KEYS do
+  local a = (i - 2) * 4
+  local rate, cap = tonumber(ARGV[a + 1]), tonumber(ARGV[a + 2])
+  local need = tonumber(ARGV[a + 3]) + tonumber(ARGV[a + 4])
+  local b = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+  local tokens, ts = tonumber(b[1]), tonumber(b[2])
+  if tokens == nil or ts == nil then tokens, ts = cap, now end
+  tokens = math.min(cap, tokens + math.max(0, now - ts) * rate / 1000)
+  levels[i] = tokens
+  if tokens < need then
+    local w = math.ceil((need - tokens) * 1000 / rate)
+    if w > wait then wait = w end
+  end
+end
+if wait > 0 then return wait end
+for i = 2, #KEYS do
+  local a = (i - 2) * 4
+  local rate, cap = tonumber(ARGV[a + 1]), tonumber(ARGV[a + 2])
+  redis.call('HSET', KEYS[i], 'tokens', levels[i] - tonumber(ARGV[a + 4]), 'ts', now)
+  redis.call('PEXPIRE', KEYS[i], math.ceil(cap * 1000 / rate) + 1000)
+end
+return 0
+"""
+
+Bucket = Tuple[str, float, float, float]  # (key, rate per second, capacity, reserve share)
+
+
+class TelegramRateLimiter:
+    """acquire(method, chat_id, lane) blocks until every bucket of the call has a token.
+    client() returns a redis client (sync for acquire/pause/run, redis.asyncio for the a* methods) or None."""
+
+    def __init__(self, client: Callable[[], Any], prefix: str = TG_RATE_PREFIX,
+                 max_wait: float = TG_RATE_MAX_WAIT):
+        self._client = client
+        self.prefix = prefix
+        self.max_wait = max_wait
+        self.methods = _method_budgets()
+        self._scripts: Dict[int, Any] = {}
+        self._down_until = 0.0
+        self.stats = {'acquired': 0, 'waited_ms': 0, 'timeouts': 0, 'pauses': 0, 'errors': 0}
+
+    def _redis(self) -> Any:
+        # After a Redis failure calls go out unthrottled for a while instead of waiting on timeouts
+        if time.monotonic() < self._down_until:
+            return None
+        return self._client()
+
+    def _failed(self) -> None:
+        self.stats['errors'] += 1
+        self._down_until = time.monotonic() + TG_RATE_REDIS_RETRY
+
+    @property
+    def pause_key(self) -> str:
+        return f"{self.prefix}:pause"
+
+    def buckets(self, method: str, chat_id: Optional[int] = None, lane: str = LANE_INTERACTIVE) -> List[Bucket]:
+        reserve = LANE_RESERVES.get(lane, 0.0)
+        out: List[Bucket] = [(f"{self.prefix}:global", TG_RATE_GLOBAL, TG_RATE_GLOBAL_BURST, reserve)]
+        if method in self.methods:
+            rate, burst = self.methods[method]
+            out.append((f"{self.prefix}:method:{method}", rate, burst, reserve))
+        if chat_id is not None and is_send_method(method):
+            if int(chat_id) > 0:
+                out.append((f"{self.prefix}:chat:{int(chat_id)}", TG_RATE_PRIVATE_CHAT, TG_RATE_PRIVATE_CHAT_BURST, 0.0))
+            else:
+                out.append((f"{self.prefix}:chat:{int(chat_id)}", TG_RATE_GROUP_CHAT_PER_MIN / 60.0,
+                            TG_RATE_GROUP_CHAT_PER_MIN, 0.0))
+        return out
+
+    def _script(self, r: Any) -> Any:
+        script = self._scripts.get(id(r))
+        if script is None:
+            script = self._scripts[id(r)] = r.register_script(_ACQUIRE_LUA)
+        return script
+
+    def _call_args(self, buckets: List[Bucket]) -> Tuple[List[str], List[float]]:
+        keys = [self.pause_key] + [b[0] for b in buckets]
+        args: List[float] = []
+        for _, rate, cap, reserve in buckets:
+            args += [rate, cap, reserve * cap, 1]
+        return keys, args
+
+    def _timeout(self, max_wait: Optional[float]) -> float:
+        return time.monotonic() + (self.max_wait if max_wait is None else max_wait)
+
+    def _sleep_for(self, wait_ms: int, deadline: float) -> Optional[float]:
+        """Seconds to sleep before the next try (with jitter so replicas do not retry in step); None - give up"""
+        left = deadline - time.monotonic()
+        if left <= 0:
+            self.stats['timeouts'] += 1
+            return None
+        self.stats['waited_ms'] += int(wait_ms)
+        return min(left, wait_ms / 1000.0 * (1 + random.random() * 0.2) + 0.005)
+
+    def acquire(self, method: str, chat_id: Optional[int] = None, lane: str = LANE_INTERACTIVE,
+                max_wait: Optional[float] = None) -> bool:
+        """True - the call may go out; False - no token within max_wait"""
+        if method in UNLIMITED_METHODS:
+            return True
+        r = self._redis()
+        if r is None:
+            return True
+        keys, args = self._call_args(self.buckets(method, chat_id, lane))
+        deadline = self._timeout(max_wait)
+        while True:
+            try:
+                wait_ms = int(self._script(r)(keys=keys, args=args))
+            except Exception:
+                self._failed()
+                return True
+            if wait_ms <= 0:
+                self.stats['acquired'] += 1
+                return True
+            delay = self._sleep_for(wait_ms, deadline)
+            if delay is None:
+                return False
+            time.sleep(delay)
+
+    async def aacquire(self, method: str, chat_id: Optional[int] = None, lane: str = LANE_INTERACTIVE,
+                       max_wait: Optional[float] = None) -> bool:
+        if method in UNLIMITED_METHODS:
+            return True
+        r = self._redis()
+        if r is None:
+            return True
+        keys, args = self._call_args(self.buckets(method, chat_id, lane))
+        deadline = self._timeout(max_wait)
+        while True:
+            try:
+                wait_ms = int(await self._script(r)(keys=keys, args=args))
+            except Exception:
+                self._failed()
+                return True
+            if wait_ms <= 0:
+                self.stats['acquired'] += 1
+                return True
+            delay = self._sleep_for(wait_ms, deadline)
+            if delay is None:
+                return False
+            await asyncio.sleep(delay)
+
+    def pause(self, retry_after: float) -> bool:
+        """Telegram answered 429: stop every service for retry_after seconds (never shortens a longer pause).
+        False - there is no Redis to share the pause through"""
+        r = self._redis()
+        if r is None:
+            return False
+        self.stats['pauses'] += 1
+        try:
+            ms = max(1, int(float(retry_after) * 1000))
+            if (r.pttl(self.pause_key) or 0) < ms:
+                r.set(self.pause_key, 1, px=ms)
+            return True
+        except Exception:
+            self._failed()
+            return False
+
+    async def apause(self, retry_after: float) -> bool:
+        r = self._redis()
+        if r is None:
+            return False
+        self.stats['pauses'] += 1
+        try:
+            ms = max(1, int(float(retry_after) * 1000))
+            if (await r.pttl(self.pause_key) or 0) < ms:
+                await r.set(self.pause_key, 1, px=ms)
+            return True
+        except Exception:
+            self._failed()
+            return False
+
+    def run(self, method: str, call: Callable[[], Any], chat_id: Optional[int] = None,
+            lane: str = LANE_INTERACTIVE, attempts: int = 3, max_wait: Optional[float] = None) -> Any:
+        """call() performs the request and returns a requests.Response. A 429 pauses the cluster
+        and the call is retried once the pause is over (without Redis the 429 is returned as is).
+        None - no token within max_wait."""
+        response = None
+        for _ in range(max(1, attempts)):
+            if not self.acquire(method, chat_id, lane, max_wait):
+                return response
+            response = call()
+            try:
+                payload = response.json() if response.status_code == 429 else None
+            except Exception:
+                payload = None
+            retry_after = retry_after_of(response.status_code, payload)
+            if retry_after is None or not self.pause(retry_after):
+                return response
+        return response
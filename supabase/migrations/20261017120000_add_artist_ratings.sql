@@ -0,0 +1,39 @@
+-- Batch of artist ratings in one round-trip (/api/rate-artists/batch and the write-behind flusher).
+-- Every row goes through the existing add_artist_rating, so the batch keeps its semantics
+-- (validation, replacing the user's previous rating) without relying on any unique key.
+-- A rejected row only rolls back its own subtransaction; the rest of the batch is committed.
+--
+-- ratings: [{"artist_name": text, "user_id": text, "rating": int, "comment": text|null}, ...]
+-- returns: [{"success": bool, "error": text|null}, ...] in the order of ratings
+create or replace function public.add_artist_ratings(ratings jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+  item jsonb;
+  res jsonb;
+  out jsonb := '[]'::jsonb;
+begin
+  for item in select value from jsonb_array_elements(ratings) with ordinality order by ordinality loop
+    begin
+      res := to_jsonb(public.add_artist_rating(
+        artist_name_param => item->>'artist_name',
+        user_id_param => item->>'user_id',
+        rating_param => (item->>'rating')::int,
+        comment_param => item->>'comment'
+      ));
+      if coalesce((res->>'success')::boolean, false) then
+        out := out || jsonb_build_array(jsonb_build_object('success', true, 'error', null));
+      else
+        out := out || jsonb_build_array(jsonb_build_object('success', false,
+                                                           'error', coalesce(res->>'error', 'Unknown error')));
+      end if;
+    exception when others then
+      out := out || jsonb_build_array(jsonb_build_object('success', false, 'error', sqlerrm));
+    end;
+  end loop;
+  return out;
+end;
+$$;
+
+grant execute on function public.add_artist_ratings(jsonb) to anon, authenticated, service_role;
@@ -0,0 +1,27 @@
+-- Replace a giveaway's winners in one transaction (api/rating_api.py _replace_giveaway_winners).
+-- Readers see either the previous complete list or the new one, also when the number of
+-- places shrinks. No unique key on (giveaway_id, place_number) is needed.
+--
+-- winners: [{"place_number", "winner_telegram_id", "winner_username", "winner_first_name",
+--            "prize_name", "prize_value", "winner_tickets", "is_first_winner"}, ...]
+-- returns: number of stored places
+create or replace function public.replace_giveaway_winners(p_giveaway_id bigint, p_winners jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+  stored integer;
+begin
+  delete from public.giveaway_winners where giveaway_id = p_giveaway_id;
+  insert into public.giveaway_winners (giveaway_id, place_number, winner_telegram_id, winner_username,
+                                       winner_first_name, prize_name, prize_value, winner_tickets,
+                                       is_first_winner)
+  select p_giveaway_id, w.place_number, w.winner_telegram_id, w.winner_username, w.winner_first_name,
+         w.prize_name, w.prize_value, w.winner_tickets, w.is_first_winner
+  from jsonb_populate_recordset(null::public.giveaway_winners, p_winners) as w;
+  get diagnostics stored = row_count;
+  return stored;
+end;
+$$;
+
+grant execute on function public.replace_giveaway_winners(bigint, jsonb) to anon, authenticated, service_role;
@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+import draw_eligibility
+from draw_eligibility import ELIGIBILITY_KEY, EligibilityIndex
+from giveaway_draw import DrawSnapshot
+from shared.tg_membership import (
+    STATUS_ERROR, STATUS_SKIPPED, eligibility_entry, subscription_verdict,
+)
+
+# (telegram_id, total_tickets, subscription_tickets)
+SNAPSHOT = DrawSnapshot.from_rows([(1, 3, 1), (2, 2, 0), (3, 4, 2), (4, 1, 1), (5, 5, 1)])
+
+
+@pytest.fixture
+def redis_index(fake_redis, monkeypatch):
+    monkeypatch.setattr(draw_eligibility, 'get_redis', lambda: fake_redis)
+    return EligibilityIndex(excluded=[5, 99])
+
+
+def _report(subscribed, **channels):
+    return {'subscribed': subscribed, 'channels': {int(k[1:]): v for k, v in channels.items()}}
+
+
+def test_verdict_is_undecided_when_a_channel_could_not_be_checked():
+    assert subscription_verdict(_report(True, c1='member', c2='administrator')) is True
+    assert subscription_verdict(_report(False, c1='member', c2='left')) is False
+    assert subscription_verdict(_report(False, c1='member', c2=STATUS_ERROR)) is None
+    assert subscription_verdict(_report(False, c1=STATUS_SKIPPED, c2=STATUS_ERROR)) is None
+    # A decided refusal on one channel outweighs an error on another
+    assert subscription_verdict(_report(False, c1='kicked', c2=STATUS_ERROR)) is False
+
+
+def test_excluded_in_masks_only_listed_participants(redis_index):
+    redis_index.record({1: False})
+    assert redis_index.excluded_in(SNAPSHOT) == [5]
+
+
+def test_refusals_never_mask_by_default(redis_index):
+    redis_index.record({1: False, 3: False})
+    assert redis_index.refused(SNAPSHOT) == []
+
+
+def test_refusals_mask_holders_within_the_window(redis_index, fake_redis, monkeypatch):
+    monkeypatch.setattr(draw_eligibility, 'ELIGIBILITY_UNSUBSCRIBED_TTL', 60)
+    redis_index.record({1: False}, at=time.time() - 61)
+    redis_index.record({2: False, 3: False})
+    # Written by the worker / bot through shared.tg_membership
+    fake_redis.hset(ELIGIBILITY_KEY, '4', eligibility_entry(False, time.time()))
+    # 1 is stale, 2 holds no subscription tickets
+    assert redis_index.refused(SNAPSHOT) == [3, 4]
+
+
+def test_later_check_overrides_refusal(redis_index, monkeypatch):
+    monkeypatch.setattr(draw_eligibility, 'ELIGIBILITY_UNSUBSCRIBED_TTL', 60)
+    redis_index.record({1: False}, at=time.time() - 10)
+    redis_index.record({1: True})
+    assert redis_index.refused(SNAPSHOT) == []
+
+
+def test_recently_subscribed_respects_verified_ttl(redis_index, monkeypatch):
+    monkeypatch.setattr(draw_eligibility, 'ELIGIBILITY_VERIFIED_TTL', 60)
+    redis_index.record({1: True}, at=time.time() - 120)
+    redis_index.record({3: True, 4: False})
+    assert redis_index.recently_subscribed([1, 3, 4]) == {3}
+
+
+def test_reads_in_chunks(redis_index, monkeypatch):
+    monkeypatch.setattr(draw_eligibility, 'ELIGIBILITY_UNSUBSCRIBED_TTL', 60)
+    monkeypatch.setattr(draw_eligibility, 'ELIGIBILITY_READ_CHUNK', 2)
+    redis_index.record({1: False, 4: False, 5: False})
+    assert redis_index.refused(SNAPSHOT) == [1, 4, 5]
+
+
+def test_without_redis_state_stays_in_process(monkeypatch):
+    monkeypatch.setattr(draw_eligibility, 'get_redis', lambda: None)
+    monkeypatch.setattr(draw_eligibility, 'ELIGIBILITY_UNSUBSCRIBED_TTL', 60)
+    index = EligibilityIndex()
+    index.record({4: False})
+    assert index.refused(SNAPSHOT) == [4]
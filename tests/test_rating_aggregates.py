@@ -0,0 +1,31 @@
+import rating_aggregates
+from rating_aggregates import RatingAggregates
+
+
+def _aggregates(db, monkeypatch):
+    monkeypatch.setattr(rating_aggregates, 'get_redis', lambda: None)
+    rows = lambda: [(a, u, r) for (a, u), r in db.items()]
+    aggs = RatingAggregates(load_all=rows, load_artist=lambda name: [row for row in rows() if row[0] == name],
+                            remote_stats=lambda name: None)
+    aggs.warm()
+    return aggs
+
+
+def test_revert_restores_the_stored_rating(monkeypatch):
+    db = {('artist', '1'): 2}
+    aggs = _aggregates(db, monkeypatch)
+    # Optimistic write-behind ratings; the database then rejects both
+    aggs.apply('artist', '1', 5)
+    aggs.apply('artist', '2', 4)
+    aggs.revert_many([('artist', '1', 5), ('artist', '2', 4)])
+    stats = aggs.stats('artist')
+    assert stats['total_ratings'] == 1
+    assert stats['average_rating'] == 2.0
+
+
+def test_revert_keeps_a_newer_rating(monkeypatch):
+    aggs = _aggregates({}, monkeypatch)
+    aggs.apply('artist', '1', 5)
+    aggs.apply('artist', '1', 3)
+    aggs.revert_many([('artist', '1', 5)])
+    assert aggs.stats('artist')['average_rating'] == 3.0
@@ -0,0 +1,163 @@
+import json
+
+import pytest
+
+import rating_writer
+from rating_writer import (
+    FIELD_SEP, FLUSH_LOCK_KEY, PENDING_KEY, PROCESSING_KEY, BufferFull, RatingWriter, RetryLater,
+)
+
+pytest.importorskip('lupa')  # fakeredis runs EVAL through lupa
+
+
+def _row(user_id, rating, artist='artist'):
+    return {'artist_name': artist, 'user_id': str(user_id), 'rating': rating, 'comment': None}
+
+
+def _field(row):
+    return f"{row['artist_name']}{FIELD_SEP}{row['user_id']}".encode()
+
+
+def _pending(r, key=PENDING_KEY):
+    return {k: json.loads(v)['rating'] for k, v in r.hgetall(key).items()}
+
+
+@pytest.fixture
+def redis(fake_redis, monkeypatch):
+    monkeypatch.setattr(rating_writer, 'get_redis', lambda: fake_redis)
+    monkeypatch.setattr(RatingWriter, 'ensure_started', lambda self: None)
+    return fake_redis
+
+
+def test_enqueue_script_caps_buffer_but_always_replaces(redis):
+    assert redis.eval(rating_writer._ENQUEUE_SCRIPT, 1, 'buf', 2, 'a', 'v1') == 1
+    assert redis.eval(rating_writer._ENQUEUE_SCRIPT, 1, 'buf', 2, 'b', 'v1') == 2
+    assert redis.eval(rating_writer._ENQUEUE_SCRIPT, 1, 'buf', 2, 'c', 'v1') == -1
+    # A newer rating for a queued key goes in even when the buffer is full
+    assert redis.eval(rating_writer._ENQUEUE_SCRIPT, 1, 'buf', 2, 'a', 'v2') == 2
+    assert redis.hgetall('buf') == {b'a': b'v2', b'b': b'v1'}
+
+
+def test_enqueue_script_takes_all_rows_or_none(redis):
+    redis.hset('buf', 'a', 'v1')
+    # Only one new key fits: the batch is refused as a whole, the replacement of "a" included
+    assert redis.eval(rating_writer._ENQUEUE_SCRIPT, 1, 'buf', 2, 'a', 'v2', 'b', 'v1', 'c', 'v1') == -1
+    assert redis.hgetall('buf') == {b'a': b'v1'}
+    assert redis.eval(rating_writer._ENQUEUE_SCRIPT, 1, 'buf', 2, 'a', 'v2', 'b', 'v1') == 2
+    assert redis.hgetall('buf') == {b'a': b'v2', b'b': b'v1'}
+
+
+def test_restore_script_keeps_newer_pending_ratings(redis):
+    redis.hset('processing', mapping={'a': 'old-a', 'b': 'old-b'})
+    redis.hset('pending', mapping={'a': 'new-a'})
+    assert redis.eval(rating_writer._RESTORE_SCRIPT, 2, 'pending', 'processing') == 2
+    assert redis.hgetall('pending') == {b'a': b'new-a', b'b': b'old-b'}
+    assert not redis.exists('processing')
+
+
+def test_enqueue_rejects_new_keys_when_full(redis, monkeypatch):
+    monkeypatch.setattr(rating_writer, 'RATING_BUFFER_MAX', 1)
+    writer = RatingWriter(write_batch=lambda rows: [None] * len(rows))
+    writer.enqueue(_row(1, 3))
+    writer.enqueue(_row(1, 4))
+    with pytest.raises(BufferFull):
+        writer.enqueue(_row(2, 5))
+    with pytest.raises(BufferFull):
+        writer.enqueue_many([_row(1, 5), _row(3, 5)])
+    assert _pending(redis) == {_field(_row(1, 4)): 4}
+
+
+def _writer(write_one, **kwargs):
+    """RatingWriter whose batch write calls write_one per row (a stand-in for add_artist_ratings)"""
+    batches = []
+
+    def write_batch(rows):
+        batches.append([row['user_id'] for row in rows])
+        return [write_one(row) for row in rows]
+
+    return RatingWriter(write_batch=write_batch, **kwargs), batches
+
+
+def test_failed_flush_goes_back_to_pending_without_overwriting(redis):
+    def unavailable(row):
+        # A newer rating arrives while the batch is in flight
+        redis.hset(PENDING_KEY, _field(_row(1, 5)), json.dumps({**_row(1, 5), 't': 0}))
+        raise RetryLater('Supabase error: 503')
+
+    writer, _ = _writer(unavailable)
+    writer.enqueue(_row(1, 2))
+    writer.enqueue(_row(2, 3))
+    assert writer.flush() == 0
+    assert _pending(redis) == {_field(_row(1, 5)): 5, _field(_row(2, 3)): 3}
+    assert not redis.exists(PROCESSING_KEY)
+    assert not redis.exists(FLUSH_LOCK_KEY)
+    assert writer.metrics()['failed_flushes'] == 1
+
+
+def test_flush_writes_in_chunks_and_restores_only_the_unwritten_rest(redis, monkeypatch):
+    monkeypatch.setattr(rating_writer, 'RATING_FLUSH_BATCH', 2)
+    written = []
+
+    def write_one(row):
+        if len(written) == 2:
+            raise RetryLater('Supabase error: 503')
+        written.append(row['user_id'])
+
+    writer, batches = _writer(write_one)
+    writer.enqueue_many([_row(user_id, 3) for user_id in range(1, 6)])
+    assert writer.flush() == 2
+    assert [len(b) for b in batches] == [2, 2]
+    # The first chunk is not written twice: only the other three rows go back to pending
+    assert sorted(_pending(redis)) == sorted(_field(_row(u, 3)) for u in range(1, 6) if str(u) not in written)
+    assert writer.metrics()['flushed'] == 2
+
+
+def test_flush_drops_rejected_rows_and_reports_them(redis):
+    written, rejected = [], []
+
+    def write_one(row):
+        if row['rating'] == 5:
+            return 'rating rejected'
+        written.append(row['user_id'])
+
+    writer, _ = _writer(write_one, on_rejected=rejected.extend)
+    for user_id, rating in ((1, 4), (2, 5), (3, 1)):
+        writer.enqueue(_row(user_id, rating))
+    assert writer.flush() == 3
+    assert sorted(written) == ['1', '3']
+    assert [row['user_id'] for row in rejected] == ['2']
+    assert not redis.exists(PENDING_KEY) and not redis.exists(PROCESSING_KEY)
+    assert writer.metrics()['dropped'] == 1
+
+
+def test_leftover_processing_batch_is_written_first(redis):
+    redis.hset(PROCESSING_KEY, _field(_row(7, 2)), json.dumps({**_row(7, 2), 't': 0}))
+    writer, batches = _writer(lambda row: None)
+    writer.enqueue(_row(8, 3))
+    assert writer.flush() == 1
+    assert writer.flush() == 1
+    assert batches == [['7'], ['8']]
+
+
+def test_flush_skips_while_another_replica_holds_the_lock(redis):
+    redis.set(FLUSH_LOCK_KEY, 'other')
+    writer, batches = _writer(lambda row: None)
+    writer.enqueue(_row(1, 3))
+    assert writer.flush() == 0
+    assert batches == [] and redis.get(FLUSH_LOCK_KEY) == b'other'
+
+
+def test_lost_lock_stops_the_pass_and_is_not_released(redis, monkeypatch):
+    monkeypatch.setattr(rating_writer, 'RATING_FLUSH_BATCH', 1)
+
+    def slow(row):
+        # Our lock expired mid-write and another replica took it
+        redis.set(FLUSH_LOCK_KEY, 'other')
+
+    writer, batches = _writer(slow)
+    writer.enqueue_many([_row(1, 3), _row(2, 3)])
+    assert writer.flush() == 1
+    assert len(batches) == 1
+    assert redis.get(FLUSH_LOCK_KEY) == b'other'
+    # The rest stays in processing for the replica that owns the lock now
+    assert redis.hlen(PROCESSING_KEY) == 1
@@ -0,0 +1,26 @@
+import shared_cache
+from shared_cache import SharedTTLCache, extend_lock, release_lock
+
+
+def test_lock_is_released_and_extended_only_by_its_owner(fake_redis):
+    fake_redis.set('lock', 'mine', px=1000)
+    assert not release_lock(fake_redis, 'lock', 'theirs')
+    assert not extend_lock(fake_redis, 'lock', 'theirs', 60000)
+    assert extend_lock(fake_redis, 'lock', 'mine', 60000)
+    assert fake_redis.pttl('lock') > 1000
+    assert release_lock(fake_redis, 'lock', 'mine')
+    assert not fake_redis.exists('lock')
+
+
+def test_refresh_does_not_drop_a_lock_taken_over_by_another_replica(fake_redis, monkeypatch):
+    monkeypatch.setattr(shared_cache, 'get_redis', lambda: fake_redis)
+    cache = SharedTTLCache('test', ttl=10, stale_ttl=10)
+    lock_key = cache._key('k') + ':lock'
+
+    def fetch():
+        # The refresh outlived lock_ttl and another replica locked the key
+        fake_redis.set(lock_key, 'other')
+        return 1
+
+    assert cache.get_or_fetch('k', fetch) == 1
+    assert fake_redis.get(lock_key) == b'other'
@@ -31,6 +31,7 @@ from __future__ import annotations
 import argparse
 import json
 import os
+import sys
 import time
 from dataclasses import dataclass
 from pathlib import Path
@@ -45,11 +46,25 @@ try:
 except Exception:
     pass
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from shared.tg_ratelimit import LANE_BULK, TelegramRateLimiter, redis_getter  # noqa: E402
+
 
 TELEGRAM_BOT_TOKEN = (os.getenv("TELEGRAM_BOT_TOKEN") or "").strip()
 SUPABASE_URL = (os.getenv("SUPABASE_URL") or "").strip()
 SUPABASE_SERVICE_ROLE_KEY = (os.getenv("SUPABASE_SERVICE_ROLE_KEY") or "").strip()
 
+# Sends share the cluster-wide Telegram buckets (REDIS_URL) in the bulk lane, so a broadcast
+# never eats the headroom of the bot's replies and subscription checks. Without Redis only
+# --sleep paces the run.
+BROADCAST_MAX_WAIT = float(os.getenv("BROADCAST_MAX_WAIT", "120"))
+_limiter = TelegramRateLimiter(redis_getter(os.getenv("REDIS_URL")), max_wait=BROADCAST_MAX_WAIT)
+
+
+def _tg_post(method: str, chat_id: int, call) -> Optional[requests.Response]:
+    """call() performs the request; None if the bulk lane got no token within BROADCAST_MAX_WAIT"""
+    return _limiter.run(method, call, chat_id=chat_id, lane=LANE_BULK)
+
 
 # Predefined templates (ru)
 TEMPLATES = {
@@ -178,9 +193,11 @@ def tg_send_message(chat_id: int, text: str, parse_mode: Optional[str], disable_
     if parse_mode:
         payload["parse_mode"] = parse_mode
     try:
-        r = requests.post(url, json=payload, timeout=20)
+        r = _tg_post("sendMessage", chat_id, lambda: requests.post(url, json=payload, timeout=20))
     except requests.RequestException as e:
         return False, f"request_exception:{type(e).__name__}:{str(e)}"
+    if r is None:
+        return False, "rate_limited:1"
     if r.status_code == 429:
         try:
             retry = int((r.json() or {}).get("parameters", {}).get("retry_after", 1))
@@ -206,8 +223,11 @@ def tg_send_photo(chat_id: int, photo_url: Optional[str], photo_file: Optional[P
                 payload["caption"] = caption
             if parse_mode:
                 payload["parse_mode"] = parse_mode
+            def call():
+                f.seek(0)  # a retry after 429 uploads the file again
+                return requests.post(url, data=payload, files=data, timeout=30)
             try:
-                r = requests.post(url, data=payload, files=data, timeout=30)
+                r = _tg_post("sendPhoto", chat_id, call)
             except requests.RequestException as e:
                 return False, f"request_exception:{type(e).__name__}:{str(e)}"
     else:
@@ -217,9 +237,11 @@ def tg_send_photo(chat_id: int, photo_url: Optional[str], photo_file: Optional[P
         if parse_mode:
             payload["parse_mode"] = parse_mode
         try:
-            r = requests.post(url, json=payload, timeout=20)
+            r = _tg_post("sendPhoto", chat_id, lambda: requests.post(url, json=payload, timeout=20))
         except requests.RequestException as e:
             return False, f"request_exception:{type(e).__name__}:{str(e)}"
+    if r is None:
+        return False, "rate_limited:1"
     if r.status_code == 429:
         try:
             retry = int((r.json() or {}).get("parameters", {}).get("retry_after", 1))
@@ -269,7 +291,12 @@ def tg_send_media_group(chat_id: int, photo_files: List[Path], caption: Optional
             "media": json.dumps(media)
         }
         
-        r = requests.post(url, data=payload, files=files, timeout=60)
+        def call():
+            for f in files.values():
+                f.seek(0)  # a retry after 429 uploads the files again
+            return requests.post(url, data=payload, files=files, timeout=60)
+
+        r = _tg_post("sendMediaGroup", chat_id, call)
         
         # Close all file handles
         for f in files.values():
@@ -281,6 +308,8 @@ def tg_send_media_group(chat_id: int, photo_files: List[Path], caption: Optional
             f.close()
         return False, f"request_exception:{type(e).__name__}:{str(e)}"
     
+    if r is None:
+        return False, "rate_limited:1"
     if r.status_code == 429:
         try:
             retry = int((r.json() or {}).get("parameters", {}).get("retry_after", 1))
@@ -614,16 +643,8 @@ def main() -> None:
             }, ensure_ascii=False) + "\n")
             rep.flush()
 
-            # Handle simple rate-limiting
-            if isinstance(detail, str) and detail.startswith("rate_limited:"):
-                try:
-                    retry_after = int(detail.split(":", 1)[1])
-                except Exception:
-                    retry_after = 1
-                print(f"rate limited: sleep {retry_after + 0.5:.1f}s", flush=True)
-                time.sleep(retry_after + 0.5)
-            else:
-                time.sleep(sleep_s)
+            # 429 pauses and retries are handled by _limiter.run; this only spaces out the sends
+            time.sleep(sleep_s)
 
     print(json.dumps({
         "users": total,
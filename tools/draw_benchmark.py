@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark and fairness simulator for the giveaway draw engine.
+
+Runs against generated user populations (no Supabase, no Telegram):
+  * sampler     - snapshot build, Fenwick build, draws/sec and peak memory (api/giveaway_draw.py)
+  * endpoints   - _draw_giveaway_winners and generate_giveaway_results end to end, with the
+                  data sources replaced by the generated population (needs api/requirements.txt)
+  * fairness    - chi-square goodness of fit of place 1 and place 2 against the exact
+                  ticket-weighted distribution over many seeded draws
+
+Examples:
+  python tools/draw_benchmark.py --sizes 100000,1000000,10000000
+  python tools/draw_benchmark.py --ci            # small sizes, exits 1 on regression
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+sys.path.insert(0, API_DIR)
+
+from giveaway_draw import DrawSnapshot, WeightedSampler, draw_giveaway  # noqa: E402
+
+PLACES = [2, 3, 4, 5, 6]
+
+
+# --- populations ---
+
+def generate_population(n: int, seed: int = 1) -> List[Tuple[int, int, int]]:
+    """(telegram_id, total_tickets, subscription_tickets) with a long-tailed ticket distribution:
+    most users hold 1-3 tickets, a few referrers hold dozens."""
+    rng = random.Random(seed)
+    users = []
+    tid = 100_000_000
+    for _ in range(n):
+        tid += rng.randint(1, 50)
+        tickets = min(200, int(rng.paretovariate(1.6)))
+        subs = 1 if rng.random() < 0.6 else 0
+        users.append((tid, tickets + subs, subs))
+    return users
+
+
+def linear_choice(users: List[Tuple[int, int, int]], rng: random.Random) -> int:
+    """Reference implementation of the original linear _weighted_choice (same pick semantics)."""
+    total = sum(u[1] for u in users if u[1] > 0)
+    pick = rng.randint(1, total)
+    acc = 0
+    for u in users:
+        if u[1] <= 0:
+            continue
+        acc += u[1]
+        if pick <= acc:
+            return u[0]
+    return users[-1][0]
+
+
+# --- measurements ---
+
+def timed(fn: Callable[[], Any]) -> Tuple[Any, float]:
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def peak_memory(fn: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_sampler(users: List[Tuple[int, int, int]], draws: int, seed: int) -> Dict[str, Any]:
+    snapshot, snapshot_s = timed(lambda: DrawSnapshot.from_rows(users))
+    tree, tree_s = timed(snapshot.tree)
+    sampler = WeightedSampler.from_arrays(snapshot.ids, snapshot.tickets, tree, seed=seed)
+    draws = min(draws, len(snapshot))
+    _, pop_s = timed(lambda: [sampler.pop() for _ in range(draws)])
+    record, draw_s = timed(lambda: draw_giveaway(snapshot, seed, PLACES, draw_first=True))
+    _, hash_s = timed(lambda: DrawSnapshot(snapshot.ids, snapshot.tickets, snapshot.subs).sha256)
+    return {
+        "users": len(users),
+        "participants": len(snapshot),
+        "snapshot_build_s": round(snapshot_s, 4),
+        "fenwick_build_s": round(tree_s, 4),
+        "sha256_s": round(hash_s, 4),
+        "draws_per_sec": int(draws / pop_s) if pop_s else None,
+        "draw_6_places_s": round(draw_s, 5),
+        "time_per_place_ms": round(draw_s / (len(PLACES) + 1) * 1000, 4),
+        "winners": len(record["winners"]) + (1 if record["first"] else 0),
+        "peak_memory_mb": round(peak_memory(lambda: DrawSnapshot.from_rows(users).tree()) / 2 ** 20, 1),
+    }
+
+
+def bench_linear(users: List[Tuple[int, int, int]], draws: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    _, s = timed(lambda: [linear_choice(users, rng) for _ in range(draws)])
+    return {"users": len(users), "linear_draws_per_sec": round(draws / s, 1) if s else None}
+
+
+def bench_endpoints(users: List[Tuple[int, int, int]]) -> Dict[str, Any]:
+    """Run the real draw functions with the Supabase/Telegram edges replaced by the population."""
+    import tempfile
+    os.environ.setdefault("DRAW_SNAPSHOT_DIR", tempfile.mkdtemp(prefix="draw-bench-"))
+    import rating_api as ra
+
+    by_id = {u[0]: u for u in users}
+    ra._iter_users = lambda params=None, compact=False, **kw: iter(users)
+    ra._get_users_by_ids = lambda ids, select=None: {int(t): {"telegram_id": int(t), "username": f"u{t}", "first_name": ""}
+                                                      for t in ids if int(t) in by_id}
+    ra._get_first_place_winner = lambda: None
+    ra._get_supabase_rows = lambda endpoint, select=None, params=None: []
+    ra._get_cached_giveaway_results = lambda giveaway_id=1: None
+    ra._save_giveaway_results_to_cache = lambda winners: None
+    ra._record_draw = lambda giveaway_id, record: None
+    ra._verify_subscriptions = lambda ids: {t: True for t in ids}
+
+    winners, draw_s = timed(ra._draw_giveaway_winners)
+    client = ra.app.test_client()
+    resp, gen_s = timed(lambda: client.post("/api/giveaway/generate-results", json={"giveaway_id": 1}))
+    return {
+        "users": len(users),
+        "draw_giveaway_winners_s": round(draw_s, 3),
+        "draw_giveaway_winners_places": len(winners),
+        "generate_giveaway_results_s": round(gen_s, 3),
+        "generate_giveaway_results_status": resp.status_code,
+    }
+
+
+# --- fairness ---
+
+def chi_square_sf(stat: float, dof: int) -> float:
+    """P(X >= stat) for X ~ chi2(dof): regularized upper incomplete gamma Q(dof/2, stat/2)."""
+    a, x = dof / 2.0, stat / 2.0
+    if x <= 0:
+        return 1.0
+    gln = math.lgamma(a)
+    if x < a + 1:
+        term = total = 1.0 / a
+        ap = a
+        for _ in range(10000):
+            ap += 1
+            term *= x / ap
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return max(0.0, 1.0 - total * math.exp(-x + a * math.log(x) - gln))
+    b = x + 1 - a
+    c = 1e300
+    d = 1 / b
+    h = d
+    for i in range(1, 10000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = 1e-300 if abs(d) < 1e-300 else d
+        c = b + an / c
+        c = 1e-300 if abs(c) < 1e-300 else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, math.exp(-x + a * math.log(x) - gln) * h)
+
+
+def chi_square(observed: Dict[int, int], expected: Dict[int, float]) -> Tuple[float, int, float]:
+    stat = sum((observed.get(k, 0) - e) ** 2 / e for k, e in expected.items() if e > 0)
+    dof = sum(1 for e in expected.values() if e > 0) - 1
+    return stat, dof, chi_square_sf(stat, dof)
+
+
+def fairness(runs: int, seed: int, population: int = 40) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    users = [(i, rng.randint(1, 12), 0) for i in range(1, population + 1)]
+    snapshot = DrawSnapshot.from_rows(users)
+    weights = {u[0]: u[1] for u in users}
+    total = sum(weights.values())
+    p1 = {t: w / total for t, w in weights.items()}
+    # Second place without replacement: sum_i p_i * w_j / (T - w_i)
+    p2 = {j: sum(p1[i] * wj / (total - weights[i]) for i in weights if i != j) for j, wj in weights.items()}
+
+    first: Dict[int, int] = {}
+    second: Dict[int, int] = {}
+    tree = snapshot.tree()
+    for r in range(runs):
+        sampler = WeightedSampler.from_arrays(snapshot.ids, snapshot.tickets, list(tree), seed=seed * 1_000_003 + r)
+        a, b = sampler.pop(), sampler.pop()
+        first[a] = first.get(a, 0) + 1
+        second[b] = second.get(b, 0) + 1
+
+    out = {"runs": runs, "population": population}
+    for name, observed, probs in (("place_1", first, p1), ("place_2", second, p2)):
+        stat, dof, p = chi_square(observed, {k: v * runs for k, v in probs.items()})
+        out[name] = {"chi2": round(stat, 2), "dof": dof, "p_value": round(p, 5)}
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark and fairness simulation for the giveaway draw engine.")
+    ap.add_argument("--sizes", default="100000,1000000", help="comma separated population sizes")
+    ap.add_argument("--draws", type=int, default=50000, help="sampler pops per size")
+    ap.add_argument("--runs", type=int, default=20000, help="fairness simulation runs")
+    ap.add_argument("--seed", type=int, default=20250818)
+    ap.add_argument("--endpoints", action="store_true", help="also run the real draw functions from rating_api")
+    ap.add_argument("--baseline", action="store_true", help="also time the original linear choice (slow)")
+    ap.add_argument("--alpha", type=float, default=0.001, help="fail if a fairness p-value is below this")
+    ap.add_argument("--min-draws-per-sec", type=float, default=0, help="fail if the sampler is slower than this")
+    ap.add_argument("--max-draw-seconds", type=float, default=0, help="fail if a 6-place draw takes longer")
+    ap.add_argument("--ci", action="store_true", help="small, fast preset with regression thresholds")
+    ap.add_argument("--json", help="write the report to this file")
+    args = ap.parse_args()
+
+    if args.ci:
+        args.sizes = "100000"
+        args.draws = min(args.draws, 20000)
+        args.runs = min(args.runs, 20000)
+        args.min_draws_per_sec = args.min_draws_per_sec or 20000
+        args.max_draw_seconds = args.max_draw_seconds or 0.5
+
+    report: Dict[str, Any] = {"sampler": [], "baseline": [], "endpoints": [], "fairness": None}
+    failures: List[str] = []
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        users = generate_population(size, args.seed)
+        row = bench_sampler(users, args.draws, args.seed)
+        report["sampler"].append(row)
+        print(json.dumps(row))
+        if args.min_draws_per_sec and (row["draws_per_sec"] or 0) < args.min_draws_per_sec:
+            failures.append(f"{size} users: {row['draws_per_sec']} draws/sec < {args.min_draws_per_sec}")
+        if args.max_draw_seconds and row["draw_6_places_s"] > args.max_draw_seconds:
+            failures.append(f"{size} users: 6-place draw {row['draw_6_places_s']}s > {args.max_draw_seconds}s")
+        if args.baseline:
+            base = bench_linear(users, 20, args.seed)
+            report["baseline"].append(base)
+            print(json.dumps(base))
+        if args.endpoints:
+            ep = bench_endpoints(users)
+            report["endpoints"].append(ep)
+            print(json.dumps(ep))
+
+    report["fairness"] = fairness(args.runs, args.seed)
+    print(json.dumps(report["fairness"]))
+    for place in ("place_1", "place_2"):
+        p = report["fairness"][place]["p_value"]
+        if p < args.alpha:
+            failures.append(f"fairness {place}: p={p} < alpha={args.alpha}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({**report, "failures": failures}, f, indent=2)
+    if failures:
+        for msg in failures:
+            print(f"FAIL: {msg}", file=sys.stderr)
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
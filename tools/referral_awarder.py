@@ -3,6 +3,7 @@ import argparse
 import csv
 import json
 import os
+import sys
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, Dict
@@ -16,6 +17,12 @@ try:
 except Exception:
     pass
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from shared.tg_ratelimit import LANE_BULK, TelegramRateLimiter, redis_getter  # noqa: E402
+
+# DMs share the cluster-wide Telegram buckets (REDIS_URL) in the bulk lane
+_limiter = TelegramRateLimiter(redis_getter(os.environ.get("REDIS_URL")), max_wait=120)
+
 
 DEFAULT_API = os.environ.get("RATING_API_URL", "https://api.gtm.baby/api")
 DEFAULT_REFERRALS_API = os.environ.get("REFERRALS_API_URL", os.environ.get("REFERRALS_API_URL", "https://api.gtm.baby/referrals"))
@@ -61,8 +68,10 @@ def notify_user_dm(telegram_id: int, message: str) -> bool:
         return False
     url = f"https://api.telegram.org/bot{token}/sendMessage"
     try:
-        r = requests.post(url, json={"chat_id": telegram_id, "text": message, "parse_mode": "HTML"}, timeout=10)
-        return 200 <= r.status_code < 300
+        r = _limiter.run("sendMessage", lambda: requests.post(
+            url, json={"chat_id": telegram_id, "text": message, "parse_mode": "HTML"}, timeout=10,
+        ), chat_id=telegram_id, lane=LANE_BULK)
+        return r is not None and 200 <= r.status_code < 300
     except requests.RequestException:
         return False
 
@@ -2,6 +2,7 @@
 import argparse
 import json
 import os
+import sys
 from typing import Dict, Set, Tuple
 
 import requests
@@ -12,6 +13,12 @@ try:
 except Exception:
     pass
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from shared.tg_ratelimit import LANE_BULK, TelegramRateLimiter, redis_getter  # noqa: E402
+
+# DMs share the cluster-wide Telegram buckets (REDIS_URL) in the bulk lane
+_limiter = TelegramRateLimiter(redis_getter(os.environ.get("REDIS_URL")), max_wait=120)
+
 
 DEFAULT_REPORT = "logs/referral_awarder_report.jsonl"
 DEFAULT_TEMPLATE = (
@@ -23,8 +30,10 @@ DEFAULT_TEMPLATE = (
 def send_dm(bot_token: str, chat_id: int, text: str) -> bool:
     url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
     try:
-        r = requests.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, timeout=10)
-        return 200 <= r.status_code < 300
+        r = _limiter.run("sendMessage", lambda: requests.post(
+            url, json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, timeout=10,
+        ), chat_id=chat_id, lane=LANE_BULK)
+        return r is not None and 200 <= r.status_code < 300
     except requests.RequestException:
         return False
 